@@ -0,0 +1,148 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from wonderful_matrices.models.configuration_cheems import CheemsConfig
+from wonderful_matrices.models.modeling_cheems import CheemsForCausalLM, HybridSSDAttnDynamicCache
+
+
+def sample_beam_idx(num_beams, keep_ratio, generator):
+    """
+    模拟一步束搜索: 大多数束保留自己的父节点, 其余束复制另一个束.
+    Simulate a beam search step: most beams keep their own parent, the others copy another beam.
+    """
+    beam_idx = torch.arange(num_beams)
+    replaced = torch.rand(num_beams, generator=generator) >= keep_ratio
+    beam_idx[replaced] = torch.randint(0, num_beams, (int(replaced.sum()),), generator=generator)
+    return beam_idx
+
+
+def synchronize(device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def run_cache(block_size, config, args, num_beams):
+    """
+    预填充后执行若干解码步, 每步重排缓存并更新所有 attn 层, 返回每步的平均耗时.
+    Prefill then run decoding steps that reorder the cache and update every attn layer, return the mean time per step.
+    """
+    generator = torch.Generator().manual_seed(args.seed)
+    dtype = getattr(torch, args.dtype)
+    head_dim = config.hidden_size // config.num_attention_heads
+    attn_layers = [i for i, layer_type in enumerate(config.layers_type) if layer_type == "attn"]
+    cache = HybridSSDAttnDynamicCache(
+        config, num_beams, dtype=dtype, device=args.device, layer_type=config.layers_type, block_size=block_size
+    )
+
+    def new_states(batch_size, seq_len):
+        states = torch.randn(batch_size, config.num_attention_heads, seq_len, head_dim, generator=generator)
+        return states.to(device=args.device, dtype=dtype)
+
+    # 与 generate 一样, 所有束从同一个提示开始
+    # Every beam starts from the same prompt, as in generate
+    for layer_idx in attn_layers:
+        prompt_keys, prompt_values = new_states(1, args.prompt_len), new_states(1, args.prompt_len)
+        cache.update(
+            prompt_keys.expand(num_beams, -1, -1, -1), prompt_values.expand(num_beams, -1, -1, -1), layer_idx
+        )
+    beam_indices = [sample_beam_idx(num_beams, args.keep_ratio, generator) for _ in range(args.steps)]
+    new_tokens = [(new_states(num_beams, 1), new_states(num_beams, 1)) for _ in range(args.steps)]
+
+    synchronize(args.device)
+    start = time.perf_counter()
+    for beam_idx, (key_states, value_states) in zip(beam_indices, new_tokens):
+        cache.reorder_cache(beam_idx.to(args.device))
+        for layer_idx in attn_layers:
+            cache.update(key_states, value_states, layer_idx)
+    synchronize(args.device)
+    elapsed = (time.perf_counter() - start) / args.steps
+
+    # 两种缓存在相同的束重排下必须给出相同的键
+    # Both caches must give the same keys under the same beam reorders
+    return elapsed, cache.key_cache[attn_layers[0]].float().sum().item()
+
+
+def run_generate(block_size, model, args, num_beams):
+    """
+    用随机初始化的仅注意力 Cheems 模型进行束搜索, 返回每个新词元的平均耗时和生成的序列.
+    Beam search with a randomly initialized attention only Cheems model, return the mean time per new token and the
+    generated sequences.
+    """
+    generator = torch.Generator().manual_seed(args.seed)
+    input_ids = torch.randint(3, model.config.vocab_size, (1, args.prompt_len), generator=generator).to(args.device)
+    config = model.config
+    cache = HybridSSDAttnDynamicCache(
+        config,
+        num_beams,
+        dtype=model.dtype,
+        device=args.device,
+        layer_type=config.layers_type,
+        block_size=block_size,
+    )
+    synchronize(args.device)
+    start = time.perf_counter()
+    sequences = model.generate(
+        input_ids, max_new_tokens=args.steps, num_beams=num_beams, do_sample=False, past_key_values=cache
+    )
+    synchronize(args.device)
+    return (time.perf_counter() - start) / args.steps, sequences
+
+
+def main(args):
+    # 不加 --generate 时只测缓存本身; --generate 的模型只有 attn 层, 因为 ssd 层需要 mamba_ssm 的 CUDA 内核
+    # Without --generate only the cache is timed, the model of --generate only has attn layers because the ssd layers
+    # need the CUDA kernels of mamba_ssm
+    config = CheemsConfig(
+        hidden_size=args.hidden_size,
+        intermediate_size=2 * args.hidden_size,
+        num_attention_heads=args.num_attention_heads,
+        num_hidden_layers=args.num_hidden_layers,
+        attn_layer_period=1 if args.generate else args.attn_layer_period,
+        attn_layer_offset=0 if args.generate else args.attn_layer_period - 1,
+        pad_token_id=0,
+        eos_token_id=None,
+    )
+    model = None
+    if args.generate:
+        torch.manual_seed(args.seed)
+        model = CheemsForCausalLM(config).to(device=args.device, dtype=getattr(torch, args.dtype)).eval()
+
+    print(f"{'beams':<8}{'index_select (ms)':>20}{'block (ms)':>14}{'speedup':>10}{'same outputs':>15}")
+    for num_beams in args.num_beams:
+        if args.generate:
+            with torch.no_grad():
+                baseline_time, baseline = run_generate(None, model, args, num_beams)
+                block_time, block = run_generate(args.block_size, model, args, num_beams)
+            same = torch.equal(baseline, block)
+        else:
+            baseline_time, baseline = run_cache(None, config, args, num_beams)
+            block_time, block = run_cache(args.block_size, config, args, num_beams)
+            # 随机键与不同的张量布局会导致求和顺序不同, 因此按相对误差比较
+            # Random keys and different tensor layouts change the summation order, so compare with a relative tolerance
+            same = abs(baseline - block) <= 1e-3 * max(abs(baseline), 1.0)
+        print(
+            f"{num_beams:<8}{baseline_time * 1e3:>20.2f}{block_time * 1e3:>14.2f}"
+            f"{baseline_time / block_time:>10.2f}{str(same):>15}"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--num_beams", type=int, nargs="+", default=[4, 8, 12, 16])
+    arg_parser.add_argument("--prompt_len", type=int, default=1024)
+    arg_parser.add_argument("--steps", type=int, default=64)
+    arg_parser.add_argument("--block_size", type=int, default=64)
+    arg_parser.add_argument("--keep_ratio", type=float, default=0.75, help="fraction of beams keeping their parent")
+    arg_parser.add_argument("--generate", action="store_true", help="time model.generate instead of the cache alone")
+    arg_parser.add_argument("--hidden_size", type=int, default=1024)
+    arg_parser.add_argument("--num_attention_heads", type=int, default=8)
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=16)
+    arg_parser.add_argument("--attn_layer_period", type=int, default=2)
+    arg_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    arg_parser.add_argument("--dtype", type=str, default="float32")
+    arg_parser.add_argument("--seed", type=int, default=233)
+    args = arg_parser.parse_args()
+
+    main(args)
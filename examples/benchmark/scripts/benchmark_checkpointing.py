@@ -0,0 +1,105 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from wonderful_matrices.models.configuration_doge import DogeConfig
+from wonderful_matrices.models.modeling_doge import DogeForCausalLM
+
+
+POLICIES = {
+    "none": None,
+    "full": ("full", None),
+    "selective": ("selective", ["attn_scores", "expert_gather", "mlp_intermediate"]),
+    "selective_attn": ("selective", ["attn_scores"]),
+    "selective_mlp": ("selective", ["expert_gather", "mlp_intermediate"]),
+}
+
+
+def build_model(args, policy):
+    config = DogeConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.num_hidden_layers,
+        num_attention_heads=args.num_attention_heads,
+        is_moe=args.is_moe,
+        num_cdmmoe_experts=args.num_cdmmoe_experts,
+        use_cache=False,
+    )
+    if policy is not None:
+        config.gradient_checkpointing_policy, targets = policy
+        if targets is not None:
+            config.selective_checkpointing_targets = targets
+    torch.manual_seed(args.seed)
+    model = DogeForCausalLM(config)
+    if policy is not None:
+        model.gradient_checkpointing_enable()
+    model.train()
+    return model
+
+
+def train_step(model, input_ids):
+    """
+    执行一次前向与反向, 返回前向过程中为反向保存的激活字节数.
+    Run one forward and backward pass, return the number of activation bytes saved for backward during forward.
+    """
+    param_storages = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    seen_storages = set()
+    saved_bytes = 0
+
+    def pack_hook(tensor):
+        nonlocal saved_bytes
+        storage = tensor.untyped_storage()
+        # 参数与同一存储的视图只统计一次
+        # Parameters and views of the same storage are only counted once
+        if storage.data_ptr() not in param_storages and storage.data_ptr() not in seen_storages:
+            seen_storages.add(storage.data_ptr())
+            saved_bytes += storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+        loss = model(input_ids=input_ids, labels=input_ids).loss
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    return saved_bytes
+
+
+def main(args):
+    input_ids = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len))
+    results = {}
+    for name in args.policies:
+        model = build_model(args, POLICIES[name])
+        saved_bytes = train_step(model, input_ids)
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            train_step(model, input_ids)
+        step_time = (time.perf_counter() - start) / args.steps
+        results[name] = (saved_bytes, step_time)
+        del model
+
+    baseline_bytes, baseline_time = results.get("none", next(iter(results.values())))
+    print(f"{'policy':<16}{'saved activations (MB)':>24}{'memory':>10}{'step time (ms)':>18}{'time':>10}")
+    for name, (saved_bytes, step_time) in results.items():
+        print(
+            f"{name:<16}{saved_bytes / 2**20:>24.2f}{saved_bytes / baseline_bytes:>10.2f}"
+            f"{step_time * 1000:>18.2f}{step_time / baseline_time:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--policies", type=str, nargs="+", default=list(POLICIES), choices=list(POLICIES))
+    arg_parser.add_argument("--batch_size", type=int, default=4)
+    arg_parser.add_argument("--seq_len", type=int, default=1024)
+    arg_parser.add_argument("--vocab_size", type=int, default=32768)
+    arg_parser.add_argument("--hidden_size", type=int, default=256)
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=4)
+    arg_parser.add_argument("--num_attention_heads", type=int, default=4)
+    arg_parser.add_argument("--is_moe", action="store_true")
+    arg_parser.add_argument("--num_cdmmoe_experts", type=int, default=4096)
+    arg_parser.add_argument("--steps", type=int, default=5)
+    arg_parser.add_argument("--seed", type=int, default=233)
+    args = arg_parser.parse_args()
+
+    main(args)
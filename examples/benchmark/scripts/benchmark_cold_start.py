@@ -0,0 +1,64 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from wonderful_matrices.loading.lazy_loading import load_lazy_model, resolve_checkpoint_dir
+from wonderful_matrices.models.modeling_doge import DogeForCausalLM
+
+
+@torch.no_grad()
+def time_to_first_token(load_fn, input_ids):
+    """
+    测量从加载权重到输出第一个 token 的耗时, 分别返回加载与首次前向的时间.
+    Measure the time from loading the weights to the first token, return the loading and first forward pass times.
+    """
+    start = time.perf_counter()
+    model = load_fn()
+    load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    logits = model(input_ids=input_ids, num_logits_to_keep=1).logits
+    forward_time = time.perf_counter() - start
+    return load_time, forward_time, logits[:, -1].float()
+
+
+def main(args):
+    if args.model == "cheems":
+        # Cheems 的 SSD 层依赖 mamba_ssm
+        # The SSD layers of Cheems depend on mamba_ssm
+        from wonderful_matrices.models.modeling_cheems import CheemsForCausalLM as model_class
+    else:
+        model_class = DogeForCausalLM
+    # 先下载检查点, 只比较加载时间
+    # Download the checkpoint first, only the loading time is compared
+    checkpoint_dir = resolve_checkpoint_dir(args.model_path)
+    input_ids = torch.randint(0, 1000, (1, args.prompt_len))
+
+    # 注意: 操作系统的页缓存会让第二次读取更快, 清空缓存后分别运行才能得到冷启动时间
+    # Note: the OS page cache makes the second read faster, run each loader after dropping the caches for cold numbers
+    loaders = {
+        "from_pretrained": lambda: model_class.from_pretrained(checkpoint_dir).eval(),
+        "lazy": lambda: load_lazy_model(model_class, checkpoint_dir),
+    }
+    if args.loaders:
+        loaders = {name: loaders[name] for name in args.loaders}
+
+    reference = None
+    print(f"{'loader':<18}{'load (s)':>10}{'first forward (s)':>20}{'total (s)':>12}{'max abs diff':>16}")
+    for name, load_fn in loaders.items():
+        load_time, forward_time, logits = time_to_first_token(load_fn, input_ids)
+        if reference is None:
+            reference = logits
+        max_abs_diff = (logits - reference).abs().max().item()
+        print(f"{name:<18}{load_time:>10.2f}{forward_time:>20.2f}{load_time + forward_time:>12.2f}{max_abs_diff:>16.2e}")
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--model_path", type=str, default="JingzeShi/Doge-320M")
+    arg_parser.add_argument("--model", type=str, default="doge", choices=["doge", "cheems"])
+    arg_parser.add_argument("--loaders", type=str, nargs="+", default=None, choices=["from_pretrained", "lazy"])
+    arg_parser.add_argument("--prompt_len", type=int, default=16)
+    args = arg_parser.parse_args()
+
+    main(args)
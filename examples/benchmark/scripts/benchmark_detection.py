@@ -0,0 +1,107 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from wonderful_matrices.models.configuration_doge_vision import DogeConfig
+from wonderful_matrices.models.image_processing_doge import (
+    DogeImageProcessor,
+    batched_box_iou,
+    center_to_corners_format,
+)
+from wonderful_matrices.models.modeing_doge_vision import DogeForObjectDetection, DogeObjectDetectionOutputWithPast
+
+
+def loop_post_process(outputs, threshold, target_sizes, nms_threshold, top_k):
+    """
+    逐图像, 逐框的参考实现, 用于比较结果与速度.
+    Reference implementation looping over the images and the boxes, to compare the results and the speed.
+    """
+    results = []
+    for logits, boxes, (height, width) in zip(outputs.logits, outputs.pred_boxes, target_sizes.tolist()):
+        scores, labels = logits.float().softmax(-1)[:, :-1].max(-1)
+        boxes = center_to_corners_format(boxes.float()) * torch.tensor([width, height, width, height])
+        selected = (scores > threshold).nonzero().squeeze(-1)
+        selected = selected[scores[selected].argsort(descending=True)]
+        iou = batched_box_iou(boxes[None])[0]
+        kept = []
+        for candidate in selected.tolist():
+            if all(labels[i] != labels[candidate] or iou[i, candidate] <= nms_threshold for i in kept):
+                kept.append(candidate)
+            if len(kept) == top_k:
+                break
+        kept = torch.tensor(kept, dtype=torch.long)
+        results.append({"scores": scores[kept], "labels": labels[kept], "boxes": boxes[kept]})
+    return results
+
+
+def timed(fn, steps):
+    start = time.perf_counter()
+    for _ in range(steps):
+        result = fn()
+    return (time.perf_counter() - start) / steps, result
+
+
+@torch.no_grad()
+def main(args):
+    config = DogeConfig(
+        hidden_size=args.hidden_size,
+        num_hidden_layers=args.num_hidden_layers,
+        num_attention_heads=args.num_attention_heads,
+        image_size=[args.image_size, args.image_size],
+        num_detection_tokens=args.num_detection_tokens,
+        num_labels=args.num_labels,
+    )
+    model = DogeForObjectDetection(config).eval()
+    image_processor = DogeImageProcessor()
+    generator = torch.Generator().manual_seed(args.seed)
+
+    print(f"{'batch':>6}{'forward (ms)':>14}{'post (ms)':>12}{'loop post (ms)':>16}{'images/s':>10}{'match':>8}")
+    for batch_size in args.batch_sizes:
+        pixel_values = torch.randn(batch_size, 3, args.image_size, args.image_size, generator=generator)
+        target_sizes = torch.tensor([[args.image_size, args.image_size]] * batch_size)
+        forward_time, outputs = timed(lambda: model(pixel_values=pixel_values, use_cache=False), args.steps)
+
+        # 随机初始化的模型几乎不输出高分框, 用随机的输出测量后处理
+        # A randomly initialized model hardly outputs confident boxes, the post-processing runs on random outputs
+        outputs = DogeObjectDetectionOutputWithPast(
+            logits=torch.randn(batch_size, args.num_detection_tokens, args.num_labels + 1, generator=generator) * 4,
+            pred_boxes=torch.rand(batch_size, args.num_detection_tokens, 4, generator=generator) * 0.5 + 0.25,
+        )
+        post_kwargs = dict(
+            threshold=args.threshold, target_sizes=target_sizes, nms_threshold=args.nms_threshold, top_k=args.top_k
+        )
+        post_time, results = timed(
+            lambda: image_processor.post_process_object_detection(outputs, **post_kwargs), args.steps
+        )
+        loop_time, loop_results = timed(lambda: loop_post_process(outputs, **post_kwargs), args.steps)
+
+        match = all(
+            torch.equal(result["labels"], loop_result["labels"])
+            and torch.allclose(result["boxes"], loop_result["boxes"])
+            for result, loop_result in zip(results, loop_results)
+        )
+        images_per_s = batch_size / (forward_time + post_time)
+        print(
+            f"{batch_size:>6}{forward_time * 1e3:>14.1f}{post_time * 1e3:>12.2f}{loop_time * 1e3:>16.2f}"
+            f"{images_per_s:>10.1f}{str(match):>8}"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32])
+    arg_parser.add_argument("--image_size", type=int, default=256)
+    arg_parser.add_argument("--num_detection_tokens", type=int, default=100)
+    arg_parser.add_argument("--num_labels", type=int, default=91)
+    arg_parser.add_argument("--threshold", type=float, default=0.1)
+    arg_parser.add_argument("--nms_threshold", type=float, default=0.5)
+    arg_parser.add_argument("--top_k", type=int, default=100)
+    arg_parser.add_argument("--hidden_size", type=int, default=256)
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=4)
+    arg_parser.add_argument("--num_attention_heads", type=int, default=4)
+    arg_parser.add_argument("--steps", type=int, default=5)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+
+    main(args)
@@ -0,0 +1,100 @@
+import time
+import types
+from argparse import ArgumentParser
+
+import yaml
+import torch
+import torch.nn.functional as F
+
+from wonderful_matrices.models.configuration_doge import DogeConfig
+from wonderful_matrices.models.modeling_doge import DogeForCausalLM, DogeMLP
+
+
+def unfused_mlp(self, hidden_states):
+    """
+    用两次 GEMM 分别计算 gate 与 up, 即打包之前的实现.
+    Compute gate and up with two separate GEMMs, the implementation before packing.
+    """
+    gate_weight, up_weight = self.gate_up_proj.weight.chunk(2, dim=0)
+    gate_bias, up_bias = self.gate_up_proj.bias.chunk(2, dim=0) if self.gate_up_proj.bias is not None else (None, None)
+    gate_states = F.linear(hidden_states, gate_weight, gate_bias)
+    up_states = F.linear(hidden_states, up_weight, up_bias)
+    return self.down_proj(self.act_fn(gate_states) * up_states)
+
+
+def use_unfused_mlp(model):
+    for module in model.modules():
+        if isinstance(module, DogeMLP):
+            module.mlp = types.MethodType(unfused_mlp, module)
+
+
+def load_model_config(config_path):
+    with open(config_path, 'r', encoding='utf-8') as f:
+        hyperparameters = yaml.load(f, Loader=yaml.FullLoader)
+    return DogeConfig(**hyperparameters['model_config'])
+
+
+def throughput(model, input_ids, steps, train):
+    """
+    返回每秒处理的 token 数, 训练模式包括前向, 反向与参数梯度清零.
+    Return the number of tokens processed per second, training includes forward, backward and zeroing the gradients.
+    """
+    def step():
+        if train:
+            loss = model(input_ids=input_ids, labels=input_ids).loss
+            loss.backward()
+            model.zero_grad(set_to_none=True)
+        else:
+            with torch.no_grad():
+                model(input_ids=input_ids)
+
+    model.train(train)
+    step()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    return input_ids.numel() * steps / (time.perf_counter() - start)
+
+
+def main(args):
+    print(f"{'config':<16}{'mode':<12}{'unfused (tok/s)':>18}{'packed (tok/s)':>18}{'speedup':>10}")
+    for config_path in args.config_paths:
+        config = load_model_config(config_path)
+        config.use_cache = False
+        torch.manual_seed(args.seed)
+        input_ids = torch.randint(0, config.vocab_size, (args.batch_size, args.seq_len))
+        name = config_path.split('/')[-1].replace('.yaml', '')
+        for mode in args.modes:
+            results = {}
+            for variant in ("unfused", "packed"):
+                torch.manual_seed(args.seed)
+                model = DogeForCausalLM(config)
+                if variant == "unfused":
+                    use_unfused_mlp(model)
+                results[variant] = throughput(model, input_ids, args.steps, train=mode == "train")
+                del model
+            print(
+                f"{name:<16}{mode:<12}{results['unfused']:>18.1f}{results['packed']:>18.1f}"
+                f"{results['packed'] / results['unfused']:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument(
+        "--config_paths",
+        type=str,
+        nargs="+",
+        default=[f"./examples/pretrain/configs/Doge-{size}.yaml" for size in ("20M", "60M", "160M", "320M")],
+    )
+    arg_parser.add_argument("--modes", type=str, nargs="+", default=["train", "inference"], choices=["train", "inference"])
+    arg_parser.add_argument("--batch_size", type=int, default=2)
+    arg_parser.add_argument("--seq_len", type=int, default=512)
+    arg_parser.add_argument("--steps", type=int, default=5)
+    arg_parser.add_argument("--threads", type=int, default=None)
+    arg_parser.add_argument("--seed", type=int, default=233)
+    args = arg_parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    main(args)
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import torch
+from PIL import Image
+
+from wonderful_matrices.models.configuration_doge_vision import DogeConfig
+from wonderful_matrices.models.image_processing_doge import DogeImageProcessor, build_image_dataloader
+from wonderful_matrices.models.modeing_doge_vision import DogeForObjectDetection
+
+
+def write_images(directory, args, generator):
+    """
+    生成随机的 JPEG 图像, 模拟服务时收到的照片.
+    Write random JPEG images, standing in for the photos received while serving.
+    """
+    paths = []
+    for image_idx in range(args.num_images):
+        size = (args.source_height, args.source_width, 3)
+        pixels = torch.randint(0, 256, size, dtype=torch.uint8, generator=generator)
+        path = os.path.join(directory, f"{image_idx}.jpg")
+        image = Image.frombytes("RGB", (args.source_width, args.source_height), pixels.numpy().tobytes())
+        image.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def run(batches, model, post_process):
+    """
+    对每个批次运行模型与后处理, 返回每秒处理的图像数.
+    Run the model and the post-processing on every batch, return the images per second.
+    """
+    num_images = 0
+    start = time.perf_counter()
+    for batch in batches:
+        outputs = model(pixel_values=batch["pixel_values"], use_cache=False)
+        post_process(outputs, target_sizes=batch["original_sizes"])
+        num_images += len(batch["pixel_values"])
+    return num_images / (time.perf_counter() - start)
+
+
+@torch.no_grad()
+def main(args):
+    config = DogeConfig(
+        hidden_size=args.hidden_size,
+        num_hidden_layers=args.num_hidden_layers,
+        num_attention_heads=args.num_attention_heads,
+        image_size=[args.image_size, args.image_size],
+    )
+    model = DogeForObjectDetection(config).eval()
+    image_processor = DogeImageProcessor.from_config(config)
+    post_process = image_processor.post_process_object_detection
+    generator = torch.Generator().manual_seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_images(directory, args, generator)
+        batched_paths = [paths[i : i + args.batch_size] for i in range(0, len(paths), args.batch_size)]
+
+        # 串行: 在主进程中解码, 然后运行模型
+        # Serial: decode in the main process, then run the model
+        serial_images_per_s = run((image_processor(batch) for batch in batched_paths), model, post_process)
+
+        print(f"{'workers':>8}{'images/s':>10}{'speedup':>10}{'shared':>8}{'match':>8}")
+        print(f"{'serial':>8}{serial_images_per_s:>10.1f}{1.0:>10.2f}{'-':>8}{'-':>8}")
+        for num_workers in args.num_workers:
+            dataloader = build_image_dataloader(
+                paths, image_processor, batch_size=args.batch_size, num_workers=num_workers
+            )
+            # 预热: 启动工作进程
+            # Warmup: start the workers
+            first_batch = next(iter(dataloader))
+            shared = first_batch["pixel_values"].is_shared()
+            match = torch.equal(first_batch["pixel_values"], image_processor(batched_paths[0])["pixel_values"])
+
+            # 工作进程解码后续批次的同时, 主进程运行模型
+            # The workers decode the next batches while the main process runs the model
+            images_per_s = run(dataloader, model, post_process)
+            print(
+                f"{num_workers:>8}{images_per_s:>10.1f}{images_per_s / serial_images_per_s:>10.2f}"
+                f"{str(shared):>8}{str(match):>8}"
+            )
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--num_images", type=int, default=256)
+    arg_parser.add_argument("--source_height", type=int, default=1080)
+    arg_parser.add_argument("--source_width", type=int, default=1440)
+    arg_parser.add_argument("--batch_size", type=int, default=16)
+    arg_parser.add_argument("--num_workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    arg_parser.add_argument("--image_size", type=int, default=256)
+    arg_parser.add_argument("--hidden_size", type=int, default=256)
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=4)
+    arg_parser.add_argument("--num_attention_heads", type=int, default=4)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+
+    main(args)
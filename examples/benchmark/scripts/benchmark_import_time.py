@@ -0,0 +1,86 @@
+import re
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+# 这些可选依赖只应在首次使用时导入
+# These optional dependencies must only be imported on first use
+DEFERRED_PACKAGES = ["einx", "mamba_ssm", "onnx", "onnxruntime", "accelerate", "einops"]
+
+
+def import_time(module, python):
+    """
+    在新的解释器中用 `-X importtime` 导入模块, 返回总耗时 (秒) 与每个被导入模块的 (自身, 累计) 耗时.
+    Import the module in a fresh interpreter with `-X importtime`, return the total time in seconds and the
+    (self, cumulative) times of every imported module.
+    """
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, _, name = match.groups()
+            times[name] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    total = times.get(module, (0.0, 0.0))[1]
+    return total, times
+
+
+def main(args):
+    failed = False
+    print(f"{'module':<48}{'import (s)':>12}  deferred packages imported")
+    for module in args.modules:
+        best_total, times = None, None
+        # 取多次运行的最小值以减少噪声
+        # Take the best of several runs to reduce the noise
+        for _ in range(args.repeats):
+            total, run_times = import_time(module, args.python)
+            if best_total is None or total < best_total:
+                best_total, times = total, run_times
+        imported = sorted(package for package in DEFERRED_PACKAGES if package in times)
+        print(f"{module:<48}{best_total:>12.3f}  {', '.join(imported) or '-'}")
+
+        if args.verbose:
+            heaviest = sorted(times.items(), key=lambda item: item[1][0], reverse=True)[: args.top]
+            for name, (self_time, cumulative_time) in heaviest:
+                print(f"    {name:<44}{self_time:>12.3f}{cumulative_time:>12.3f}")
+
+        if args.max_seconds is not None and best_total > args.max_seconds:
+            print(f"    {module} takes {best_total:.3f}s to import, over the budget of {args.max_seconds:.3f}s")
+            failed = True
+        if imported and args.check_deferred:
+            print(f"    {module} imports {', '.join(imported)} eagerly")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument(
+        "--modules",
+        type=str,
+        nargs="+",
+        default=[
+            "wonderful_matrices",
+            "wonderful_matrices.models",
+            "wonderful_matrices.models.modeling_doge",
+            "wonderful_matrices.models.modeling_cheems",
+        ],
+    )
+    arg_parser.add_argument("--python", type=str, default=sys.executable)
+    arg_parser.add_argument("--repeats", type=int, default=3)
+    arg_parser.add_argument("--max_seconds", type=float, default=None, help="fail if a module takes longer to import")
+    arg_parser.add_argument("--check_deferred", action="store_true", help="fail if a deferred package is imported")
+    arg_parser.add_argument("--verbose", action="store_true", help="print the modules with the largest self time")
+    arg_parser.add_argument("--top", type=int, default=15)
+    args = arg_parser.parse_args()
+
+    main(args)
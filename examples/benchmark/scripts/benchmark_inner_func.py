@@ -0,0 +1,90 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from wonderful_matrices.bench.utils import count_allocations
+from wonderful_matrices.models.configuration_doge_vision import DogeConfig
+from wonderful_matrices.models.modeing_doge_vision import DogeInnerFuncAttn
+
+
+def gather_inner_func(attn, hidden_states):
+    """
+    先收集 b h t k d 的值再求和, 即 embedding_bag 之前的实现.
+    Gather the b h t k d values then sum them, the implementation before embedding_bag.
+    """
+    bsz, seq_len, _ = hidden_states.shape
+    v_queries = attn.v_queries(hidden_states)
+    v_queries = v_queries.view(bsz, seq_len, attn.num_inner_value_heads, -1).transpose(1, 2)
+    sim = torch.matmul(v_queries, attn.v_keys)
+    v_embed = attn.v_embed(sim.topk(k=attn.num_value_per_head, dim=-1).indices)
+    return hidden_states * v_embed.sum(dim=-2).sum(dim=-3)
+
+
+def measure(fn, hidden_states, args):
+    """
+    返回平均耗时与峰值内存 (CUDA) 或分配的内存 (CPU), 单位为 MB.
+    Return the mean time and the peak memory on CUDA, or the allocated memory on CPU, in MB.
+    """
+    for _ in range(args.warmup):
+        fn(hidden_states)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        output = fn(hidden_states)
+        if args.backward:
+            output.sum().backward()
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / args.steps
+    if args.device.startswith("cuda"):
+        memory = (torch.cuda.max_memory_allocated() - baseline) / 2**20
+    else:
+        _, memory = count_allocations(lambda: fn(hidden_states))
+    return elapsed, memory, output
+
+
+def main(args):
+    config = DogeConfig(
+        hidden_size=args.hidden_size,
+        num_attention_heads=args.num_attention_heads,
+        num_inner_values=args.num_inner_values,
+        num_inner_value_heads=args.num_inner_value_heads,
+        num_value_per_head=args.num_value_per_head,
+    )
+    attn = DogeInnerFuncAttn(config, layer_idx=0).to(args.device)
+    torch.nn.init.normal_(attn.v_keys, std=config.initializer_range)
+
+    print(f"{'seq_len':>8}{'gather (ms)':>14}{'bag (ms)':>12}{'gather MB':>12}{'bag MB':>10}{'max abs diff':>16}")
+    for seq_len in args.seq_lens:
+        hidden_states = torch.randn(args.batch_size, seq_len, args.hidden_size, device=args.device)
+        hidden_states.requires_grad_(args.backward)
+        with torch.set_grad_enabled(args.backward):
+            gather_time, gather_memory, reference = measure(lambda x: gather_inner_func(attn, x), hidden_states, args)
+            bag_time, bag_memory, output = measure(attn.inner_func, hidden_states, args)
+        max_abs_diff = (output - reference).abs().max().item()
+        print(
+            f"{seq_len:>8}{gather_time * 1e3:>14.2f}{bag_time * 1e3:>12.2f}{gather_memory:>12.1f}{bag_memory:>10.1f}"
+            f"{max_abs_diff:>16.2e}"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--seq_lens", type=int, nargs="+", default=[256, 1024, 4096])
+    arg_parser.add_argument("--batch_size", type=int, default=2)
+    arg_parser.add_argument("--hidden_size", type=int, default=1024)
+    arg_parser.add_argument("--num_attention_heads", type=int, default=8)
+    arg_parser.add_argument("--num_inner_values", type=int, default=8)
+    arg_parser.add_argument("--num_inner_value_heads", type=int, default=4)
+    arg_parser.add_argument("--num_value_per_head", type=int, default=4)
+    arg_parser.add_argument("--backward", action="store_true")
+    arg_parser.add_argument("--warmup", type=int, default=2)
+    arg_parser.add_argument("--steps", type=int, default=10)
+    arg_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = arg_parser.parse_args()
+
+    main(args)
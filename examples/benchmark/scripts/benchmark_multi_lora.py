@@ -0,0 +1,99 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from wonderful_matrices.adapters.multi_lora import MultiLoRALinear, adapter_batch, inject_multi_lora, load_lora_adapter
+from wonderful_matrices.models.configuration_doge import DogeConfig
+from wonderful_matrices.models.modeling_doge import DogeForCausalLM
+
+
+def random_adapter(model, rank, generator):
+    """
+    生成一个覆盖所有 MultiLoRALinear 层的随机 PEFT 格式适配器.
+    Build a random adapter in the PEFT format covering every MultiLoRALinear layer.
+    """
+    state_dict = {}
+    for name, module in model.named_modules():
+        if isinstance(module, MultiLoRALinear):
+            in_features, out_features = module.base_layer.in_features, module.base_layer.out_features
+            state_dict[f"base_model.model.{name}.lora_A.weight"] = torch.randn(rank, in_features, generator=generator) * 0.01
+            state_dict[f"base_model.model.{name}.lora_B.weight"] = torch.randn(out_features, rank, generator=generator) * 0.01
+    return state_dict
+
+
+@torch.no_grad()
+def timed_forward(model, input_ids, adapter_ids, args):
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        if adapter_ids is None:
+            logits = model(input_ids=input_ids).logits
+        else:
+            with adapter_batch(model, adapter_ids):
+                logits = model(input_ids=input_ids).logits
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.steps, logits
+
+
+@torch.no_grad()
+def main(args):
+    torch.manual_seed(args.seed)
+    generator = torch.Generator().manual_seed(args.seed)
+    config = DogeConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.num_hidden_layers,
+        num_attention_heads=args.num_attention_heads,
+    )
+    model = DogeForCausalLM(config)
+    inject_multi_lora(model, num_adapters=args.num_adapters, rank=args.rank)
+    for slot in range(1, args.num_adapters + 1):
+        load_lora_adapter(model, random_adapter(model, args.rank, generator), slot=slot, lora_alpha=2 * args.rank)
+    model = model.to(device=args.device, dtype=getattr(torch, args.dtype)).eval()
+
+    input_ids = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len), device=args.device)
+    # 每个请求随机选择一个适配器, 0 表示基础模型
+    # Every request picks a random adapter, 0 is the base model
+    adapter_ids = torch.randint(0, args.num_adapters + 1, (args.batch_size,), generator=generator)
+
+    base_time, _ = timed_forward(model, input_ids, None, args)
+    mixed_time, mixed_logits = timed_forward(model, input_ids, adapter_ids, args)
+
+    # 基线: 按适配器分组, 每组单独前向
+    # Baseline: group the requests by adapter and run one forward pass per group
+    grouped_time = 0.0
+    grouped_logits = torch.empty_like(mixed_logits)
+    for adapter_id in adapter_ids.unique().tolist():
+        rows = (adapter_ids == adapter_id).nonzero().squeeze(-1).to(args.device)
+        elapsed, logits = timed_forward(model, input_ids[rows], [adapter_id] * len(rows), args)
+        grouped_time += elapsed
+        grouped_logits[rows] = logits
+    max_abs_diff = (mixed_logits.float() - grouped_logits.float()).abs().max().item()
+
+    print(f"{'mode':<24}{'time (ms)':>12}{'tok/s':>12}")
+    for name, elapsed in [("base only", base_time), ("grouped per adapter", grouped_time), ("mixed batch", mixed_time)]:
+        print(f"{name:<24}{elapsed * 1e3:>12.2f}{args.batch_size * args.seq_len / elapsed:>12.1f}")
+    print(f"max abs diff mixed vs grouped: {max_abs_diff:.2e}")
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--num_adapters", type=int, default=16)
+    arg_parser.add_argument("--rank", type=int, default=16)
+    arg_parser.add_argument("--batch_size", type=int, default=32)
+    arg_parser.add_argument("--seq_len", type=int, default=128)
+    arg_parser.add_argument("--steps", type=int, default=10)
+    arg_parser.add_argument("--vocab_size", type=int, default=32768)
+    arg_parser.add_argument("--hidden_size", type=int, default=512)
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=8)
+    arg_parser.add_argument("--num_attention_heads", type=int, default=8)
+    arg_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    arg_parser.add_argument("--dtype", type=str, default="float32")
+    arg_parser.add_argument("--seed", type=int, default=233)
+    args = arg_parser.parse_args()
+
+    main(args)
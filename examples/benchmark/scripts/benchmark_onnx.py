@@ -0,0 +1,89 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from wonderful_matrices.export.export_doge import (
+    check_onnx_parity,
+    eager_greedy_generate,
+    export_doge_onnx,
+    load_onnx_sessions,
+    onnx_greedy_generate,
+)
+from wonderful_matrices.models.configuration_doge import DogeConfig
+from wonderful_matrices.models.modeling_doge import DogeForCausalLM
+
+
+def build_model(args):
+    if args.model_path is not None:
+        return DogeForCausalLM.from_pretrained(args.model_path, torch_dtype=torch.float32).eval()
+    config = DogeConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.num_hidden_layers,
+        num_attention_heads=args.num_attention_heads,
+        is_moe=args.is_moe,
+    )
+    return DogeForCausalLM(config).eval()
+
+
+def timed(generate_fn, max_new_tokens):
+    """
+    分别测量预填充 (首 token) 与之后每个解码步的平均耗时.
+    Measure the prefill (first token) time and the mean time of every following decoding step.
+    """
+    start = time.perf_counter()
+    generate_fn(1)
+    prefill_time = time.perf_counter() - start
+    start = time.perf_counter()
+    generate_fn(max_new_tokens)
+    decode_time = (time.perf_counter() - start - prefill_time) / (max_new_tokens - 1)
+    return prefill_time, decode_time
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.threads)
+    model = build_model(args)
+    export_doge_onnx(model, args.output_dir, opset_version=args.opset_version)
+
+    input_ids = torch.randint(0, model.config.vocab_size, (args.batch_size, args.prompt_len))
+    attention_mask = torch.ones_like(input_ids)
+    # 左填充第一行, 以覆盖填充掩码
+    # Left pad the first row to cover the padding mask
+    attention_mask[0, : args.prompt_len // 4] = 0
+
+    max_abs_diff = check_onnx_parity(model, args.output_dir, input_ids, attention_mask, args.parity_tokens, args.atol)
+    print(f"parity over {args.parity_tokens} greedy steps: max abs diff {max_abs_diff:.2e}")
+
+    sessions = load_onnx_sessions(args.output_dir, num_threads=args.threads)
+    results = {
+        "eager": timed(lambda n: eager_greedy_generate(model, input_ids, attention_mask, n), args.max_new_tokens),
+        "onnxruntime": timed(lambda n: onnx_greedy_generate(sessions, input_ids, attention_mask, n), args.max_new_tokens),
+    }
+    print(f"{'runtime':<14}{'prefill (ms)':>14}{'decode (ms/token)':>20}")
+    for name, (prefill_time, decode_time) in results.items():
+        print(f"{name:<14}{prefill_time * 1e3:>14.2f}{decode_time * 1e3:>20.2f}")
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--model_path", type=str, default=None, help="a Doge checkpoint, a random model if not given")
+    arg_parser.add_argument("--output_dir", type=str, default="./onnx/doge")
+    arg_parser.add_argument("--opset_version", type=int, default=17)
+    arg_parser.add_argument("--batch_size", type=int, default=1)
+    arg_parser.add_argument("--prompt_len", type=int, default=128)
+    arg_parser.add_argument("--max_new_tokens", type=int, default=32)
+    arg_parser.add_argument("--parity_tokens", type=int, default=8)
+    arg_parser.add_argument("--atol", type=float, default=1e-4)
+    arg_parser.add_argument("--vocab_size", type=int, default=32768)
+    arg_parser.add_argument("--hidden_size", type=int, default=256)
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=4)
+    arg_parser.add_argument("--num_attention_heads", type=int, default=4)
+    arg_parser.add_argument("--is_moe", action="store_true")
+    arg_parser.add_argument("--threads", type=int, default=4)
+    arg_parser.add_argument("--seed", type=int, default=233)
+    args = arg_parser.parse_args()
+
+    main(args)
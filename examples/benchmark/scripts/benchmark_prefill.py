@@ -0,0 +1,109 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from wonderful_matrices.models.configuration_cheems import CheemsConfig
+from wonderful_matrices.models.configuration_doge import DogeConfig
+
+
+def build_model(args):
+    if args.model == "doge":
+        from wonderful_matrices.models.modeling_doge import DogeModel
+
+        config = DogeConfig(
+            vocab_size=args.vocab_size,
+            hidden_size=args.hidden_size,
+            intermediate_size=args.hidden_size * 4,
+            num_hidden_layers=args.num_hidden_layers,
+            num_attention_heads=args.num_attention_heads,
+            max_position_embeddings=args.seq_len,
+        )
+        model = DogeModel(config)
+    else:
+        # Cheems 的 SSD 层依赖 mamba_ssm 的 CUDA 内核
+        # The SSD layers of Cheems depend on the CUDA kernels of mamba_ssm
+        from wonderful_matrices.models.modeling_cheems import CheemsModel
+
+        config = CheemsConfig(
+            vocab_size=args.vocab_size,
+            hidden_size=args.hidden_size,
+            intermediate_size=args.hidden_size * 4,
+            num_hidden_layers=args.num_hidden_layers,
+            num_attention_heads=args.num_attention_heads,
+            max_position_embeddings=args.seq_len,
+            attn_layer_period=2,
+            attn_layer_offset=1,
+        )
+        model = CheemsModel(config)
+    return model.to(device=args.device, dtype=getattr(torch, args.dtype)).eval()
+
+
+def new_cache(model, batch_size):
+    if isinstance(model.config, CheemsConfig):
+        from wonderful_matrices.models.modeling_cheems import HybridSSDAttnDynamicCache
+
+        return HybridSSDAttnDynamicCache(
+            model.config,
+            batch_size,
+            dtype=model.dtype,
+            device=model.device,
+            layer_type=model.config.layers_type,
+        )
+    from wonderful_matrices.models.modeling_doge import DogeDynamicCache
+
+    return DogeDynamicCache()
+
+
+@torch.no_grad()
+def prefill(model, input_ids, chunk_size, device):
+    """
+    预填充整个提示, 返回最后的隐藏状态, 耗时与峰值显存.
+    Prefill the whole prompt, return the last hidden state, the elapsed time and the peak memory.
+    """
+    model.config.prefill_chunk_size = chunk_size
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    outputs = model(input_ids=input_ids, past_key_values=new_cache(model, input_ids.shape[0]), use_cache=True)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    peak_memory = torch.cuda.max_memory_allocated() if device.startswith("cuda") else float("nan")
+    return outputs.last_hidden_state[:, -1].float(), elapsed, peak_memory
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    model = build_model(args)
+    input_ids = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len), device=args.device)
+
+    reference = None
+    print(f"{'chunk size':<12}{'time (s)':>12}{'peak memory (MB)':>20}{'max abs diff':>16}")
+    for chunk_size in args.chunk_sizes:
+        chunk_size = None if chunk_size <= 0 else chunk_size
+        last_hidden_state, elapsed, peak_memory = prefill(model, input_ids, chunk_size, args.device)
+        if reference is None:
+            reference = last_hidden_state
+        max_abs_diff = (last_hidden_state - reference).abs().max().item()
+        name = "none" if chunk_size is None else str(chunk_size)
+        print(f"{name:<12}{elapsed:>12.2f}{peak_memory / 2**20:>20.1f}{max_abs_diff:>16.2e}")
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--model", type=str, default="doge", choices=["doge", "cheems"])
+    arg_parser.add_argument("--chunk_sizes", type=int, nargs="+", default=[0, 4096, 1024], help="0 disables chunking")
+    arg_parser.add_argument("--batch_size", type=int, default=1)
+    arg_parser.add_argument("--seq_len", type=int, default=32768)
+    arg_parser.add_argument("--vocab_size", type=int, default=32768)
+    arg_parser.add_argument("--hidden_size", type=int, default=256)
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=4)
+    arg_parser.add_argument("--num_attention_heads", type=int, default=4)
+    arg_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    arg_parser.add_argument("--dtype", type=str, default="float32")
+    arg_parser.add_argument("--seed", type=int, default=233)
+    args = arg_parser.parse_args()
+
+    main(args)
@@ -0,0 +1,135 @@
+import time
+import types
+from argparse import ArgumentParser
+
+import torch
+from transformers.cache_utils import DynamicCache, StaticCache
+
+from wonderful_matrices.models.configuration_doge import DogeConfig
+from wonderful_matrices.models.modeling_doge import DogeForCausalLM
+
+
+@torch.no_grad()
+def direct_forward(self, x, position_ids):
+    """
+    每一步都重新计算 cos 与 sin, 即查表之前的实现.
+    Recompute cos and sin at every step, the implementation before the table lookup.
+    """
+    cos, sin = self._compute_cos_sin(position_ids, x.device.type)
+    return cos.to(dtype=x.dtype), sin.to(dtype=x.dtype)
+
+
+def use_direct_rope(model):
+    rotary_emb = model.model.rotary_emb
+    rotary_emb.forward = types.MethodType(direct_forward, rotary_emb)
+
+
+def time_module(rotary_emb, x, positions, steps):
+    start = time.perf_counter()
+    for _ in range(steps):
+        for position in positions:
+            rotary_emb(x, position)
+    return (time.perf_counter() - start) / (steps * len(positions))
+
+
+def benchmark_module(args):
+    config = DogeConfig(hidden_size=args.hidden_size, num_attention_heads=args.num_attention_heads)
+    model = DogeForCausalLM(config)
+    rotary_emb = model.model.rotary_emb
+    x = torch.zeros(args.batch_size, 1, args.hidden_size)
+    positions = [
+        torch.full((args.batch_size, 1), position, dtype=torch.long)
+        for position in range(args.prompt_len, args.prompt_len + args.new_tokens)
+    ]
+
+    # 查表的结果必须与直接计算完全一致
+    # The table lookup must give exactly the same result as the direct computation
+    for position in positions:
+        cached = rotary_emb(x, position)
+        direct = direct_forward(rotary_emb, x, position)
+        assert all(torch.equal(a, b) for a, b in zip(cached, direct)), "cos/sin table does not match direct computation"
+
+    table_time = time_module(rotary_emb, x, positions, args.steps)
+    rotary_emb.forward = types.MethodType(direct_forward, rotary_emb)
+    direct_time = time_module(rotary_emb, x, positions, args.steps)
+    print(f"{'rotary embedding':<24}{'direct (us)':>14}{'table (us)':>14}{'speedup':>10}")
+    print(f"{'single token':<24}{direct_time * 1e6:>14.2f}{table_time * 1e6:>14.2f}{direct_time / table_time:>10.2f}")
+
+
+@torch.no_grad()
+def decode(model, input_ids, cache, new_tokens):
+    """
+    预填充提示后逐 token 贪心解码, 返回每个 token 的平均延迟与生成的 token.
+    Prefill the prompt then greedily decode token by token, return the mean latency per token and the generated tokens.
+    """
+    batch_size, prompt_len = input_ids.shape
+    cache_position = torch.arange(prompt_len)
+    outputs = model(input_ids=input_ids, past_key_values=cache, cache_position=cache_position, use_cache=True)
+    next_tokens = outputs.logits[:, -1].argmax(dim=-1, keepdim=True)
+    generated = [next_tokens]
+    start = time.perf_counter()
+    for step in range(new_tokens - 1):
+        cache_position = torch.tensor([prompt_len + step])
+        outputs = model(input_ids=next_tokens, past_key_values=cache, cache_position=cache_position, use_cache=True)
+        next_tokens = outputs.logits[:, -1].argmax(dim=-1, keepdim=True)
+        generated.append(next_tokens)
+    latency = (time.perf_counter() - start) / max(new_tokens - 1, 1)
+    return latency, torch.cat(generated, dim=-1)
+
+
+def build_cache(name, model, args):
+    if name == "dynamic":
+        return DynamicCache()
+    return StaticCache(
+        config=model.config,
+        batch_size=args.batch_size,
+        max_cache_len=args.prompt_len + args.new_tokens,
+        device="cpu",
+        dtype=model.dtype,
+    )
+
+
+def benchmark_decode(args):
+    config = DogeConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.num_hidden_layers,
+        num_attention_heads=args.num_attention_heads,
+    )
+    torch.manual_seed(args.seed)
+    input_ids = torch.randint(0, args.vocab_size, (args.batch_size, args.prompt_len))
+
+    print(f"{'decode':<24}{'direct (ms)':>14}{'table (ms)':>14}{'speedup':>10}{'same tokens':>14}")
+    for cache_name in args.caches:
+        results = {}
+        for mode in ("direct", "table"):
+            torch.manual_seed(args.seed)
+            model = DogeForCausalLM(config).eval()
+            if mode == "direct":
+                use_direct_rope(model)
+            decode(model, input_ids, build_cache(cache_name, model, args), args.new_tokens)
+            results[mode] = decode(model, input_ids, build_cache(cache_name, model, args), args.new_tokens)
+        (direct_time, direct_tokens), (table_time, table_tokens) = results["direct"], results["table"]
+        print(
+            f"{cache_name + ' cache':<24}{direct_time * 1e3:>14.2f}{table_time * 1e3:>14.2f}"
+            f"{direct_time / table_time:>10.2f}{str(torch.equal(direct_tokens, table_tokens)):>14}"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--caches", type=str, nargs="+", default=["dynamic", "static"], choices=["dynamic", "static"])
+    arg_parser.add_argument("--batch_size", type=int, default=1)
+    arg_parser.add_argument("--prompt_len", type=int, default=512)
+    arg_parser.add_argument("--new_tokens", type=int, default=128)
+    arg_parser.add_argument("--vocab_size", type=int, default=32768)
+    arg_parser.add_argument("--hidden_size", type=int, default=256)
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=4)
+    arg_parser.add_argument("--num_attention_heads", type=int, default=4)
+    arg_parser.add_argument("--steps", type=int, default=20)
+    arg_parser.add_argument("--seed", type=int, default=233)
+    args = arg_parser.parse_args()
+
+    benchmark_module(args)
+    benchmark_decode(args)
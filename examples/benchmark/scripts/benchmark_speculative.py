@@ -0,0 +1,93 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+from transformers import AutoTokenizer
+
+from wonderful_matrices.generation.speculative import speculative_generate
+from wonderful_matrices.models.modeling_doge import DogeForCausalLM
+
+
+PROMPTS = [
+    "The capital of France is",
+    "Once upon a time, in a small village by the sea,",
+    "def fibonacci(n):",
+    "The three laws of thermodynamics state that",
+]
+
+
+def count_new_tokens(sequences, prompt_len, pad_token_id):
+    return int((sequences[:, prompt_len:] != pad_token_id).sum())
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    dtype = getattr(torch, args.dtype)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, padding_side="left")
+    target_model = DogeForCausalLM.from_pretrained(args.target_model_path, torch_dtype=dtype).to(args.device).eval()
+    draft_model = DogeForCausalLM.from_pretrained(args.draft_model_path, torch_dtype=dtype).to(args.device).eval()
+
+    prompts = (PROMPTS * args.batch_size)[: args.batch_size]
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(args.device)
+    prompt_len = inputs.input_ids.shape[1]
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    # 基线: 目标模型单独逐 token 解码
+    # Baseline: the target model decoding token by token on its own
+    start = time.perf_counter()
+    baseline = target_model.generate(
+        **inputs,
+        max_new_tokens=args.max_new_tokens,
+        do_sample=args.do_sample,
+        temperature=args.temperature if args.do_sample else None,
+        top_p=None,
+        top_k=None,
+        pad_token_id=pad_token_id,
+    )
+    baseline_time = time.perf_counter() - start
+    baseline_tokens = count_new_tokens(baseline, prompt_len, pad_token_id)
+
+    print(f"{'lookahead':<12}{'tok/s':>10}{'speedup':>10}{'acceptance':>12}{'same as target':>16}")
+    print(f"{'target only':<12}{baseline_tokens / baseline_time:>10.1f}{1.0:>10.2f}{'-':>12}{'-':>16}")
+    for num_lookahead_tokens in args.num_lookahead_tokens:
+        start = time.perf_counter()
+        outputs = speculative_generate(
+            target_model,
+            draft_model,
+            inputs.input_ids,
+            attention_mask=inputs.attention_mask,
+            max_new_tokens=args.max_new_tokens,
+            num_lookahead_tokens=num_lookahead_tokens,
+            do_sample=args.do_sample,
+            temperature=args.temperature,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=pad_token_id,
+        )
+        elapsed = time.perf_counter() - start
+        new_tokens = count_new_tokens(outputs.sequences, prompt_len, pad_token_id)
+        acceptance = outputs.num_accepted_tokens / max(outputs.num_draft_tokens, 1)
+        # 贪心解码时输出必须与目标模型完全一致, 采样时只比较吞吐
+        # With greedy decoding the output must match the target model exactly, with sampling only the throughput is compared
+        same = "-" if args.do_sample else str(torch.equal(outputs.sequences, baseline[:, : outputs.sequences.shape[1]]))
+        print(
+            f"{num_lookahead_tokens:<12}{new_tokens / elapsed:>10.1f}"
+            f"{(new_tokens / elapsed) / (baseline_tokens / baseline_time):>10.2f}{acceptance:>12.2f}{same:>16}"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--target_model_path", type=str, default="JingzeShi/Doge-320M")
+    arg_parser.add_argument("--draft_model_path", type=str, default="JingzeShi/Doge-20M")
+    arg_parser.add_argument("--tokenizer_path", type=str, default="./examples/tokenizer")
+    arg_parser.add_argument("--num_lookahead_tokens", type=int, nargs="+", default=[2, 4, 6, 8])
+    arg_parser.add_argument("--batch_size", type=int, default=1)
+    arg_parser.add_argument("--max_new_tokens", type=int, default=128)
+    arg_parser.add_argument("--do_sample", action="store_true")
+    arg_parser.add_argument("--temperature", type=float, default=1.0)
+    arg_parser.add_argument("--device", type=str, default="cpu")
+    arg_parser.add_argument("--dtype", type=str, default="float32")
+    arg_parser.add_argument("--seed", type=int, default=233)
+    args = arg_parser.parse_args()
+
+    main(args)
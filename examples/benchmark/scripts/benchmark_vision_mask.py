@@ -0,0 +1,80 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from wonderful_matrices.bench.utils import count_allocations
+from wonderful_matrices.models.configuration_doge_vision import DogeConfig
+from wonderful_matrices.models.modeing_doge_vision import DogeModel
+
+
+def legacy_layer_mask(attention_mask, dynamic_mask, sequence_length, target_length, dtype, cache_position):
+    """
+    每层重新构建 (bsz, num_heads, q_len, target_len) 的浮点掩码, 即缓存之前的实现.
+    Rebuild the (bsz, num_heads, q_len, target_len) float mask in every layer, the implementation before caching.
+    """
+    batch_size, num_heads = attention_mask.shape[0], dynamic_mask.shape[0]
+    min_dtype = torch.finfo(dtype).min
+    causal_mask = torch.full((sequence_length, target_length), fill_value=min_dtype, dtype=dtype)
+    causal_mask = torch.triu(causal_mask, diagonal=1)
+    causal_mask *= torch.arange(target_length) > cache_position.reshape(-1, 1)
+    causal_mask = causal_mask[None, None, :, :].expand(batch_size, num_heads, -1, -1).clone()
+    mask_length = attention_mask.shape[-1]
+    padding_mask = attention_mask[:, None, None, :].expand(-1, num_heads, 1, -1)
+    padding_mask = padding_mask.clone() * dynamic_mask[None, :, None, :mask_length].expand(batch_size, -1, 1, -1)
+    padding_mask = causal_mask[:, :, :, :mask_length] + padding_mask
+    causal_mask[:, :, :, :mask_length] = causal_mask[:, :, :, :mask_length].masked_fill(padding_mask == 0, min_dtype)
+    return causal_mask
+
+
+def timed(fn, steps):
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    return (time.perf_counter() - start) / steps
+
+
+@torch.no_grad()
+def main(args):
+    config = DogeConfig(
+        hidden_size=args.hidden_size,
+        num_hidden_layers=args.num_hidden_layers,
+        num_attention_heads=args.num_attention_heads,
+        max_position_embeddings=max(args.seq_lens) + 1,
+    )
+    model = DogeModel(config).eval()
+    dynamic_masks = [layer.attn.dynamic_mask for layer in model.layers]
+
+    print(f"{'seq_len':>8}{'legacy (ms)':>14}{'cached (ms)':>14}{'legacy MB':>12}{'cached MB':>12}")
+    for seq_len in args.seq_lens:
+        inputs_embeds = torch.empty(args.batch_size, seq_len, args.hidden_size)
+        attention_mask = torch.ones(args.batch_size, seq_len, dtype=torch.long)
+        attention_mask[1:, : seq_len // 4] = 0
+        cache_position = torch.arange(seq_len)
+
+        def legacy():
+            for dynamic_mask in dynamic_masks:
+                legacy_layer_mask(attention_mask, dynamic_mask, seq_len, seq_len, torch.float32, cache_position)
+
+        def cached():
+            causal_mask = model._update_causal_mask(attention_mask, inputs_embeds, cache_position, None)
+            for layer in model.layers:
+                layer.attn.prepare_attention_mask(causal_mask, seq_len)
+
+        legacy_time, cached_time = timed(legacy, args.steps), timed(cached, args.steps)
+        _, legacy_memory = count_allocations(legacy)
+        _, cached_memory = count_allocations(cached)
+        print(f"{seq_len:>8}{legacy_time * 1e3:>14.2f}{cached_time * 1e3:>14.2f}{legacy_memory:>12.1f}{cached_memory:>12.1f}")
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--seq_lens", type=int, nargs="+", default=[1024, 2048, 4096])
+    arg_parser.add_argument("--batch_size", type=int, default=2)
+    arg_parser.add_argument("--hidden_size", type=int, default=256)
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=16)
+    arg_parser.add_argument("--num_attention_heads", type=int, default=8)
+    arg_parser.add_argument("--steps", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    main(args)
@@ -0,0 +1,158 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+import torch.nn.functional as F
+
+from wonderful_matrices.models.configuration_doge_vision import DogeConfig
+from wonderful_matrices.models.modeing_doge_vision import DogeForCausalVLM
+
+
+def random_samples(args, generator):
+    """
+    生成随机样本: 每个样本有不同长度的文本与不同数量, 不同分辨率的图像.
+    Build random samples: every sample has a text of a different length and a different number of images of
+    different resolutions.
+    """
+    input_ids, images = [], []
+    for _ in range(args.batch_size):
+        text_len = int(torch.randint(args.min_text_len, args.max_text_len + 1, (1,), generator=generator))
+        num_images = int(torch.randint(0, args.max_images + 1, (1,), generator=generator))
+        input_ids.append(torch.randint(3, args.vocab_size, (text_len,), generator=generator))
+        sample_images = []
+        for _ in range(num_images):
+            height = int(torch.randint(args.min_image_size, args.max_image_size + 1, (1,), generator=generator))
+            width = int(torch.randint(args.min_image_size, args.max_image_size + 1, (1,), generator=generator))
+            sample_images.append(torch.randn(3, height, width, generator=generator))
+        images.append(sample_images)
+    return input_ids, images
+
+
+def padded_inputs(model, input_ids, images):
+    """
+    基线: 将每张图像缩放到 config.image_size, 并将每个样本右填充到批次中的最大长度.
+    Baseline: resize every image to config.image_size and right pad every sample to the longest one of the batch.
+    """
+    image_size = model.pixel_embed.image_size
+    sample_embeds = []
+    for sample_input_ids, sample_images in zip(input_ids, images):
+        embeds = [model.word_embed(sample_input_ids)]
+        for image in sample_images:
+            resized = F.interpolate(image[None], size=tuple(image_size), mode="bilinear", align_corners=False)
+            embeds.append(model.pixel_embed(resized)[0])
+        sample_embeds.append(torch.cat(embeds, dim=0))
+    max_len = max(len(embeds) for embeds in sample_embeds)
+    inputs_embeds = torch.stack([F.pad(embeds, (0, 0, 0, max_len - len(embeds))) for embeds in sample_embeds])
+    attention_mask = torch.zeros(len(sample_embeds), max_len, dtype=torch.long)
+    for sample_idx, embeds in enumerate(sample_embeds):
+        attention_mask[sample_idx, : len(embeds)] = 1
+    return inputs_embeds, attention_mask
+
+
+def block_diagonal_mask(cu_seqlens):
+    """
+    旧的打包方式: 整行的块对角因果掩码, 内存与计算随行长度平方增长.
+    The previous packing: a block diagonal causal mask of the whole row, whose memory and compute grow with the square
+    of the row length.
+    """
+    positions = torch.arange(int(cu_seqlens[-1]))
+    sample_idx = torch.repeat_interleave(torch.arange(len(cu_seqlens) - 1), cu_seqlens.diff())
+    mask = (sample_idx[:, None] == sample_idx[None, :]) & (positions[:, None] >= positions[None, :])
+    return mask[None, None]
+
+
+@torch.no_grad()
+def main(args):
+    config = DogeConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.num_hidden_layers,
+        num_attention_heads=args.num_attention_heads,
+        image_size=[args.image_size, args.image_size],
+        patch_size=args.patch_size,
+    )
+    model = DogeForCausalVLM(config).eval()
+    generator = torch.Generator().manual_seed(args.seed)
+    # 随机初始化的动态掩码保留所有位置, 置零一部分以便一致性检查覆盖它
+    # The dynamic mask of a random init keeps every position, zero a part of it so that the parity check covers it
+    for layer in model.model.layers:
+        dropped = torch.rand(config.max_position_embeddings, generator=generator) < args.dynamic_mask_drop
+        layer.attn.dynamic_mask[:, dropped] = 0
+    input_ids, images = random_samples(args, generator)
+
+    # 填充批次: 固定分辨率, 填充到最长样本
+    # Padded batch: fixed resolution, padded to the longest sample
+    start = time.perf_counter()
+    inputs_embeds, attention_mask = padded_inputs(model, input_ids, images)
+    model(inputs_embeds=inputs_embeds, attention_mask=attention_mask, use_cache=False)
+    padded_time = time.perf_counter() - start
+    padded_tokens = inputs_embeds.shape[0] * inputs_embeds.shape[1]
+
+    # 打包: 原始分辨率, 所有样本拼接为一行, 每层在每个样本内计算注意力
+    # Packed: native resolution, every sample concatenated in one row, every layer attends within each sample
+    start = time.perf_counter()
+    packed = model.pack_inputs(input_ids, images, max_num_patches=args.max_num_patches)
+    logits = model(**packed, use_cache=False).logits
+    packed_time = time.perf_counter() - start
+    packed_tokens = packed.inputs_embeds.shape[1]
+
+    # 相同的打包行, 但使用整行的块对角掩码
+    # The same packed row with a block diagonal mask of the whole row
+    start = time.perf_counter()
+    attention_mask = block_diagonal_mask(packed.cu_seqlens)
+    dense_logits = model(
+        inputs_embeds=packed.inputs_embeds,
+        position_ids=packed.position_ids,
+        attention_mask=attention_mask,
+        use_cache=False,
+    ).logits
+    dense_time = time.perf_counter() - start
+    dense_mask_mb = attention_mask.numel() * attention_mask.element_size() / 2**20
+
+    # 打包的结果应与单独运行每个样本一致
+    # The packed results should match running every sample alone
+    max_abs_diff = 0.0
+    for sample_idx, logits_per_sample in enumerate(logits[0].split(packed.cu_seqlens.diff().tolist())):
+        alone = model.pack_inputs(
+            input_ids[sample_idx : sample_idx + 1], images[sample_idx : sample_idx + 1], args.max_num_patches
+        )
+        alone_logits = model(inputs_embeds=alone.inputs_embeds, use_cache=False).logits[0]
+        max_abs_diff = max(max_abs_diff, (alone_logits - logits_per_sample).abs().max().item())
+    max_abs_diff = max(max_abs_diff, (dense_logits - logits).abs().max().item())
+
+    print(f"{'layout':<14}{'tokens':>10}{'time (s)':>12}{'tokens/s':>12}")
+    print(f"{'padded':<14}{padded_tokens:>10}{padded_time:>12.3f}{padded_tokens / padded_time:>12.0f}")
+    print(f"{'dense mask':<14}{packed_tokens:>10}{dense_time:>12.3f}{packed_tokens / dense_time:>12.0f}")
+    print(f"{'packed':<14}{packed_tokens:>10}{packed_time:>12.3f}{packed_tokens / packed_time:>12.0f}")
+    print(
+        f"speedup x{padded_time / packed_time:.2f} over padding, x{dense_time / packed_time:.2f} over the "
+        f"{dense_mask_mb:.1f} MB dense mask, max abs diff of the packed logits {max_abs_diff:.2e}"
+    )
+    if max_abs_diff > args.atol:
+        raise SystemExit(f"The packed logits differ from running every sample alone by {max_abs_diff:.2e} > {args.atol:.2e}")
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--batch_size", type=int, default=8)
+    arg_parser.add_argument("--min_text_len", type=int, default=16)
+    arg_parser.add_argument("--max_text_len", type=int, default=128)
+    arg_parser.add_argument("--max_images", type=int, default=3)
+    arg_parser.add_argument("--min_image_size", type=int, default=64)
+    arg_parser.add_argument("--max_image_size", type=int, default=256)
+    arg_parser.add_argument("--max_num_patches", type=int, default=None)
+    arg_parser.add_argument("--image_size", type=int, default=256, help="resolution of the padded baseline")
+    arg_parser.add_argument("--patch_size", type=int, default=16)
+    arg_parser.add_argument("--vocab_size", type=int, default=32768)
+    arg_parser.add_argument("--hidden_size", type=int, default=256)
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=4)
+    arg_parser.add_argument("--num_attention_heads", type=int, default=4)
+    arg_parser.add_argument(
+        "--dynamic_mask_drop", type=float, default=0.1, help="fraction of positions zeroed in the dynamic masks"
+    )
+    arg_parser.add_argument("--atol", type=float, default=1e-4)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+
+    main(args)
@@ -0,0 +1,89 @@
+import math
+import time
+from argparse import ArgumentParser
+
+import torch
+import torch.nn.functional as F
+from transformers import AutoTokenizer
+
+from wonderful_matrices.bench.generation import cache_nbytes, load_benchmark_model, new_cache
+
+
+def load_input_ids(args):
+    """
+    读取长文本并分词, 没有文本时使用随机 token, 此时困惑度只用于检查流程.
+    Read and tokenize a long text, without a text random tokens are used and the perplexity only checks the pipeline.
+    """
+    if args.text_file is None:
+        generator = torch.Generator().manual_seed(args.seed)
+        return torch.randint(3, args.vocab_size, (1, args.seq_len), generator=generator)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    with open(args.text_file, encoding="utf-8") as f:
+        input_ids = tokenizer(f.read(), return_tensors="pt").input_ids
+    if input_ids.shape[1] < args.seq_len:
+        print(f"the text only has {input_ids.shape[1]} tokens, fewer than --seq_len {args.seq_len}")
+    return input_ids[:, : args.seq_len]
+
+
+@torch.no_grad()
+def perplexity(model, input_ids, chunk_size):
+    """
+    分块预填充整个序列, 每块的 logits 预测下一个 token, 返回困惑度, 缓存的峰值字节数与耗时.
+    Prefill the whole sequence chunk by chunk, the logits of every chunk predict the next tokens, return the
+    perplexity, the peak bytes of the cache and the elapsed time.
+    """
+    cache = new_cache(model, input_ids.shape[0])
+    seq_len = input_ids.shape[1]
+    nll, num_targets, peak_cache_bytes = 0.0, 0, 0
+    start = time.perf_counter()
+    for chunk_start, outputs in zip(
+        range(0, seq_len, chunk_size),
+        model.model.iter_prefill(input_ids=input_ids, past_key_values=cache, chunk_size=chunk_size),
+    ):
+        targets = input_ids[:, chunk_start + 1 : chunk_start + chunk_size + 1]
+        logits = model.lm_head(outputs.last_hidden_state[:, : targets.shape[1]]).float()
+        nll += F.cross_entropy(logits.flatten(0, 1), targets.flatten(), reduction="sum").item()
+        num_targets += targets.numel()
+        peak_cache_bytes = max(peak_cache_bytes, cache_nbytes(cache))
+    elapsed = time.perf_counter() - start
+    return math.exp(nll / num_targets), peak_cache_bytes, elapsed
+
+
+def main(args):
+    model = load_benchmark_model(args.model_path, torch_dtype=getattr(torch, args.dtype), device=args.device)
+    args.vocab_size = model.config.vocab_size
+    input_ids = load_input_ids(args).to(args.device)
+    seq_len = input_ids.shape[1]
+
+    print(f"{'window':>8}{'perplexity':>12}{'vs full':>10}{'cache MB':>10}{'tokens/s':>10}")
+    full_ppl = None
+    for window in args.windows:
+        # 0 表示所有层都关注完整的历史
+        # 0 means every layer attends to the whole history
+        window = None if window <= 0 else window
+        model.model.set_sliding_window(window, args.sliding_window_layers)
+        ppl, peak_cache_bytes, elapsed = perplexity(model, input_ids, args.chunk_size)
+        if window is None:
+            full_ppl = ppl
+        relative = f"{ppl / full_ppl - 1:+.2%}" if full_ppl is not None else "-"
+        name = "full" if window is None else str(window)
+        print(f"{name:>8}{ppl:>12.3f}{relative:>10}{peak_cache_bytes / 2**20:>10.1f}{seq_len / elapsed:>10.0f}")
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("--model_path", type=str, required=True, help="checkpoint, or config.json for random init")
+    arg_parser.add_argument("--tokenizer_path", type=str, default="./examples/tokenizer")
+    arg_parser.add_argument("--text_file", type=str, default=None)
+    arg_parser.add_argument("--seq_len", type=int, default=16384)
+    arg_parser.add_argument("--chunk_size", type=int, default=1024)
+    arg_parser.add_argument(
+        "--windows", type=int, nargs="+", default=[0, 512, 1024, 2048, 4096], help="0 attends to the whole history"
+    )
+    arg_parser.add_argument("--sliding_window_layers", type=int, nargs="+", default=None)
+    arg_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    arg_parser.add_argument("--dtype", type=str, default="float32")
+    arg_parser.add_argument("--seed", type=int, default=233)
+    args = arg_parser.parse_args()
+
+    main(args)
@@ -0,0 +1,193 @@
+import random
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import torch
+from torch.utils.data import Sampler
+
+
+def compute_padding_ratio(lengths: Sequence[int], batches: Sequence[Sequence[int]]) -> float:
+    """
+    计算一组批次中填充 token 占全部 token 的比例.
+    Compute the fraction of padding tokens over all tokens of a list of batches.
+    """
+    real_tokens = 0
+    padded_tokens = 0
+    for batch in batches:
+        if len(batch) == 0:
+            continue
+        batch_lengths = [lengths[idx] for idx in batch]
+        real_tokens += sum(batch_lengths)
+        padded_tokens += max(batch_lengths) * len(batch)
+    if padded_tokens == 0:
+        return 0.0
+    return 1.0 - real_tokens / padded_tokens
+
+
+def fixed_size_batches(num_samples: int, batch_size: int, seed: int = 0) -> List[List[int]]:
+    """
+    模拟默认的随机采样器: 随机打乱后按固定批次大小切分.
+    Simulate the default random sampler: shuffle and split into fixed size batches.
+    """
+    indices = list(range(num_samples))
+    random.Random(seed).shuffle(indices)
+    return [indices[i : i + batch_size] for i in range(0, num_samples, batch_size)]
+
+
+class TokenBudgetBatchSampler(Sampler[List[int]]):
+    """
+    按长度分桶并以 token 预算组批的采样器.
+    Length bucketed batch sampler that fills every batch up to a token budget.
+
+    样本先按长度分桶, 桶内随机打乱, 然后按长度升序贪心地组成批次,
+    使得 `批次大小 * 批次内最大长度` 不超过 `max_tokens_per_batch`.
+    批次的组成只在初始化时计算一次, 因此 `__len__` 在每个轮次都是稳定的, 每个轮次只打乱批次的顺序.
+    Samples are grouped into buckets of `bucket_width` tokens, shuffled inside each bucket and then greedily
+    packed in ascending length order so that `batch_size * max_length_in_batch` never exceeds
+    `max_tokens_per_batch`. The batches are built once, so `__len__` is stable across epochs, and only the
+    order of the batches is reshuffled every epoch.
+
+    Args:
+        lengths (`Sequence[int]`):
+            Number of tokens of every sample, already truncated to the maximum sequence length.
+        max_tokens_per_batch (`int`):
+            Token budget of a batch, counted with padding.
+        bucket_width (`int`, *optional*, defaults to 64):
+            Width in tokens of a length bucket.
+        max_batch_size (`int`, *optional*):
+            Upper bound of the number of samples in a batch.
+        shuffle (`bool`, *optional*, defaults to `True`):
+            Whether to shuffle the order of the batches every epoch.
+        seed (`int`, *optional*, defaults to 0):
+            Random seed of the bucket and batch shuffling.
+        drop_last (`bool`, *optional*, defaults to `False`):
+            Whether to drop the last, possibly underfilled, batch.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        max_tokens_per_batch: int,
+        bucket_width: int = 64,
+        max_batch_size: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+    ):
+        if max_tokens_per_batch < max(lengths, default=0):
+            raise ValueError(
+                f"`max_tokens_per_batch` ({max_tokens_per_batch}) must be at least the longest sample ({max(lengths)}),"
+                " truncate the samples to `max_seq_length` first."
+            )
+        self.lengths = lengths
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.bucket_width = bucket_width
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.batches = self._build_batches()
+
+    def _build_batches(self) -> List[List[int]]:
+        rng = random.Random(self.seed)
+        buckets = {}
+        for idx, length in enumerate(self.lengths):
+            buckets.setdefault(length // self.bucket_width, []).append(idx)
+
+        batches = []
+        batch, batch_max_length = [], 0
+        for bucket_id in sorted(buckets):
+            bucket = buckets[bucket_id]
+            rng.shuffle(bucket)
+            # 桶内按长度排序, 让批次内的最大长度尽可能贴近其他样本
+            # Sort inside the bucket so that the maximum length of a batch stays close to the other samples
+            bucket.sort(key=lambda idx: self.lengths[idx])
+            for idx in bucket:
+                new_max_length = max(batch_max_length, self.lengths[idx])
+                over_budget = new_max_length * (len(batch) + 1) > self.max_tokens_per_batch
+                over_size = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+                if batch and (over_budget or over_size):
+                    batches.append(batch)
+                    batch, new_max_length = [], self.lengths[idx]
+                batch.append(idx)
+                batch_max_length = new_max_length
+        if batch and not self.drop_last:
+            batches.append(batch)
+        return batches
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[List[int]]:
+        order = list(range(len(self.batches)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        for i in order:
+            yield self.batches[i]
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def padding_report(self, batch_size: int) -> dict:
+        """
+        对比固定批次大小与 token 预算批次的填充比例.
+        Compare the padding ratio of fixed size batches against the token budget batches.
+        """
+        fixed_batches = fixed_size_batches(len(self.lengths), batch_size, seed=self.seed)
+        real_tokens = sum(self.lengths)
+        return {
+            "num_samples": len(self.lengths),
+            "real_tokens": real_tokens,
+            "fixed_num_batches": len(fixed_batches),
+            "fixed_padding_ratio": compute_padding_ratio(self.lengths, fixed_batches),
+            "bucketed_num_batches": len(self.batches),
+            "bucketed_padding_ratio": compute_padding_ratio(self.lengths, self.batches),
+            "bucketed_mean_batch_size": len(self.lengths) / max(len(self.batches), 1),
+            "bucketed_mean_tokens_per_batch": real_tokens / max(len(self.batches), 1),
+            "budget_utilization": real_tokens / max(len(self.batches) * self.max_tokens_per_batch, 1),
+        }
+
+
+class DataCollatorForAssistantOnlyLM:
+    """
+    将预分词的样本填充为批次, 只在助手回复的 token 上计算损失.
+    Pad pre-tokenized samples into a batch and only train on the tokens of the assistant replies.
+
+    每个样本需要包含 `input_ids` 与同样长度的 `assistant_masks`, 标签在非助手位置与填充位置上为 -100.
+    Every sample needs `input_ids` and `assistant_masks` of the same length, labels are -100 outside the
+    assistant replies and on padding.
+
+    Args:
+        pad_token_id (`int`):
+            Token id used to pad `input_ids`.
+        pad_to_multiple_of (`int`, *optional*):
+            Pad the sequence length to a multiple of this value.
+        ignore_index (`int`, *optional*, defaults to -100):
+            Label value ignored by the loss.
+    """
+
+    def __init__(self, pad_token_id: int, pad_to_multiple_of: Optional[int] = None, ignore_index: int = -100):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.ignore_index = ignore_index
+
+    def __call__(self, features: List[Dict[str, Sequence[int]]]) -> Dict[str, torch.Tensor]:
+        max_length = max(len(feature["input_ids"]) for feature in features)
+        if self.pad_to_multiple_of is not None:
+            max_length = (max_length + self.pad_to_multiple_of - 1) // self.pad_to_multiple_of * self.pad_to_multiple_of
+
+        input_ids = torch.full((len(features), max_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(features), max_length), dtype=torch.long)
+        labels = torch.full((len(features), max_length), self.ignore_index, dtype=torch.long)
+        for i, feature in enumerate(features):
+            ids = torch.as_tensor(feature["input_ids"], dtype=torch.long)
+            mask = torch.as_tensor(feature["assistant_masks"], dtype=torch.bool)
+            length = ids.shape[0]
+            input_ids[i, :length] = ids
+            attention_mask[i, :length] = 1
+            labels[i, :length] = ids.masked_fill(~mask, self.ignore_index)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "labels": labels,
+        }
@@ -1,15 +1,62 @@
 from transformers import AutoTokenizer
-from datasets import load_from_disk
+from datasets import load_from_disk, Features, Sequence, Value
 from argparse import ArgumentParser
 
 
-def process_smoltalk(example, tokenizer):
-    messages = example['messages']
-    example['text'] = tokenizer.apply_chat_template(
-        messages,
-        tokenize=False,
-    )
-    return example
+def assistant_char_spans(text, messages, eos_token):
+    # 在渲染后的文本中按顺序定位每条助手回复, 包括模板追加的结束符
+    # Locate every assistant reply in the rendered text in order, including the eos token appended by the template
+    spans = []
+    cursor = 0
+    for message in messages:
+        if message['role'] != 'assistant':
+            continue
+        content = message['content'].strip()
+        start = text.find(content, cursor)
+        if start == -1:
+            continue
+        end = start + len(content)
+        if text.startswith(eos_token, end):
+            end += len(eos_token)
+        spans.append((start, end))
+        cursor = end
+    return spans
+
+
+def process_smoltalk(examples, tokenizer, max_length):
+    input_ids, assistant_masks, lengths = [], [], []
+    for messages in examples['messages']:
+        text = tokenizer.apply_chat_template(
+            messages,
+            tokenize=False,
+        )
+        # 模板已经包含了 bos_token, 因此不再添加特殊符号
+        # The template already contains the bos_token, so no special tokens are added
+        encoding = tokenizer(
+            text,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+        )
+        spans = assistant_char_spans(text, messages, tokenizer.eos_token)
+        # 与助手回复有重叠的 token 都计入损失, 这样带前导空格的首个 token 也会被包含
+        # Tokens overlapping an assistant reply are trained on, so the first token carrying a leading space is included
+        mask = [
+            int(any(token_start < end and token_end > start for start, end in spans))
+            for token_start, token_end in encoding['offset_mapping']
+        ]
+        ids = encoding['input_ids']
+        # 与训练时的 truncation_side='left' 保持一致, 保留最后的 max_length 个 token
+        # Consistent with truncation_side='left' at training time, keep the last max_length tokens
+        if len(ids) > max_length:
+            ids, mask = ids[-max_length:], mask[-max_length:]
+        input_ids.append(ids)
+        assistant_masks.append(mask)
+        lengths.append(len(ids))
+    return {
+        'input_ids': input_ids,
+        'assistant_masks': assistant_masks,
+        'length': lengths,
+    }
 
 def main(args):
     dataset = load_from_disk(args.datasets_dir + '/smoltalk')
@@ -17,16 +64,35 @@ def main(args):
     # Keep the column names of the original dataset for later removal of redundant columns
     columns = dataset['train'].column_names
     tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    if not tokenizer.is_fast:
+        raise ValueError("A fast tokenizer is required to compute the assistant masks from the offset mapping.")
 
+    # 使用紧凑的整数类型保存, 数据集以 Arrow 格式落盘, load_from_disk 时会被内存映射
+    # Saved with compact integer types, the dataset is stored as Arrow and memory-mapped by load_from_disk
+    features = Features({
+        'input_ids': Sequence(Value('int32')),
+        'assistant_masks': Sequence(Value('int8')),
+        'length': Value('int32'),
+    })
     dataset = dataset.map(
-        process_smoltalk, 
+        process_smoltalk,
         fn_kwargs={
-            'tokenizer': tokenizer
+            'tokenizer': tokenizer,
+            'max_length': args.max_length,
         },
         num_proc=args.num_proc,
         remove_columns=columns,
+        features=features,
         batched=True,
-        desc="Applying chat template"
+        desc="Tokenizing and masking assistant turns"
+    )
+    # 没有任何助手 token 的样本不会产生损失, 直接丢弃
+    # Samples without any assistant token produce no loss, drop them
+    dataset = dataset.filter(
+        lambda examples: [sum(mask) > 0 for mask in examples['assistant_masks']],
+        batched=True,
+        num_proc=args.num_proc,
+        desc="Dropping samples without assistant tokens"
     )
     print(dataset)
     dataset.save_to_disk(args.save_dir + '/finetune_dataset')
@@ -36,6 +102,7 @@ if __name__ == '__main__':
     argparser.add_argument("--datasets_dir", type=str, default="./datasets")
     argparser.add_argument("--save_dir", type=str, default="./datasets")
     argparser.add_argument("--tokenizer_path", type=str, default="./examples/tokenizer")
+    argparser.add_argument("--max_length", type=int, default=8192, help="should match max_seq_length of the finetune config")
     argparser.add_argument("--num_proc", type=int, default=8)
     args = argparser.parse_args()
 
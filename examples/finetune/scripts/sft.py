@@ -6,15 +6,65 @@ from argparse import ArgumentParser
 import yaml
 import datasets
 import transformers
+from torch.utils.data import DataLoader
 from transformers import AutoTokenizer, AutoConfig, AutoModel, AutoModelForCausalLM
 from trl import SFTConfig, SFTTrainer
 
 from wonderful_matrices.models import DogeConfig
 from wonderful_matrices.models import DogeModel, DogeForCausalLM
+from wonderful_matrices.loading import load_lazy_model
+
+from data_utils import DataCollatorForAssistantOnlyLM, TokenBudgetBatchSampler
 
 
 logger = logging.getLogger(__name__)
 
+
+class TokenBudgetSFTTrainer(SFTTrainer):
+    """
+    使用按长度分桶的 token 预算批次进行训练的 SFTTrainer.
+    SFTTrainer that trains on length bucketed batches filled up to a token budget.
+    """
+
+    def __init__(self, *args, max_tokens_per_batch: int, bucket_width: int = 64, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 长度来自已经截断的 input_ids, 所以左截断仍然由分词器负责
+        # Lengths come from the already truncated input_ids, so left truncation is still handled by the tokenizer
+        max_seq_length = self.args.max_seq_length
+        if "length" in self.train_dataset.column_names:
+            lengths = [min(length, max_seq_length) for length in self.train_dataset["length"]]
+        else:
+            lengths = self.train_dataset.map(
+                lambda batch: {"length": [min(len(ids), max_seq_length) for ids in batch["input_ids"]]},
+                batched=True,
+                remove_columns=self.train_dataset.column_names,
+                desc="Computing sample lengths",
+            )["length"]
+        self.batch_sampler = TokenBudgetBatchSampler(
+            lengths,
+            max_tokens_per_batch=max_tokens_per_batch,
+            bucket_width=bucket_width,
+            seed=self.args.seed,
+        )
+        report = self.batch_sampler.padding_report(self.args.per_device_train_batch_size)
+        logger.info(
+            f"Padding ratio: {report['fixed_padding_ratio']:.2%} with {report['fixed_num_batches']} fixed size batches "
+            f"-> {report['bucketed_padding_ratio']:.2%} with {report['bucketed_num_batches']} token budget batches "
+            f"(mean batch size {report['bucketed_mean_batch_size']:.2f}, budget utilization {report['budget_utilization']:.2%})."
+        )
+
+    def get_train_dataloader(self) -> DataLoader:
+        train_dataset = self._remove_unused_columns(self.train_dataset, description="training")
+        dataloader = DataLoader(
+            train_dataset,
+            batch_sampler=self.batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=self.args.dataloader_persistent_workers,
+        )
+        return self.accelerator.prepare(dataloader)
+
 def main(args):
 
     # 获取配置中的超参数
@@ -73,12 +123,24 @@ def main(args):
     # Load pretrained model
     ################################
     logger.info(f"Loading model from {args.pretrained_model_name_or_path}")
-    model = AutoModelForCausalLM.from_pretrained(args.pretrained_model_name_or_path, trust_remote_code=True)
+    if args.lazy_load:
+        # 权重是内存映射的 safetensors 文件的零拷贝视图, 只有被访问的页面才会从磁盘读取
+        # The weights are zero-copy views of the memory-mapped safetensors files, only the pages touched are read from disk
+        model = load_lazy_model(DogeForCausalLM, args.pretrained_model_name_or_path, lazy=False)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(args.pretrained_model_name_or_path, trust_remote_code=True)
 
     num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
     logger.info(f"Model structure: {model}")
     logger.info(f"Model parameters: {num_params}")
 
+    # 预处理阶段已经完成分词与助手掩码, 训练时不再分词, 非助手 token 不计算损失
+    # Tokenization and assistant masks are done during preprocessing, no tokenization happens while training and non assistant tokens carry no loss
+    pretokenized = 'input_ids' in dataset['train'].column_names
+    if pretokenized and hyperparameters['finetuning_args']['packing']:
+        raise ValueError("Pre-tokenized datasets are not packed, set `packing: False` in the config.")
+    data_collator = DataCollatorForAssistantOnlyLM(pad_token_id=tokenizer.pad_token_id) if pretokenized else None
+
     ################################
     # 设置监督微调参数
     # Setup supervised finetuning arguments
@@ -130,19 +192,36 @@ def main(args):
         dataset_num_proc=hyperparameters['finetuning_args']['dataset_num_proc'],
         max_seq_length=hyperparameters['finetuning_args']['max_seq_length'],
         packing=hyperparameters['finetuning_args']['packing'],
+        dataset_kwargs={'skip_prepare_dataset': pretokenized},
+        # 保留 assistant_masks 列, 由数据整理器转换为标签
+        # Keep the assistant_masks column, it is turned into labels by the data collator
+        remove_unused_columns=not pretokenized,
     )
 
     ################################
     # 初始化训练器
     # Initialize the trainer
     ################################
-    trainer = SFTTrainer(
+    trainer_kwargs = dict(
         model=model,
         args=sft_config,
         train_dataset=dataset['train'],
         eval_dataset=dataset['test'] if hyperparameters['finetuning_args']['do_eval'] else None,
         processing_class=tokenizer,
+        data_collator=data_collator,
     )
+    if hyperparameters['finetuning_args'].get('token_budget_batching', False):
+        # 按 token 预算组批时每个批次的样本数是可变的, 打包会让所有样本等长, 因此两者不能同时使用
+        # With token budget batching the number of samples per batch varies, packing makes every sample the same length, so the two cannot be combined
+        if sft_config.packing:
+            raise ValueError("`token_budget_batching` requires `packing: False`.")
+        trainer = TokenBudgetSFTTrainer(
+            max_tokens_per_batch=hyperparameters['finetuning_args']['max_tokens_per_batch'],
+            bucket_width=hyperparameters['finetuning_args'].get('bucket_width', 64),
+            **trainer_kwargs,
+        )
+    else:
+        trainer = SFTTrainer(**trainer_kwargs)
 
     ################################
     # 训练循环
@@ -210,6 +289,7 @@ if __name__ == "__main__":
     arg_parser.add_argument('--logging_dir', type=str, default='./logs')
     arg_parser.add_argument('--output_dir', type=str, default='./results')
     arg_parser.add_argument("--resume_from_checkpoint", type=str, default=None, help="path to checkpoint to resume training")
+    arg_parser.add_argument("--lazy_load", action="store_true", help="load the pretrained model from memory-mapped safetensors files")
 
     args = arg_parser.parse_args()
 
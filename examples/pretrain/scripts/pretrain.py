@@ -10,6 +10,7 @@ from transformers import AutoTokenizer, AutoConfig, AutoModel, AutoModelForCausa
 
 from wonderful_matrices.models.configuration_doge import DogeConfig
 from wonderful_matrices.models.modeling_doge import DogeModel, DogeForCausalLM
+from wonderful_matrices.loading import load_lazy_model
 
 
 logger = logging.getLogger(__name__)
@@ -194,7 +195,10 @@ def main(args):
     DogeModel.register_for_auto_class("AutoModel")
     DogeForCausalLM.register_for_auto_class("AutoModelForCausalLM")
     tokenizer = AutoTokenizer.from_pretrained(f'{output_dir}')
-    model = AutoModelForCausalLM.from_pretrained(f'{output_dir}')
+    if args.lazy_load:
+        model = load_lazy_model(DogeForCausalLM, f'{output_dir}', lazy=False)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(f'{output_dir}')
     tokenizer.save_pretrained(f'{output_dir}-registered')
     model.save_pretrained(f'{output_dir}-registered')
     logger.info(f"Model registered and saved to {output_dir}-registered")
@@ -208,6 +212,7 @@ if __name__ == '__main__':
     arg_parser.add_argument('--output_dir', type=str, default='./results')
     arg_parser.add_argument('--tokenizer_path', type=str, default='./examples/tokenizer', help='path to tokenizer')
     arg_parser.add_argument("--resume_from_checkpoint", type=str, default=None, help="path to checkpoint to resume training")
+    arg_parser.add_argument("--lazy_load", action="store_true", help="reload the trained model from memory-mapped safetensors files")
 
     args = arg_parser.parse_args()
 
@@ -31,43 +31,64 @@ try:
 except OptionalDependencyNotAvailable:
     pass
 else:
-    _import_structure["configuration_cheems"] = [
-        "CheemsConfig"
+    _import_structure["models.configuration_cheems"] = [
+        "CheemsConfig",
     ]
-    _import_structure["configuration_doge"] = [
-        "DogeConfig"
+    _import_structure["models.configuration_doge"] = [
+        "DogeConfig",
     ]
-    _import_structure["modeling_doge"] = [
+    _import_structure["models.modeling_doge"] = [
+        "DogeDynamicCache",
         "DogeForCausalLM",
         "DogeForSequenceClassification",
         "DogeModel",
         "DogePreTrainedModel",
+        "DogeSlidingWindowCache",
     ]
-    _import_structure["modeling_cheems"] = [
+    _import_structure["models.modeling_cheems"] = [
         "CheemsForCausalLM",
         "CheemsForSequenceClassification",
         "CheemsModel",
         "CheemsPreTrainedModel",
     ]
-    _import_structure["ssd"] = [
+    _import_structure["modules.ssd"] = [
         "SSD",
     ]
-    _import_structure["dmattn"] = [
+    _import_structure["modules.dmattn"] = [
         "DMAttn",
     ]
-    _import_structure["cdmoe"] = [
+    _import_structure["modules.cdmoe"] = [
         "CDMoE",
     ]
-    _import_structure["peer"] = [
+    _import_structure["modules.peer"] = [
         "PEER",
     ]
-    _import_structure["seimoe"] = [
+    _import_structure["modules.seimoe"] = [
         "SEIMoE",
     ]
-    _import_structure["mlp"] = [
+    _import_structure["modules.mlp"] = [
         "MLP",
         "GatedMLP",
     ]
+    _import_structure["generation.speculative"] = [
+        "SpeculativeDecodingOutput",
+        "speculative_generate",
+    ]
+    _import_structure["adapters.multi_lora"] = [
+        "MultiLoRALinear",
+        "adapter_batch",
+        "inject_multi_lora",
+        "load_lora_adapter",
+    ]
+    _import_structure["export.export_doge"] = [
+        "check_onnx_parity",
+        "export_doge_onnx",
+        "export_doge_torchscript",
+    ]
+    _import_structure["loading.lazy_loading"] = [
+        "load_lazy_model",
+        "materialize_lazy_layers",
+    ]
 
 
 if TYPE_CHECKING:
@@ -81,10 +102,12 @@ if TYPE_CHECKING:
         from .models.configuration_cheems import CheemsConfig
         from .models.configuration_doge import DogeConfig
         from .models.modeling_doge import (
+            DogeDynamicCache,
             DogeForCausalLM,
             DogeForSequenceClassification,
             DogeModel,
             DogePreTrainedModel,
+            DogeSlidingWindowCache,
         )
         from .models.modeling_cheems import (
             CheemsForCausalLM,
@@ -98,6 +121,10 @@ if TYPE_CHECKING:
         from .modules.peer import PEER
         from .modules.seimoe import SEIMoE
         from .modules.mlp import MLP, GatedMLP
+        from .generation.speculative import SpeculativeDecodingOutput, speculative_generate
+        from .adapters.multi_lora import MultiLoRALinear, adapter_batch, inject_multi_lora, load_lora_adapter
+        from .export.export_doge import check_onnx_parity, export_doge_onnx, export_doge_torchscript
+        from .loading.lazy_loading import load_lazy_model, materialize_lazy_layers
 
 
 else:
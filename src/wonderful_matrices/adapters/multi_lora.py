@@ -0,0 +1,283 @@
+# coding=utf-8
+# Copyright 2024 Jingze Shi. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Serving many LoRA adapters on one set of base weights, with the adapter selected per row of the batch."""
+
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Sequence, Union
+
+import torch
+from torch import nn
+
+
+# sub-projections packed into a single linear layer of the Doge modules, with their slice index
+PACKED_PROJECTIONS = {
+    "q_proj": ("qkv_proj", 0),
+    "k_proj": ("qkv_proj", 1),
+    "v_proj": ("qkv_proj", 2),
+    "gate_proj": ("gate_up_proj", 0),
+    "up_proj": ("gate_up_proj", 1),
+}
+NUM_PACKED_SLICES = {
+    "qkv_proj": 3,
+    "gate_up_proj": 2,
+}
+DEFAULT_TARGET_MODULES = ("qkv_proj", "o_proj", "gate_up_proj", "down_proj")
+
+
+class MultiLoRALinear(nn.Module):
+    """
+    A linear layer shared by up to `num_adapters` LoRA adapters, each row of the batch using its own adapter.
+
+    The low-rank weights of all the adapters are stacked, and the weights of the adapter of every row are gathered by
+    `adapter_ids` so that a whole mixed batch is computed with two batched matmuls on top of the base layer. Slot 0
+    is reserved for "no adapter" and stays zero. Packed projections such as `qkv_proj` are split into `num_slices`
+    equal output slices, each with its own low-rank pair, so adapters trained on the separate `q_proj`, `k_proj`
+    and `v_proj` keep a block diagonal update.
+
+    Args:
+        base_layer (`nn.Linear`):
+            The frozen base projection.
+        num_adapters (`int`):
+            Number of adapter slots, slot 0 included.
+        rank (`int`):
+            Maximum LoRA rank, adapters with a smaller rank are zero padded.
+        num_slices (`int`, *optional*, defaults to 1):
+            Number of equal output slices of a packed projection.
+    """
+
+    def __init__(self, base_layer: nn.Linear, num_adapters: int, rank: int, num_slices: int = 1):
+        super().__init__()
+        if base_layer.out_features % num_slices != 0:
+            raise ValueError(
+                f"The output features ({base_layer.out_features}) must be divisible by the number of slices ({num_slices})."
+            )
+        self.base_layer = base_layer
+        self.num_adapters = num_adapters
+        self.rank = rank
+        self.num_slices = num_slices
+        self.slice_features = base_layer.out_features // num_slices
+
+        weight = base_layer.weight
+        self.register_buffer(
+            "lora_A",
+            torch.zeros(num_adapters, num_slices, rank, base_layer.in_features, device=weight.device, dtype=weight.dtype),
+        )
+        self.register_buffer(
+            "lora_B",
+            torch.zeros(num_adapters, num_slices, self.slice_features, rank, device=weight.device, dtype=weight.dtype),
+        )
+        self.register_buffer("scaling", torch.zeros(num_adapters, device=weight.device, dtype=weight.dtype))
+        # adapter slot of every row of the current batch, `None` runs the base layer only
+        self.adapter_ids: Optional[torch.LongTensor] = None
+
+    def set_adapter_slice(
+        self,
+        slot: int,
+        slice_idx: int,
+        lora_A: torch.Tensor,
+        lora_B: torch.Tensor,
+        scaling: float,
+    ):
+        """
+        Write the low-rank pair `lora_A` of shape `(r, in_features)` and `lora_B` of shape `(slice_features, r)` of
+        an adapter into `slot`, or `lora_B` of shape `(out_features, r)` for all the slices at once.
+        """
+        if slot == 0:
+            raise ValueError("Slot 0 is reserved for requests without adapter.")
+        rank = lora_A.shape[0]
+        if rank > self.rank:
+            raise ValueError(f"The adapter rank ({rank}) is larger than the maximum rank ({self.rank}).")
+        lora_B = lora_B.reshape(-1, self.slice_features, rank)
+        for i in range(lora_B.shape[0]):
+            self.lora_A[slot, slice_idx + i].zero_()
+            self.lora_B[slot, slice_idx + i].zero_()
+            self.lora_A[slot, slice_idx + i, :rank] = lora_A.to(self.lora_A.dtype)
+            self.lora_B[slot, slice_idx + i, :, :rank] = lora_B[i].to(self.lora_B.dtype)
+        self.scaling[slot] = scaling
+
+    def clear_adapter(self, slot: int):
+        """Reset `slot`, so that it can be reused by another adapter."""
+        self.lora_A[slot].zero_()
+        self.lora_B[slot].zero_()
+        self.scaling[slot] = 0.0
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        output = self.base_layer(hidden_states)
+        if self.adapter_ids is None:
+            return output
+
+        adapter_ids = self.adapter_ids
+        batch_size = hidden_states.shape[0]
+        if batch_size != adapter_ids.shape[0]:
+            # `generate` repeats every row `num_beams * num_return_sequences` times next to each other
+            if batch_size % adapter_ids.shape[0] != 0:
+                raise ValueError(
+                    f"The batch size ({batch_size}) is not a multiple of the number of adapter ids "
+                    f"({adapter_ids.shape[0]}), give one adapter id per row of the batch."
+                )
+            adapter_ids = adapter_ids.repeat_interleave(batch_size // adapter_ids.shape[0])
+
+        # gather the low-rank weights of the adapter of every row
+        lora_A = self.lora_A[adapter_ids]
+        lora_B = self.lora_B[adapter_ids]
+        scaling = self.scaling[adapter_ids]
+
+        low_rank_states = torch.einsum("b t i, b s r i -> b t s r", hidden_states.to(lora_A.dtype), lora_A)
+        lora_states = torch.einsum("b t s r, b s o r -> b t s o", low_rank_states, lora_B)
+        lora_states = lora_states.reshape(*hidden_states.shape[:-1], -1) * scaling[:, None, None]
+        return output + lora_states.to(output.dtype)
+
+    def extra_repr(self):
+        return f"num_adapters={self.num_adapters}, rank={self.rank}, num_slices={self.num_slices}"
+
+
+def inject_multi_lora(
+    model: nn.Module,
+    num_adapters: int,
+    rank: int,
+    target_modules: Sequence[str] = DEFAULT_TARGET_MODULES,
+) -> nn.Module:
+    """
+    Replace in place the linear layers of `model` whose name is in `target_modules` with [`MultiLoRALinear`] sharing
+    their base weights, e.g. the attention `qkv_proj` and `o_proj` and the `gate_up_proj` and `down_proj` of the MLP
+    and of the CDMoE shared branch. The base weights are frozen. Load the base checkpoint before injecting.
+
+    Args:
+        model (`nn.Module`):
+            The model to serve the adapters with, e.g. a [`DogeForCausalLM`].
+        num_adapters (`int`):
+            Number of adapters that can be loaded at the same time.
+        rank (`int`):
+            Maximum LoRA rank of the adapters.
+        target_modules (`Sequence[str]`, *optional*, defaults to `("qkv_proj", "o_proj", "gate_up_proj", "down_proj")`):
+            Names of the linear layers to wrap.
+    """
+    for param in model.parameters():
+        param.requires_grad_(False)
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if child_name in target_modules and isinstance(child, nn.Linear):
+                multi_lora = MultiLoRALinear(
+                    child,
+                    num_adapters + 1,
+                    rank,
+                    num_slices=NUM_PACKED_SLICES.get(child_name, 1),
+                )
+                setattr(module, child_name, multi_lora)
+    return model
+
+
+def _peft_module_name(key: str) -> str:
+    module_name = key.rsplit(".lora_", 1)[0]
+    if module_name.startswith("base_model.model."):
+        module_name = module_name[len("base_model.model.") :]
+    return module_name
+
+
+def load_lora_adapter(
+    model: nn.Module,
+    adapter: Union[str, os.PathLike, Dict[str, torch.Tensor]],
+    slot: int,
+    lora_alpha: Optional[float] = None,
+) -> nn.Module:
+    """
+    Load a LoRA adapter saved by PEFT into `slot` of the [`MultiLoRALinear`] layers of `model`.
+
+    Adapters on the separate `q_proj`, `k_proj`, `v_proj`, `gate_proj` and `up_proj` go to their slice of the packed
+    `qkv_proj` and `gate_up_proj`, adapters trained on the packed projections are split over their slices.
+
+    Args:
+        model (`nn.Module`):
+            A model prepared by [`inject_multi_lora`].
+        adapter (`str`, `os.PathLike` or `Dict[str, torch.Tensor]`):
+            A directory containing `adapter_model.safetensors` (or `adapter_model.bin`) and `adapter_config.json`,
+            or the adapter state dict.
+        slot (`int`):
+            Adapter slot, from 1 to the `num_adapters` given to [`inject_multi_lora`].
+        lora_alpha (`float`, *optional*):
+            LoRA alpha, read from `adapter_config.json` when `adapter` is a directory.
+    """
+    if not isinstance(adapter, dict):
+        with open(os.path.join(adapter, "adapter_config.json"), "r", encoding="utf-8") as f:
+            adapter_config = json.load(f)
+        lora_alpha = lora_alpha if lora_alpha is not None else adapter_config["lora_alpha"]
+        safetensors_path = os.path.join(adapter, "adapter_model.safetensors")
+        if os.path.exists(safetensors_path):
+            from safetensors.torch import load_file
+
+            adapter = load_file(safetensors_path)
+        else:
+            adapter = torch.load(os.path.join(adapter, "adapter_model.bin"), map_location="cpu", weights_only=True)
+    if lora_alpha is None:
+        raise ValueError("`lora_alpha` must be given when the adapter is passed as a state dict.")
+
+    modules = dict(model.named_modules())
+    # layers the adapter does not cover must not keep the weights of the previous adapter of the slot
+    for module in modules.values():
+        if isinstance(module, MultiLoRALinear):
+            module.clear_adapter(slot)
+    for key, lora_A in adapter.items():
+        if ".lora_A." not in key:
+            continue
+        lora_B = adapter[key.replace(".lora_A.", ".lora_B.")]
+        module_name = _peft_module_name(key)
+        parent_name, _, child_name = module_name.rpartition(".")
+        slice_idx = 0
+        if child_name in PACKED_PROJECTIONS:
+            child_name, slice_idx = PACKED_PROJECTIONS[child_name]
+        target_name = f"{parent_name}.{child_name}" if parent_name else child_name
+        # adapters saved from the base model name it `model.`, adapters saved from a wrapper may not
+        if target_name not in modules and f"model.{target_name}" in modules:
+            target_name = f"model.{target_name}"
+        module = modules.get(target_name)
+        if not isinstance(module, MultiLoRALinear):
+            raise ValueError(f"{module_name} of the adapter has no matching `MultiLoRALinear` in the model.")
+        if lora_B.shape[0] == module.base_layer.out_features:
+            # trained on the packed projection, the update of every slice shares `lora_A`
+            slice_idx = 0
+        module.set_adapter_slice(slot, slice_idx, lora_A, lora_B, lora_alpha / lora_A.shape[0])
+    return model
+
+
+@contextmanager
+def adapter_batch(model: nn.Module, adapter_ids: Union[torch.LongTensor, Sequence[int]]) -> Iterator[nn.Module]:
+    """
+    Select the adapter slot of every row of the batch for the forward passes inside the context, 0 for the base model.
+
+    When the model runs on a batch expanded by `generate`, e.g. with `num_beams` or `num_return_sequences` larger
+    than 1, every adapter id is repeated for the consecutive rows of its request.
+
+    Example:
+
+    ```python
+    >>> inject_multi_lora(model, num_adapters=8, rank=16)
+    >>> load_lora_adapter(model, "./adapters/math", slot=1)
+    >>> load_lora_adapter(model, "./adapters/code", slot=2)
+    >>> with adapter_batch(model, [1, 2, 0]):
+    ...     outputs = model.generate(**inputs, num_beams=4)
+    ```
+    """
+    device = next(model.parameters()).device
+    adapter_ids = torch.as_tensor(adapter_ids, dtype=torch.long, device=device)
+    lora_modules = [module for module in model.modules() if isinstance(module, MultiLoRALinear)]
+    for module in lora_modules:
+        module.adapter_ids = adapter_ids
+    try:
+        yield model
+    finally:
+        for module in lora_modules:
+            module.adapter_ids = None
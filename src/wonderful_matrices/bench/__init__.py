@@ -0,0 +1,73 @@
+# coding=utf-8
+# Copyright 2024 Jingze Shi. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import TYPE_CHECKING
+
+from transformers.utils import (
+    OptionalDependencyNotAvailable,
+    _LazyModule,
+    is_torch_available,
+)
+
+
+_import_structure = {
+}
+
+
+try:
+    if not is_torch_available():
+        raise OptionalDependencyNotAvailable()
+except OptionalDependencyNotAvailable:
+    pass
+else:
+    _import_structure["generation"] = [
+        "GenerationBenchmarkResult",
+        "benchmark_generation",
+        "load_benchmark_model",
+    ]
+    _import_structure["modules"] = [
+        "MODULES",
+        "ModuleBenchmarkResult",
+        "benchmark_module",
+    ]
+    _import_structure["profiler"] = [
+        "DogeProfiler",
+    ]
+    _import_structure["utils"] = [
+        "compare_results",
+        "count_allocations",
+        "peak_rss_mb",
+        "reset_peak_rss",
+        "write_results",
+    ]
+
+
+if TYPE_CHECKING:
+
+    try:
+        if not is_torch_available():
+            raise OptionalDependencyNotAvailable()
+    except OptionalDependencyNotAvailable:
+        pass
+    else:
+        from .generation import GenerationBenchmarkResult, benchmark_generation, load_benchmark_model
+        from .modules import MODULES, ModuleBenchmarkResult, benchmark_module
+        from .profiler import DogeProfiler
+        from .utils import compare_results, count_allocations, peak_rss_mb, reset_peak_rss, write_results
+
+
+else:
+    import sys
+
+    sys.modules[__name__] = _LazyModule(__name__, globals()["__file__"], _import_structure, module_spec=__spec__)
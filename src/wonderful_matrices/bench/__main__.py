@@ -0,0 +1,38 @@
+# coding=utf-8
+# Copyright 2024 Jingze Shi. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+`python -m wonderful_matrices.bench <benchmark> [args]`, with `<benchmark>` one of `generation` or `modules`.
+"""
+
+import sys
+
+
+BENCHMARKS = ("generation", "modules")
+
+
+def main() -> int:
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"usage: python -m wonderful_matrices.bench {{{','.join(BENCHMARKS)}}} [args]", file=sys.stderr)
+        return 2
+    benchmark, argv = sys.argv[1], sys.argv[2:]
+    if benchmark == "generation":
+        from .generation import main as benchmark_main
+    else:
+        from .modules import main as benchmark_main
+    return benchmark_main(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+# coding=utf-8
+# Copyright 2024 Jingze Shi. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+End-to-end CPU generation benchmark of Doge configs and checkpoints. Cheems checkpoints are rejected up front, the
+`mamba_ssm` kernels of their SSD layers need a CUDA device.
+
+For every batch size and prompt length the runner measures the time to first token, the inter-token latency
+percentiles of greedy decoding, the prefill and decode throughput, and the memory per sequence, and writes them to
+JSON. `--compare` and the latency budgets exit with an error, so a deployment can be gated on the results:
+
+```bash
+python -m wonderful_matrices.bench generation --model_path JingzeShi/Doge-20M --output results/doge-20m.json
+python -m wonderful_matrices.bench generation --model_path ./configs/doge_320m.json --batch_sizes 1 4 16
+python -m wonderful_matrices.bench generation --model_path JingzeShi/Doge-20M --compare results/doge-20m.json
+```
+"""
+
+import itertools
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import torch
+from transformers import PretrainedConfig, PreTrainedModel
+from transformers.cache_utils import Cache
+from transformers.utils.import_utils import is_mamba_2_ssm_available
+
+from .utils import compare_results, current_rss_mb, peak_rss_mb, percentile, reset_peak_rss, write_results
+
+
+KEY_FIELDS = ("batch_size", "prompt_len", "max_new_tokens")
+
+
+@dataclass
+class GenerationBenchmarkResult:
+    batch_size: int
+    prompt_len: int
+    max_new_tokens: int
+    ttft_ms: float
+    itl_p50_ms: float
+    itl_p90_ms: float
+    itl_p99_ms: float
+    prefill_tokens_per_s: float
+    decode_tokens_per_s: float
+    cache_mb_per_seq: float
+    peak_rss_mb_per_seq: float
+
+
+def _model_family(config_dict: Dict[str, Any]) -> str:
+    # Cheems configs share the `doge` model type, they are told apart by their architecture or their ssd layers
+    architectures = config_dict.get("architectures") or []
+    if any(architecture.startswith("Cheems") for architecture in architectures) or "attn_layer_period" in config_dict:
+        return "cheems"
+    return "doge"
+
+
+def _model_classes(model_family: str) -> Tuple[type, type]:
+    if model_family == "doge":
+        from ..models.configuration_doge import DogeConfig
+        from ..models.modeling_doge import DogeForCausalLM
+
+        return DogeConfig, DogeForCausalLM
+    if model_family == "cheems":
+        from ..models.configuration_cheems import CheemsConfig
+        from ..models.modeling_cheems import CheemsForCausalLM
+
+        return CheemsConfig, CheemsForCausalLM
+    raise ValueError(f"Unsupported model {model_family}, expected `doge` or `cheems`.")
+
+
+def load_benchmark_model(
+    model_path: str,
+    random_init: bool = False,
+    torch_dtype: torch.dtype = torch.float32,
+    model_family: Optional[str] = None,
+    device: Union[str, torch.device] = "cpu",
+) -> PreTrainedModel:
+    """
+    Load a Doge or Cheems causal language model for benchmarking.
+
+    Args:
+        model_path (`str`):
+            A checkpoint directory, a Hub repository id, or a `config.json` file to build a randomly initialized model.
+        random_init (`bool`, *optional*, defaults to `False`):
+            Only read the config of the checkpoint and initialize the weights randomly. The latency does not depend
+            on the values of the weights, so the config is enough to benchmark an unreleased size.
+        torch_dtype (`torch.dtype`, *optional*, defaults to `torch.float32`):
+            Dtype of the weights.
+        model_family (`str`, *optional*):
+            `doge` or `cheems`, inferred from the `architectures` of the config by default.
+        device (`str` or `torch.device`, *optional*, defaults to `"cpu"`):
+            Device to run the model on. Cheems needs a CUDA device.
+
+    Raises:
+        `ValueError`: if the model is a Cheems model and `device` is not a CUDA device or `mamba_ssm` is missing, the
+        SSD layers only run with the `mamba_ssm` Triton kernels.
+    """
+    if os.path.isfile(model_path):
+        random_init = True
+    config_dict, _ = PretrainedConfig.get_config_dict(model_path)
+    model_family = model_family or _model_family(config_dict)
+    if model_family == "cheems" and (torch.device(device).type != "cuda" or not is_mamba_2_ssm_available()):
+        raise ValueError(
+            f"Cheems can not run on {device}: its SSD layers need the `mamba_ssm` Triton kernels and a CUDA device. "
+            "Install `mamba-ssm` and pass a CUDA device, the CPU benchmarks only support Doge."
+        )
+    config_class, model_class = _model_classes(model_family)
+    if random_init:
+        config = config_class.from_dict(config_dict)
+        model = model_class(config).to(torch_dtype)
+    else:
+        model = model_class.from_pretrained(model_path, torch_dtype=torch_dtype)
+    return model.to(device).eval()
+
+
+def new_cache(model: PreTrainedModel, batch_size: int) -> Cache:
+    """An empty cache of the type the model decodes with."""
+    from ..models.configuration_cheems import CheemsConfig
+
+    if isinstance(model.config, CheemsConfig):
+        from ..models.modeling_cheems import HybridSSDAttnDynamicCache
+
+        return HybridSSDAttnDynamicCache(
+            model.config, batch_size, dtype=model.dtype, device=model.device, layer_type=model.config.layers_type
+        )
+    from ..models.modeling_doge import DogeDynamicCache, DogeSlidingWindowCache
+
+    if model.config.sliding_window is not None:
+        return DogeSlidingWindowCache.from_config(model.config)
+    return DogeDynamicCache()
+
+
+def cache_nbytes(cache: Cache) -> int:
+    """Number of bytes held by the tensors of a cache, the key and value states as well as the dt or ssd states."""
+    nbytes = 0
+    for value in vars(cache).values():
+        if isinstance(value, torch.Tensor):
+            nbytes += value.numel() * value.element_size()
+        elif isinstance(value, (list, tuple)):
+            nbytes += sum(item.numel() * item.element_size() for item in value if isinstance(item, torch.Tensor))
+    return nbytes
+
+
+@torch.no_grad()
+def _generate_timed(
+    model: PreTrainedModel,
+    input_ids: torch.LongTensor,
+    max_new_tokens: int,
+) -> Tuple[float, List[float], Cache]:
+    """Greedy decoding returning the time to first token, the inter-token latencies and the final cache."""
+    past_key_values = new_cache(model, input_ids.shape[0])
+    start = time.perf_counter()
+    logits = model(
+        input_ids=input_ids, past_key_values=past_key_values, use_cache=True, num_logits_to_keep=1
+    ).logits
+    next_tokens = logits[:, -1].argmax(dim=-1, keepdim=True)
+    ttft = time.perf_counter() - start
+
+    inter_token_latencies = []
+    for _ in range(max_new_tokens - 1):
+        start = time.perf_counter()
+        logits = model(
+            input_ids=next_tokens, past_key_values=past_key_values, use_cache=True, num_logits_to_keep=1
+        ).logits
+        next_tokens = logits[:, -1].argmax(dim=-1, keepdim=True)
+        inter_token_latencies.append(time.perf_counter() - start)
+    return ttft, inter_token_latencies, past_key_values
+
+
+def benchmark_generation(
+    model: PreTrainedModel,
+    batch_size: int,
+    prompt_len: int,
+    max_new_tokens: int = 64,
+    warmup: int = 1,
+    repeats: int = 3,
+) -> GenerationBenchmarkResult:
+    """
+    Benchmark greedy generation of random prompts with a model on the device of its weights.
+
+    Args:
+        model (`PreTrainedModel`):
+            The causal language model, e.g. returned by [`load_benchmark_model`].
+        batch_size (`int`):
+            Number of sequences generated together.
+        prompt_len (`int`):
+            Number of tokens of every prompt.
+        max_new_tokens (`int`, *optional*, defaults to 64):
+            Number of tokens generated for every sequence, including the first one.
+        warmup (`int`, *optional*, defaults to 1):
+            Untimed generations before measuring.
+        repeats (`int`, *optional*, defaults to 3):
+            Timed generations, the time to first token is their median and the inter-token latencies are pooled.
+    """
+    input_ids = torch.randint(0, model.config.vocab_size, (batch_size, prompt_len), device=model.device)
+    for _ in range(warmup):
+        _generate_timed(model, input_ids, max_new_tokens)
+
+    baseline_rss = current_rss_mb()
+    peak_reset = reset_peak_rss()
+    ttfts, inter_token_latencies = [], []
+    for _ in range(repeats):
+        ttft, latencies, past_key_values = _generate_timed(model, input_ids, max_new_tokens)
+        ttfts.append(ttft)
+        inter_token_latencies.extend(latencies)
+    peak_rss = peak_rss_mb() - baseline_rss if peak_reset else float("nan")
+
+    ttft = percentile(ttfts, 50)
+    itl = percentile(inter_token_latencies, 50)
+    return GenerationBenchmarkResult(
+        batch_size=batch_size,
+        prompt_len=prompt_len,
+        max_new_tokens=max_new_tokens,
+        ttft_ms=ttft * 1e3,
+        itl_p50_ms=itl * 1e3,
+        itl_p90_ms=percentile(inter_token_latencies, 90) * 1e3,
+        itl_p99_ms=percentile(inter_token_latencies, 99) * 1e3,
+        prefill_tokens_per_s=batch_size * prompt_len / ttft,
+        decode_tokens_per_s=batch_size / itl if inter_token_latencies else float("nan"),
+        cache_mb_per_seq=cache_nbytes(past_key_values) / 2**20 / batch_size,
+        peak_rss_mb_per_seq=peak_rss / batch_size,
+    )
+
+
+def print_result(result: GenerationBenchmarkResult):
+    print(
+        f"{result.batch_size:>6}{result.prompt_len:>8}{result.ttft_ms:>12.1f}{result.itl_p50_ms:>10.2f}"
+        f"{result.itl_p90_ms:>10.2f}{result.itl_p99_ms:>10.2f}{result.prefill_tokens_per_s:>16.0f}"
+        f"{result.decode_tokens_per_s:>15.1f}{result.cache_mb_per_seq:>15.2f}{result.peak_rss_mb_per_seq:>13.1f}"
+    )
+
+
+def _check_budgets(results: List[Dict[str, Any]], args) -> List[str]:
+    failures = []
+    for result in results:
+        configuration = f"batch={result['batch_size']} prompt={result['prompt_len']}"
+        if args.max_ttft_ms is not None and result["ttft_ms"] > args.max_ttft_ms:
+            failures.append(f"{configuration}: time to first token {result['ttft_ms']:.1f} ms > {args.max_ttft_ms} ms")
+        if args.max_itl_p99_ms is not None and result["itl_p99_ms"] > args.max_itl_p99_ms:
+            failures.append(
+                f"{configuration}: p99 inter-token latency {result['itl_p99_ms']:.2f} ms > {args.max_itl_p99_ms} ms"
+            )
+    return failures
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    arg_parser = ArgumentParser(description="CPU generation benchmark of Doge")
+    arg_parser.add_argument("--model_path", type=str, required=True, help="checkpoint, Hub id or config.json")
+    arg_parser.add_argument("--model", type=str, default=None, choices=["doge", "cheems"], help="inferred by default")
+    arg_parser.add_argument("--random_init", action="store_true", help="only use the config of the checkpoint")
+    arg_parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 16])
+    arg_parser.add_argument("--prompt_lens", type=int, nargs="+", default=[128, 512, 2048])
+    arg_parser.add_argument("--max_new_tokens", type=int, default=64)
+    arg_parser.add_argument("--warmup", type=int, default=1)
+    arg_parser.add_argument("--repeats", type=int, default=3)
+    arg_parser.add_argument("--dtype", type=str, default="float32")
+    arg_parser.add_argument("--threads", type=int, default=None)
+    arg_parser.add_argument("--output", type=str, default=None, help="path of the JSON results")
+    arg_parser.add_argument("--compare", type=str, default=None, help="JSON results of a baseline run")
+    arg_parser.add_argument("--threshold", type=float, default=0.1, help="relative latency increase that fails")
+    arg_parser.add_argument("--max_ttft_ms", type=float, default=None, help="fail above this time to first token")
+    arg_parser.add_argument("--max_itl_p99_ms", type=float, default=None, help="fail above this p99 latency")
+    arg_parser.add_argument(
+        "--profile_trace", type=str, default=None, help="profile the first configuration to this Chrome trace"
+    )
+    args = arg_parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = load_benchmark_model(args.model_path, args.random_init, getattr(torch, args.dtype), args.model)
+
+    print(
+        f"{'batch':>6}{'prompt':>8}{'TTFT ms':>12}{'ITL p50':>10}{'ITL p90':>10}{'ITL p99':>10}"
+        f"{'prefill tok/s':>16}{'decode tok/s':>15}{'cache MB/seq':>15}{'RSS MB/seq':>13}"
+    )
+    results = []
+    for batch_size, prompt_len in itertools.product(args.batch_sizes, args.prompt_lens):
+        result = benchmark_generation(
+            model, batch_size, prompt_len, args.max_new_tokens, warmup=args.warmup, repeats=args.repeats
+        )
+        results.append(asdict(result))
+        print_result(result)
+
+    if args.output is not None:
+        write_results(
+            args.output,
+            results,
+            benchmark="generation",
+            model_path=args.model_path,
+            model=type(model).__name__,
+            num_params=model.num_parameters(),
+            dtype=args.dtype,
+        )
+
+    if args.profile_trace is not None:
+        from .profiler import DogeProfiler
+
+        input_ids = torch.randint(0, model.config.vocab_size, (args.batch_sizes[0], args.prompt_lens[0]))
+        with DogeProfiler(model) as profiler:
+            _generate_timed(model, input_ids, args.max_new_tokens)
+        print(profiler.table())
+        print(profiler.table(by_layer=True))
+        profiler.export_chrome_trace(args.profile_trace)
+
+    failures = _check_budgets(results, args)
+    if args.compare is not None:
+        for metric in ("ttft_ms", "itl_p50_ms"):
+            for regression in compare_results(args.compare, results, KEY_FIELDS, metric, threshold=args.threshold):
+                failures.append(
+                    f"batch={regression['batch_size']} prompt={regression['prompt_len']}: {metric} "
+                    f"{regression[f'baseline_{metric}']:.2f} -> {regression[metric]:.2f} (x{regression['ratio']:.2f})"
+                )
+    for failure in failures:
+        print(f"failed: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,350 @@
+# coding=utf-8
+# Copyright 2024 Jingze Shi. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+CPU microbenchmarks of the modules of `wonderful_matrices.modules`.
+
+Every module is swept over batch sizes, sequence lengths, hidden sizes and expert counts. The runner records the
+latency, the throughput, the FLOPs and arithmetic intensity, the peak RSS and the number of tensor allocations of
+the forward pass, and writes them to JSON so that runs of different commits can be compared. A configuration that
+fails is recorded with its `error` and the sweep goes on:
+
+```bash
+python -m wonderful_matrices.bench.modules --output results/modules.json
+python -m wonderful_matrices.bench.modules --modules CDMoE PEER --num_experts 1024 4096 --compare results/modules.json
+```
+"""
+
+import itertools
+import math
+import sys
+import time
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+from torch import nn
+
+from .utils import (
+    compare_results,
+    count_allocations,
+    current_rss_mb,
+    peak_rss_mb,
+    percentile,
+    reset_peak_rss,
+    write_results,
+)
+
+
+KEY_FIELDS = ("module", "batch_size", "seq_len", "hidden_size", "num_experts")
+
+
+@dataclass
+class ModuleBenchmarkResult:
+    module: str
+    batch_size: int
+    seq_len: int
+    hidden_size: int
+    num_experts: Optional[int]
+    num_params: int
+    latency_ms: float
+    latency_p90_ms: float
+    tokens_per_s: float
+    gflops: Optional[float]
+    gflops_per_s: Optional[float]
+    arithmetic_intensity: Optional[float]
+    peak_rss_mb: float
+    num_allocations: int
+    allocated_mb: float
+
+
+def _build_ssd(hidden_size: int, num_experts: Optional[int]) -> nn.Module:
+    from ..modules.ssd import SSD
+
+    return SSD(d_model=hidden_size, n_heads=max(hidden_size // 64, 1), d_state=64, n_groups=1, chunk_len=64)
+
+
+def _build_dmattn(hidden_size: int, num_experts: Optional[int]) -> nn.Module:
+    from ..modules.dmattn import DMAttn
+
+    return DMAttn(d_model=hidden_size, n_heads=max(hidden_size // 64, 1), max_position_embeddings=2048)
+
+
+def _check_square(name: str, num_experts: int):
+    if math.isqrt(num_experts) ** 2 != num_experts:
+        raise ValueError(f"{name} retrieves experts with product keys, `num_experts` must be a perfect square.")
+
+
+def _build_cdmoe(hidden_size: int, num_experts: Optional[int]) -> nn.Module:
+    from ..modules.cdmoe import CDMoE
+
+    _check_square("CDMoE", num_experts)
+    return CDMoE(
+        d_model=hidden_size,
+        act_fn="silu",
+        d_cd=hidden_size * 4,
+        d_expert_retrieval=256,
+        n_experts=num_experts,
+        n_experts_heads=1,
+        n_experts_per_head=math.isqrt(num_experts),
+    )
+
+
+def _build_peer(hidden_size: int, num_experts: Optional[int]) -> nn.Module:
+    from ..modules.peer import PEER
+
+    _check_square("PEER", num_experts)
+    return PEER(dim=hidden_size, heads=8, num_experts=num_experts, num_experts_per_head=16)
+
+
+def _build_seimoe(hidden_size: int, num_experts: Optional[int]) -> nn.Module:
+    from ..modules.seimoe import SEIMoE
+
+    return SEIMoE(d_model=hidden_size, act_fn="silu", d_ff=hidden_size * 4 // 2, n_experts=num_experts, n_experts_per_topk=2)
+
+
+def _build_mlp(hidden_size: int, num_experts: Optional[int]) -> nn.Module:
+    from ..modules.mlp import MLP
+
+    return MLP(d_model=hidden_size, act_fn="silu", d_ff=hidden_size * 4)
+
+
+def _build_gated_mlp(hidden_size: int, num_experts: Optional[int]) -> nn.Module:
+    from ..modules.mlp import GatedMLP
+
+    return GatedMLP(d_model=hidden_size, act_fn="silu", d_ff=hidden_size * 4)
+
+
+def _ssd_inputs(module: nn.Module, hidden_states: torch.Tensor) -> Dict[str, Any]:
+    # checked before the forward pass, which fails with a reshape error otherwise
+    seq_len = hidden_states.shape[1]
+    if seq_len % module.chunk_len != 0:
+        raise ValueError(f"SSD needs `seq_len` to be a multiple of `chunk_len` {module.chunk_len}, got {seq_len}.")
+    return {}
+
+
+def _dmattn_inputs(module: nn.Module, hidden_states: torch.Tensor) -> Dict[str, Any]:
+    bsz, seq_len, _ = hidden_states.shape
+    attention_mask = module.prepare_4d_causal_attention_mask_with_cache_position(
+        attention_mask=None,
+        sequence_length=seq_len,
+        target_length=seq_len,
+        dtype=hidden_states.dtype,
+        device=hidden_states.device,
+        cache_position=torch.arange(seq_len, device=hidden_states.device),
+        batch_size=bsz,
+    )
+    return {"attention_mask": attention_mask}
+
+
+# module name -> (constructor, extra forward inputs, whether the module has experts)
+MODULES: Dict[str, Tuple[Callable, Optional[Callable], bool]] = {
+    "SSD": (_build_ssd, _ssd_inputs, False),
+    "DMAttn": (_build_dmattn, _dmattn_inputs, False),
+    "CDMoE": (_build_cdmoe, None, True),
+    "PEER": (_build_peer, None, True),
+    "SEIMoE": (_build_seimoe, None, True),
+    "MLP": (_build_mlp, None, False),
+    "GatedMLP": (_build_gated_mlp, None, False),
+}
+
+
+def _count_flops(fn: Callable[[], Any]) -> Optional[float]:
+    try:
+        from torch.utils.flop_counter import FlopCounterMode
+    except ImportError:
+        return None
+    flop_counter = FlopCounterMode(display=False)
+    with flop_counter:
+        fn()
+    return flop_counter.get_total_flops()
+
+
+@torch.no_grad()
+def benchmark_module(
+    name: str,
+    batch_size: int,
+    seq_len: int,
+    hidden_size: int,
+    num_experts: Optional[int] = None,
+    warmup: int = 3,
+    repeats: int = 10,
+    dtype: torch.dtype = torch.float32,
+) -> ModuleBenchmarkResult:
+    """
+    Benchmark the forward pass of one module of `wonderful_matrices.modules` on CPU.
+
+    Args:
+        name (`str`):
+            One of the keys of `MODULES`.
+        batch_size (`int`):
+            Batch size of the input.
+        seq_len (`int`):
+            Sequence length of the input.
+        hidden_size (`int`):
+            Hidden size of the module.
+        num_experts (`int`, *optional*):
+            Number of experts of the mixture of experts modules, a perfect square for `CDMoE` and `PEER`.
+        warmup (`int`, *optional*, defaults to 3):
+            Untimed iterations before measuring.
+        repeats (`int`, *optional*, defaults to 10):
+            Timed iterations.
+        dtype (`torch.dtype`, *optional*, defaults to `torch.float32`):
+            Dtype of the module and the input.
+    """
+    build, extra_inputs, has_experts = MODULES[name]
+    module = build(hidden_size, num_experts if has_experts else None).to(dtype).eval()
+    hidden_states = torch.randn(batch_size, seq_len, hidden_size, dtype=dtype)
+    kwargs = extra_inputs(module, hidden_states) if extra_inputs is not None else {}
+
+    def forward():
+        return module(hidden_states, **kwargs)
+
+    for _ in range(warmup):
+        forward()
+
+    baseline_rss = current_rss_mb()
+    peak_reset = reset_peak_rss()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        forward()
+        latencies.append(time.perf_counter() - start)
+    # the peak over the baseline is the working set of the forward pass when the peak could be reset
+    peak_rss = peak_rss_mb() - baseline_rss if peak_reset else peak_rss_mb()
+
+    num_allocations, allocated_mb = count_allocations(forward)
+    flops = _count_flops(forward)
+
+    latency = percentile(latencies, 50)
+    num_params = sum(param.numel() for param in module.parameters())
+    # bytes that must at least be read or written once: the parameters, the input and the output
+    element_size = torch.finfo(dtype).bits // 8
+    min_bytes = (num_params + 2 * hidden_states.numel()) * element_size
+    return ModuleBenchmarkResult(
+        module=name,
+        batch_size=batch_size,
+        seq_len=seq_len,
+        hidden_size=hidden_size,
+        num_experts=num_experts if has_experts else None,
+        num_params=num_params,
+        latency_ms=latency * 1e3,
+        latency_p90_ms=percentile(latencies, 90) * 1e3,
+        tokens_per_s=batch_size * seq_len / latency,
+        gflops=flops / 1e9 if flops is not None else None,
+        gflops_per_s=flops / 1e9 / latency if flops is not None else None,
+        arithmetic_intensity=flops / min_bytes if flops is not None else None,
+        peak_rss_mb=peak_rss,
+        num_allocations=num_allocations,
+        allocated_mb=allocated_mb,
+    )
+
+
+def run_sweep(args) -> List[Dict[str, Any]]:
+    results = []
+    for name in args.modules:
+        has_experts = MODULES[name][2]
+        num_experts_sweep = args.num_experts if has_experts else [None]
+        for batch_size, seq_len, hidden_size, num_experts in itertools.product(
+            args.batch_sizes, args.seq_lens, args.hidden_sizes, num_experts_sweep
+        ):
+            try:
+                result = benchmark_module(
+                    name,
+                    batch_size,
+                    seq_len,
+                    hidden_size,
+                    num_experts,
+                    warmup=args.warmup,
+                    repeats=args.repeats,
+                    dtype=getattr(torch, args.dtype),
+                )
+            except ImportError as e:
+                print(f"skipping {name}: {e}", file=sys.stderr)
+                break
+            except Exception as e:
+                # one configuration that cannot run is recorded instead of aborting the rest of the sweep
+                config = {
+                    "module": name,
+                    "batch_size": batch_size,
+                    "seq_len": seq_len,
+                    "hidden_size": hidden_size,
+                    "num_experts": num_experts,
+                }
+                print(
+                    f"skipping {name} batch={batch_size} seq={seq_len} hidden={hidden_size} experts={num_experts}: {e}",
+                    file=sys.stderr,
+                )
+                results.append({**config, "error": f"{type(e).__name__}: {e}"})
+                continue
+            results.append(asdict(result))
+            print_result(result)
+    return results
+
+
+def print_result(result: ModuleBenchmarkResult):
+    gflops_per_s = f"{result.gflops_per_s:.1f}" if result.gflops_per_s is not None else "-"
+    intensity = f"{result.arithmetic_intensity:.1f}" if result.arithmetic_intensity is not None else "-"
+    num_experts = str(result.num_experts) if result.num_experts is not None else "-"
+    print(
+        f"{result.module:<10}{result.batch_size:>6}{result.seq_len:>8}{result.hidden_size:>8}{num_experts:>9}"
+        f"{result.latency_ms:>12.3f}{result.tokens_per_s:>14.0f}{gflops_per_s:>10}{intensity:>11}"
+        f"{result.peak_rss_mb:>11.1f}{result.num_allocations:>8}"
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    arg_parser = ArgumentParser(description="CPU microbenchmarks of wonderful_matrices.modules")
+    arg_parser.add_argument("--modules", type=str, nargs="+", default=list(MODULES), choices=list(MODULES))
+    arg_parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8])
+    arg_parser.add_argument("--seq_lens", type=int, nargs="+", default=[128, 512])
+    arg_parser.add_argument("--hidden_sizes", type=int, nargs="+", default=[256, 512])
+    arg_parser.add_argument("--num_experts", type=int, nargs="+", default=[256, 1024], help="perfect squares")
+    arg_parser.add_argument("--warmup", type=int, default=3)
+    arg_parser.add_argument("--repeats", type=int, default=10)
+    arg_parser.add_argument("--dtype", type=str, default="float32")
+    arg_parser.add_argument("--threads", type=int, default=None)
+    arg_parser.add_argument("--output", type=str, default=None, help="path of the JSON results")
+    arg_parser.add_argument("--compare", type=str, default=None, help="JSON results of a baseline run")
+    arg_parser.add_argument("--threshold", type=float, default=0.1, help="relative latency increase that fails")
+    args = arg_parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    print(
+        f"{'module':<10}{'batch':>6}{'seq':>8}{'hidden':>8}{'experts':>9}{'latency ms':>12}{'tokens/s':>14}"
+        f"{'GFLOP/s':>10}{'FLOP/byte':>11}{'peak MB':>11}{'allocs':>8}"
+    )
+    results = run_sweep(args)
+    if args.output is not None:
+        write_results(args.output, results, benchmark="modules")
+
+    if args.compare is not None:
+        regressions = compare_results(args.compare, results, KEY_FIELDS, "latency_ms", threshold=args.threshold)
+        for regression in regressions:
+            print(
+                f"regression: {regression['module']} batch={regression['batch_size']} seq={regression['seq_len']} "
+                f"hidden={regression['hidden_size']} experts={regression['num_experts']}: "
+                f"{regression['baseline_latency_ms']:.3f} ms -> {regression['latency_ms']:.3f} ms "
+                f"(x{regression['ratio']:.2f})"
+            )
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+# coding=utf-8
+# Copyright 2024 Jingze Shi. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Opt-in per-layer profiling of Doge models.
+
+```python
+with DogeProfiler(model) as profiler:
+    model.generate(input_ids, max_new_tokens=32)
+print(profiler.table())
+print(profiler.table(by_layer=True))
+profiler.export_chrome_trace("doge_trace.json")
+```
+
+The spans are recorded with forward hooks and by wrapping the methods of the instances, nothing is patched on the
+classes and everything is removed when the context exits, so a model that is not profiled runs unchanged.
+"""
+
+import json
+import os
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from torch import nn
+
+
+# component -> method of the attention or feed-forward module that is timed as that component
+ATTENTION_METHODS = {"dynamic_mask": "prepare_dynamic_mask", "attention_core": "attention_core"}
+FEED_FORWARD_METHODS = {"route": "route", "expert_gather": "mix_experts", "mlp": "mlp"}
+COMPONENTS = (
+    "model",
+    "rotary_emb",
+    "layer",
+    "attn",
+    "dynamic_mask",
+    "attention_core",
+    "feed_forward",
+    "route",
+    "expert_gather",
+    "mlp",
+)
+
+
+@dataclass
+class ProfileEvent:
+    name: str
+    phase: str
+    layer_idx: Optional[int]
+    start_ns: int
+    duration_ns: int
+    depth: int
+    output_bytes: int
+    device_memory_bytes: Optional[int] = None
+
+
+def _nbytes(outputs: Any) -> int:
+    if isinstance(outputs, torch.Tensor):
+        return outputs.numel() * outputs.element_size()
+    if isinstance(outputs, (tuple, list)):
+        return sum(_nbytes(output) for output in outputs)
+    return 0
+
+
+class DogeProfiler:
+    """
+    Context manager that times the decoder layers of a Doge model and their parts, split by prefill and decode.
+
+    The spans are:
+
+    - `model`: one forward pass of the base model, the phase is `prefill` when the cache is empty and `decode` after.
+    - `rotary_emb`: the cos and sin of the positions.
+    - `layer`: a decoder layer, with its norms and residuals.
+    - `attn`: the dynamic mask attention, containing `dynamic_mask` and `attention_core`.
+    - `feed_forward`: the MLP or CDMoE, containing `route`, `expert_gather` and `mlp`.
+
+    Every span records its wall time and the bytes of its outputs. On CUDA the allocated memory delta is recorded too
+    and the device is synchronized at the span boundaries, which adds overhead but keeps the kernels in their span.
+
+    Args:
+        model (`nn.Module`):
+            A [`DogeModel`] or a model with a Doge base model, e.g. [`DogeForCausalLM`].
+        synchronize (`bool`, *optional*):
+            Whether to synchronize the device at the span boundaries, defaults to whether the model is on CUDA.
+    """
+
+    def __init__(self, model: nn.Module, synchronize: Optional[bool] = None):
+        self.model = model
+        self.base_model = getattr(model, "base_model", model)
+        device = next(model.parameters()).device
+        self.cuda = device.type == "cuda"
+        self.synchronize = self.cuda if synchronize is None else synchronize
+        self.events: List[ProfileEvent] = []
+        self.phase = "prefill"
+        self._stack: List[Tuple[str, Optional[int], int, Optional[int]]] = []
+        self._handles = []
+        self._wrapped: List[Tuple[nn.Module, str]] = []
+        self._start_ns = None
+
+    def _now(self) -> int:
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter_ns()
+
+    def _push(self, name: str, layer_idx: Optional[int]):
+        memory = torch.cuda.memory_allocated() if self.cuda else None
+        self._stack.append((name, layer_idx, self._now(), memory))
+
+    def _pop(self, outputs: Any):
+        end = self._now()
+        name, layer_idx, start, memory = self._stack.pop()
+        self.events.append(
+            ProfileEvent(
+                name=name,
+                phase=self.phase,
+                layer_idx=layer_idx,
+                start_ns=start - self._start_ns,
+                duration_ns=end - start,
+                depth=len(self._stack),
+                output_bytes=_nbytes(outputs),
+                device_memory_bytes=torch.cuda.memory_allocated() - memory if memory is not None else None,
+            )
+        )
+
+    def _hook_module(self, module: nn.Module, name: str, layer_idx: Optional[int] = None):
+        def pre_hook(module, args):
+            self._push(name, layer_idx)
+
+        def post_hook(module, args, outputs):
+            self._pop(outputs)
+
+        self._handles.append(module.register_forward_pre_hook(pre_hook))
+        self._handles.append(module.register_forward_hook(post_hook))
+
+    def _wrap_method(self, module: nn.Module, method_name: str, name: str, layer_idx: Optional[int]):
+        method = getattr(module, method_name, None)
+        if method is None:
+            return
+
+        def wrapped(*args, **kwargs):
+            self._push(name, layer_idx)
+            outputs = method(*args, **kwargs)
+            self._pop(outputs)
+            return outputs
+
+        # an instance attribute shadows the method of the class until it is deleted on exit
+        setattr(module, method_name, wrapped)
+        self._wrapped.append((module, method_name))
+
+    def _set_phase(self, module, args, kwargs):
+        past_key_values = kwargs.get("past_key_values")
+        has_cache = past_key_values is not None and hasattr(past_key_values, "get_seq_length")
+        self.phase = "decode" if has_cache and past_key_values.get_seq_length() > 0 else "prefill"
+        self._push("model", None)
+
+    def __enter__(self) -> "DogeProfiler":
+        self._start_ns = time.perf_counter_ns()
+        self._handles.append(self.base_model.register_forward_pre_hook(self._set_phase, with_kwargs=True))
+        self._handles.append(self.base_model.register_forward_hook(lambda module, args, outputs: self._pop(outputs)))
+        self._hook_module(self.base_model.rotary_emb, "rotary_emb")
+        for layer_idx, layer in enumerate(self.base_model.layers):
+            self._hook_module(layer, "layer", layer_idx)
+            # the ssd layers of a Cheems model have no attention, only their layer and feed-forward are timed
+            attn = getattr(layer, "attn", None)
+            if attn is not None:
+                self._hook_module(attn, "attn", layer_idx)
+                for name, method_name in ATTENTION_METHODS.items():
+                    self._wrap_method(attn, method_name, name, layer_idx)
+            self._hook_module(layer.feed_forward, "feed_forward", layer_idx)
+            for name, method_name in FEED_FORWARD_METHODS.items():
+                self._wrap_method(layer.feed_forward, method_name, name, layer_idx)
+        return self
+
+    def __exit__(self, *exc_info):
+        for handle in self._handles:
+            handle.remove()
+        for module, method_name in self._wrapped:
+            delattr(module, method_name)
+        self._handles, self._wrapped, self._stack = [], [], []
+
+    def summary(self, by_layer: bool = False) -> Dict[Tuple, Dict[str, float]]:
+        """
+        Aggregate the spans by phase and component, and by layer with `by_layer=True`. Every entry holds the number
+        of calls, the total and mean time in milliseconds, the share of the time of the `model` spans of the phase
+        and the mean output bytes.
+        """
+        totals = defaultdict(lambda: {"calls": 0, "total_ms": 0.0, "output_bytes": 0})
+        phase_ms = defaultdict(float)
+        for event in self.events:
+            if event.name == "model":
+                phase_ms[event.phase] += event.duration_ns / 1e6
+            key = (event.phase, event.layer_idx, event.name) if by_layer else (event.phase, event.name)
+            totals[key]["calls"] += 1
+            totals[key]["total_ms"] += event.duration_ns / 1e6
+            totals[key]["output_bytes"] += event.output_bytes
+        summary = {}
+        for key, total in totals.items():
+            summary[key] = {
+                "calls": total["calls"],
+                "total_ms": total["total_ms"],
+                "mean_ms": total["total_ms"] / total["calls"],
+                "percent": 100 * total["total_ms"] / phase_ms[key[0]] if phase_ms[key[0]] else float("nan"),
+                "mean_output_bytes": total["output_bytes"] / total["calls"],
+            }
+        return summary
+
+    def table(self, by_layer: bool = False) -> str:
+        """The [`~DogeProfiler.summary`] as a text table, sorted by phase, layer and component."""
+        summary = self.summary(by_layer)
+
+        def sort_key(key):
+            # prefill first, then the spans outside of the layers, then by layer, in the order of `COMPONENTS`
+            layer_idx = key[1] if by_layer and key[1] is not None else -1
+            return key[0] != "prefill", layer_idx, COMPONENTS.index(key[-1])
+
+        layer_header = f"{'layer':>6}" if by_layer else ""
+        lines = [
+            f"{'phase':<9}{layer_header}{'component':<16}{'calls':>8}{'total ms':>12}{'mean ms':>10}{'%':>8}"
+            f"{'out MB':>10}"
+        ]
+        for key in sorted(summary, key=sort_key):
+            entry = summary[key]
+            layer = f"{'-' if key[1] is None else key[1]:>6}" if by_layer else ""
+            lines.append(
+                f"{key[0]:<9}{layer}{key[-1]:<16}{entry['calls']:>8}{entry['total_ms']:>12.2f}"
+                f"{entry['mean_ms']:>10.3f}{entry['percent']:>8.1f}{entry['mean_output_bytes'] / 2**20:>10.2f}"
+            )
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path: str):
+        """Write the spans as a Chrome trace, to open in `chrome://tracing` or Perfetto."""
+        trace_events = []
+        for event in self.events:
+            name = event.name if event.layer_idx is None else f"{event.name}.{event.layer_idx}"
+            args = {"layer": event.layer_idx, "output_bytes": event.output_bytes}
+            if event.device_memory_bytes is not None:
+                args["device_memory_bytes"] = event.device_memory_bytes
+            trace_events.append(
+                {
+                    "name": name,
+                    "cat": event.phase,
+                    "ph": "X",
+                    "ts": event.start_ns / 1e3,
+                    "dur": event.duration_ns / 1e3,
+                    "pid": 0,
+                    "tid": 0,
+                    "args": args,
+                }
+            )
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
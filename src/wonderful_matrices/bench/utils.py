@@ -0,0 +1,161 @@
+# coding=utf-8
+# Copyright 2024 Jingze Shi. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Helpers shared by the benchmarks: environment metadata, memory counters, JSON results and comparisons."""
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def git_commit() -> Optional[str]:
+    """The commit of the working tree the benchmark runs from, `None` outside of a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> Dict[str, Any]:
+    """Metadata stored with every result file, so results are only compared across comparable runs."""
+    return {
+        "git_commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "num_threads": torch.get_num_threads(),
+    }
+
+
+def _proc_status_kb(field: str) -> Optional[int]:
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the peak resident set size of the process, only supported on Linux. Returns whether it was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def current_rss_mb() -> float:
+    rss_kb = _proc_status_kb("VmRSS")
+    return rss_kb / 1024 if rss_kb is not None else float("nan")
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process since the last [`reset_peak_rss`], or since it started."""
+    peak_kb = _proc_status_kb("VmHWM")
+    if peak_kb is None and resource is None:
+        return float("nan")
+    if peak_kb is None:
+        # `ru_maxrss` is in kilobytes on Linux and in bytes on macOS
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if platform.system() == "Darwin":
+            peak_kb /= 1024
+    return peak_kb / 1024
+
+
+def count_allocations(fn: Callable[[], Any]) -> Tuple[int, float]:
+    """
+    Run `fn` once under the PyTorch profiler and return the number of CPU tensor allocations and the allocated MB.
+
+    The profiler attributes an allocation to the operator that made it, as a positive `self_cpu_memory_usage`, and
+    only records the frees as separate `[memory]` events. Each operator that allocates counts as one allocation.
+    """
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    num_allocations, allocated_bytes = 0, 0
+    for event in prof.events():
+        if event.self_cpu_memory_usage > 0:
+            num_allocations += 1
+            allocated_bytes += event.self_cpu_memory_usage
+    return num_allocations, allocated_bytes / 2**20
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """The `q`-th percentile of `values`, with linear interpolation."""
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def write_results(path: str, results: List[Dict[str, Any]], **metadata):
+    """Write `results` with the environment metadata to a JSON file."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({**environment(), **metadata, "results": results}, f, indent=2)
+
+
+def compare_results(
+    baseline_path: str,
+    results: List[Dict[str, Any]],
+    key_fields: Sequence[str],
+    metric: str,
+    higher_is_better: bool = False,
+    threshold: float = 0.1,
+) -> List[Dict[str, Any]]:
+    """
+    Match `results` to the results of the baseline file on `key_fields` and return the ones whose `metric` regressed
+    by more than `threshold`, as a relative change, with the baseline value and the ratio.
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    baseline_results = {tuple(result.get(field) for field in key_fields): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get(tuple(result.get(field) for field in key_fields))
+        if baseline_result is None or not baseline_result.get(metric) or result.get(metric) is None:
+            continue
+        ratio = result[metric] / baseline_result[metric]
+        regressed = ratio < 1 - threshold if higher_is_better else ratio > 1 + threshold
+        if regressed:
+            regressions.append({**result, f"baseline_{metric}": baseline_result[metric], "ratio": ratio})
+    return regressions
@@ -0,0 +1,372 @@
+# coding=utf-8
+# Copyright 2024 Jingze Shi. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""ONNX and TorchScript export of DogeForCausalLM as a prefill graph and a decode step graph."""
+
+import importlib.util
+import inspect
+import os
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from torch import nn
+
+from ..models.modeling_doge import DogeDynamicCache
+
+
+# `onnxruntime` is only imported by `load_onnx_sessions`
+is_onnxruntime_available = importlib.util.find_spec("onnxruntime") is not None
+
+
+PREFILL_FILE_NAME = "prefill"
+DECODE_FILE_NAME = "decode"
+
+
+def cache_names(num_hidden_layers: int, prefix: str) -> List[str]:
+    """
+    Names of the flat cache tensors of the exported graphs, three per layer: the keys, the values and the `dt_states`
+    of the dynamic mask.
+    """
+    names = []
+    for layer_idx in range(num_hidden_layers):
+        names += [f"{prefix}.{layer_idx}.key", f"{prefix}.{layer_idx}.value", f"{prefix}.{layer_idx}.dt"]
+    return names
+
+
+def prepare_export_mask(
+    attention_mask: torch.Tensor,
+    query_length: int,
+    dtype: torch.dtype,
+    sliding_window: Optional[int] = None,
+) -> torch.Tensor:
+    """
+    Export safe causal + padding mask of shape `(batch_size, 1, query_length, key_value_length)`, restricted to the
+    `sliding_window` most recent tokens if it is given.
+
+    The mask is built from boolean comparisons and turned into an additive mask by a single `torch.where`, instead of
+    the in place slicing, `torch.triu` branch and multiplication of `torch.finfo(dtype).min` in
+    `DogeModel._update_causal_mask`, which trace into data dependent scatters.
+    """
+    key_value_length = attention_mask.shape[-1]
+    key_positions = torch.arange(key_value_length, device=attention_mask.device)
+    query_positions = key_positions[key_value_length - query_length :]
+    distance = query_positions[:, None] - key_positions[None, :]
+    allowed = distance >= 0
+    if sliding_window is not None:
+        allowed = allowed & (distance < sliding_window)
+    allowed = allowed[None, None, :, :] & attention_mask[:, None, None, :].bool()
+    return torch.where(allowed, 0.0, torch.finfo(dtype).min).to(dtype)
+
+
+class DogeExportModule(nn.Module):
+    """
+    One step of [`DogeForCausalLM`] with the cache as explicit tensors, traced by [`export_doge_onnx`] and
+    [`export_doge_torchscript`].
+
+    The prefill graph takes `input_ids`, `attention_mask` and `position_ids` and returns the logits of the last token
+    followed by the `present.{i}.key`, `present.{i}.value` and `present.{i}.dt` tensors of every layer. The decode
+    graph also takes the `past.{i}.*` tensors of the previous step. The `dt_states` of the dynamic mask are cached
+    like in [`DogeDynamicCache`], so `dt_proj` only runs on the new value states. The decoder layers of the model,
+    with their eager or SDPA attention, are reused as is. The sliding window layers keep their whole history in the
+    cache tensors and apply `config.sliding_window` through their mask.
+
+    Args:
+        model (`DogeForCausalLM`):
+            The model to export, in eval mode.
+        with_past (`bool`, *optional*, defaults to `False`):
+            Whether to build the decode graph taking the cache of the previous step.
+    """
+
+    def __init__(self, model: nn.Module, with_past: bool = False):
+        super().__init__()
+        rotary_emb = model.model.rotary_emb
+        if "dynamic" in rotary_emb.rope_type:
+            raise ValueError("Dynamic RoPE scaling depends on the sequence length and cannot be exported.")
+        self.model = model
+        self.with_past = with_past
+        self.num_hidden_layers = model.config.num_hidden_layers
+
+    def forward(
+        self,
+        input_ids: torch.LongTensor,
+        attention_mask: torch.Tensor,
+        position_ids: torch.LongTensor,
+        *past_states: torch.Tensor,
+    ) -> Tuple[torch.Tensor, ...]:
+        decoder = self.model.model
+        hidden_states = decoder.word_embed(input_ids)
+        causal_mask = prepare_export_mask(attention_mask, input_ids.shape[1], hidden_states.dtype)
+        sliding_window_mask = None
+        if any(decoder_layer.attn.sliding_window is not None for decoder_layer in decoder.layers):
+            sliding_window_mask = prepare_export_mask(
+                attention_mask, input_ids.shape[1], hidden_states.dtype, self.model.config.sliding_window
+            )
+        # cos and sin are computed from the position ids, a traced table lookup would be bounded by its traced length
+        cos, sin = decoder.rotary_emb._compute_cos_sin(position_ids, "cpu")
+        position_embeddings = (cos.to(hidden_states.dtype), sin.to(hidden_states.dtype))
+
+        # the decoder layers of the model run as is, on a cache holding the explicit past tensors
+        cache = DogeDynamicCache()
+        if self.with_past:
+            cache.key_cache = list(past_states[0::3])
+            cache.value_cache = list(past_states[1::3])
+            cache.dt_cache = list(past_states[2::3])
+        for decoder_layer in decoder.layers:
+            layer_mask = sliding_window_mask if decoder_layer.attn.sliding_window is not None else causal_mask
+            hidden_states = decoder_layer(
+                hidden_states,
+                attention_mask=layer_mask,
+                position_ids=position_ids,
+                past_key_value=cache,
+                position_embeddings=position_embeddings,
+            )[0]
+
+        hidden_states = decoder.final_layernorm(hidden_states[:, -1:, :])
+        logits = self.model.lm_head(hidden_states)
+        present_states = ()
+        for layer_idx in range(self.num_hidden_layers):
+            present_states += (cache.key_cache[layer_idx], cache.value_cache[layer_idx], cache.dt_cache[layer_idx])
+        return (logits,) + present_states
+
+
+def _example_inputs(model: nn.Module, with_past: bool, batch_size: int = 2, seq_len: int = 8):
+    device = model.device
+    attn = model.model.layers[0].attn
+    past_len = seq_len if with_past else 0
+    q_len = 1 if with_past else seq_len
+    input_ids = torch.randint(0, model.config.vocab_size, (batch_size, q_len), device=device)
+    attention_mask = torch.ones(batch_size, past_len + q_len, dtype=torch.long, device=device)
+    attention_mask[0, :2] = 0
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, -q_len:]
+    past_states = ()
+    if with_past:
+        for _ in range(model.config.num_hidden_layers):
+            past_states += (
+                torch.randn(batch_size, attn.num_attention_heads, past_len, attn.attention_head_dim, device=device),
+                torch.randn(batch_size, attn.num_attention_heads, past_len, attn.attention_head_dim, device=device),
+                torch.randn(batch_size, past_len, attn.num_attention_heads, device=device),
+            )
+        past_states = tuple(state.to(model.dtype) for state in past_states)
+    return (input_ids, attention_mask, position_ids) + past_states
+
+
+def _dynamic_axes(num_hidden_layers: int, with_past: bool) -> Dict[str, Dict[int, str]]:
+    dynamic_axes = {
+        "input_ids": {0: "batch_size", 1: "sequence_length"},
+        "attention_mask": {0: "batch_size", 1: "total_sequence_length"},
+        "position_ids": {0: "batch_size", 1: "sequence_length"},
+        "logits": {0: "batch_size"},
+    }
+    for prefix, length in [("past", "past_sequence_length"), ("present", "total_sequence_length")]:
+        if prefix == "past" and not with_past:
+            continue
+        for name in cache_names(num_hidden_layers, prefix):
+            # keys and values are `(batch_size, num_heads, length, head_dim)`, dt states `(batch_size, length, num_heads)`
+            dynamic_axes[name] = {0: "batch_size", 1 if name.endswith(".dt") else 2: length}
+    return dynamic_axes
+
+
+@torch.no_grad()
+def export_doge_onnx(model: nn.Module, output_dir: str, opset_version: int = 17) -> Tuple[str, str]:
+    """
+    Export `model` to `prefill.onnx` and `decode.onnx` in `output_dir`, see [`DogeExportModule`] for their inputs and
+    outputs. Returns the paths of both graphs.
+
+    Args:
+        model (`DogeForCausalLM`):
+            The model to export.
+        output_dir (`str`):
+            The directory to write the graphs to.
+        opset_version (`int`, *optional*, defaults to 17):
+            The ONNX opset, at least 14 for the `scaled_dot_product_attention` of the SDPA attention.
+    """
+    model.eval()
+    os.makedirs(output_dir, exist_ok=True)
+    num_hidden_layers = model.config.num_hidden_layers
+    # the graphs are traced with `dynamic_axes`, newer torch versions default to the dynamo exporter instead
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs["dynamo"] = False
+    paths = []
+    for name, with_past in [(PREFILL_FILE_NAME, False), (DECODE_FILE_NAME, True)]:
+        path = os.path.join(output_dir, f"{name}.onnx")
+        input_names = ["input_ids", "attention_mask", "position_ids"]
+        if with_past:
+            input_names += cache_names(num_hidden_layers, "past")
+        torch.onnx.export(
+            DogeExportModule(model, with_past=with_past),
+            _example_inputs(model, with_past),
+            path,
+            input_names=input_names,
+            output_names=["logits"] + cache_names(num_hidden_layers, "present"),
+            dynamic_axes=_dynamic_axes(num_hidden_layers, with_past),
+            opset_version=opset_version,
+            do_constant_folding=True,
+            **export_kwargs,
+        )
+        paths.append(path)
+    return tuple(paths)
+
+
+@torch.no_grad()
+def export_doge_torchscript(model: nn.Module, output_dir: str) -> Tuple[str, str]:
+    """
+    Trace `model` to `prefill.pt` and `decode.pt` in `output_dir` with `torch.jit.trace`, see [`DogeExportModule`]
+    for their inputs and outputs. Returns the paths of both graphs.
+
+    Args:
+        model (`DogeForCausalLM`):
+            The model to export.
+        output_dir (`str`):
+            The directory to write the graphs to.
+    """
+    model.eval()
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for name, with_past in [(PREFILL_FILE_NAME, False), (DECODE_FILE_NAME, True)]:
+        path = os.path.join(output_dir, f"{name}.pt")
+        traced = torch.jit.trace(
+            DogeExportModule(model, with_past=with_past), _example_inputs(model, with_past), check_trace=False
+        )
+        traced.save(path)
+        paths.append(path)
+    return tuple(paths)
+
+
+def load_onnx_sessions(output_dir: str, num_threads: Optional[int] = None):
+    """
+    Create the ONNX Runtime CPU sessions of the prefill and decode graphs written by [`export_doge_onnx`].
+    """
+    if not is_onnxruntime_available:
+        raise ImportError("Running the exported graphs requires `onnxruntime`, install it with `pip install onnxruntime`.")
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    if num_threads is not None:
+        options.intra_op_num_threads = num_threads
+    return tuple(
+        onnxruntime.InferenceSession(
+            os.path.join(output_dir, f"{name}.onnx"), options, providers=["CPUExecutionProvider"]
+        )
+        for name in [PREFILL_FILE_NAME, DECODE_FILE_NAME]
+    )
+
+
+def _next_step_inputs(attention_mask: torch.Tensor, next_token: torch.LongTensor):
+    attention_mask = torch.cat([attention_mask, attention_mask.new_ones(attention_mask.shape[0], 1)], dim=-1)
+    position_ids = (attention_mask.long().cumsum(-1) - 1)[:, -1:]
+    return next_token, attention_mask, position_ids
+
+
+def onnx_greedy_generate(
+    sessions: Tuple,
+    input_ids: torch.LongTensor,
+    attention_mask: torch.Tensor,
+    max_new_tokens: int,
+) -> Tuple[torch.LongTensor, List[torch.Tensor]]:
+    """
+    Greedy decoding with the ONNX Runtime sessions of [`load_onnx_sessions`], returns the generated tokens and the
+    logits of every step.
+    """
+    prefill_session, decode_session = sessions
+    cache_inputs = [name for name in (i.name for i in decode_session.get_inputs()) if name.startswith("past.")]
+    position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+    feeds = {
+        "input_ids": input_ids.numpy(),
+        "attention_mask": attention_mask.long().numpy(),
+        "position_ids": position_ids.numpy(),
+    }
+    session = prefill_session
+    tokens, all_logits = [], []
+    for _ in range(max_new_tokens):
+        logits, *present_states = session.run(None, feeds)
+        logits = torch.from_numpy(logits)[:, -1]
+        next_token = logits.argmax(dim=-1, keepdim=True)
+        tokens.append(next_token)
+        all_logits.append(logits)
+
+        next_token, attention_mask, position_ids = _next_step_inputs(attention_mask, next_token)
+        feeds = {
+            "input_ids": next_token.numpy(),
+            "attention_mask": attention_mask.long().numpy(),
+            "position_ids": position_ids.numpy(),
+        }
+        feeds.update(zip(cache_inputs, present_states))
+        session = decode_session
+    return torch.cat(tokens, dim=-1), all_logits
+
+
+@torch.no_grad()
+def eager_greedy_generate(
+    model: nn.Module,
+    input_ids: torch.LongTensor,
+    attention_mask: torch.Tensor,
+    max_new_tokens: int,
+) -> Tuple[torch.LongTensor, List[torch.Tensor]]:
+    """
+    Greedy decoding with `model` and a [`DogeDynamicCache`], with the same position ids as the exported graphs.
+    Returns the generated tokens and the logits of every step.
+    """
+    cache = DogeDynamicCache()
+    position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+    step_ids = input_ids
+    tokens, all_logits = [], []
+    for _ in range(max_new_tokens):
+        outputs = model(
+            input_ids=step_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+            num_logits_to_keep=1,
+        )
+        logits = outputs.logits[:, -1].float()
+        next_token = logits.argmax(dim=-1, keepdim=True)
+        tokens.append(next_token)
+        all_logits.append(logits)
+        step_ids, attention_mask, position_ids = _next_step_inputs(attention_mask, next_token)
+    return torch.cat(tokens, dim=-1), all_logits
+
+
+@torch.no_grad()
+def check_onnx_parity(
+    model: nn.Module,
+    output_dir: str,
+    input_ids: torch.LongTensor,
+    attention_mask: Optional[torch.Tensor] = None,
+    max_new_tokens: int = 8,
+    atol: float = 1e-4,
+) -> float:
+    """
+    Decode greedily with the eager `model` and with the graphs exported to `output_dir`, and check that the logits of
+    every step match within `atol`. Returns the largest absolute difference.
+
+    Raises:
+        `ValueError`: if the logits differ by more than `atol` or the generated tokens differ.
+    """
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    model.eval()
+    eager_tokens, eager_logits = eager_greedy_generate(model, input_ids, attention_mask, max_new_tokens)
+    onnx_tokens, onnx_logits = onnx_greedy_generate(
+        load_onnx_sessions(output_dir), input_ids.cpu(), attention_mask.cpu(), max_new_tokens
+    )
+    max_abs_diff = max(
+        (eager.cpu() - exported).abs().max().item() for eager, exported in zip(eager_logits, onnx_logits)
+    )
+    if max_abs_diff > atol:
+        raise ValueError(f"The exported logits differ from the eager logits by {max_abs_diff:.2e} > {atol:.2e}.")
+    if not torch.equal(eager_tokens.cpu(), onnx_tokens):
+        raise ValueError("The exported graphs generate different tokens than the eager model.")
+    return max_abs_diff
@@ -0,0 +1,255 @@
+# coding=utf-8
+# Copyright 2024 Jingze Shi. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Speculative decoding with a small draft model proposing tokens for a larger target model."""
+
+from dataclasses import dataclass
+from typing import List, Optional, Union
+
+import torch
+from torch import nn
+from transformers.cache_utils import Cache
+from transformers.utils import ModelOutput
+
+from ..models.modeling_doge import DogeDynamicCache, DogeSlidingWindowCache
+
+
+@dataclass
+class SpeculativeDecodingOutput(ModelOutput):
+    """
+    Outputs of [`speculative_generate`].
+
+    Args:
+        sequences (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
+            The prompts followed by the generated tokens, rows that finished early are padded with `pad_token_id`.
+        num_draft_tokens (`int`):
+            Number of tokens proposed by the draft model for the unfinished rows.
+        num_accepted_tokens (`int`):
+            Number of proposed tokens accepted by the target model and kept in `sequences`.
+    """
+
+    sequences: torch.LongTensor = None
+    num_draft_tokens: Optional[int] = None
+    num_accepted_tokens: Optional[int] = None
+
+
+def logits_to_probs(
+    logits: torch.Tensor,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    top_p: Optional[float] = None,
+) -> torch.Tensor:
+    """
+    Apply temperature, top-k and top-p warping to `logits` and return the float32 sampling distribution.
+    """
+    logits = logits.float() / temperature
+    if top_k is not None and top_k > 0:
+        kth_logits = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values[..., -1:]
+        logits = logits.masked_fill(logits < kth_logits, float("-inf"))
+    if top_p is not None and top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+        sorted_probs = sorted_logits.softmax(dim=-1)
+        # remove the tokens after the cumulative probability exceeds `top_p`, the most likely token is always kept
+        sorted_to_remove = (sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p
+        to_remove = sorted_to_remove.scatter(-1, sorted_indices, sorted_to_remove)
+        logits = logits.masked_fill(to_remove, float("-inf"))
+    return logits.softmax(dim=-1)
+
+
+def _forward_new_tokens(
+    model: nn.Module,
+    input_ids: torch.LongTensor,
+    attention_mask: torch.Tensor,
+    past_key_values: Cache,
+    num_logits_to_keep: int,
+) -> torch.Tensor:
+    """
+    Feed the tokens of `input_ids` that `past_key_values` does not hold yet and return the last `num_logits_to_keep`
+    logits.
+    """
+    if isinstance(past_key_values, DogeSlidingWindowCache):
+        raise ValueError(
+            "Speculative decoding crops the cache after every step and a `DogeSlidingWindowCache` can not be "
+            "cropped, use a `DogeDynamicCache`."
+        )
+    num_new_tokens = input_ids.shape[1] - past_key_values.get_seq_length()
+    # left padding aware positions, padding tokens get a dummy position
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids = position_ids.masked_fill(attention_mask == 0, 1)
+    outputs = model(
+        input_ids=input_ids[:, -num_new_tokens:],
+        attention_mask=attention_mask,
+        position_ids=position_ids[:, -num_new_tokens:],
+        past_key_values=past_key_values,
+        use_cache=True,
+        num_logits_to_keep=num_logits_to_keep,
+    )
+    return outputs.logits[:, -num_logits_to_keep:]
+
+
+@torch.no_grad()
+def speculative_generate(
+    target_model: nn.Module,
+    draft_model: nn.Module,
+    input_ids: torch.LongTensor,
+    attention_mask: Optional[torch.Tensor] = None,
+    max_new_tokens: int = 128,
+    num_lookahead_tokens: int = 4,
+    do_sample: bool = False,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    top_p: Optional[float] = None,
+    eos_token_id: Optional[Union[int, List[int]]] = None,
+    pad_token_id: Optional[int] = None,
+) -> SpeculativeDecodingOutput:
+    """
+    Generate with speculative decoding: `draft_model` proposes `num_lookahead_tokens` tokens autoregressively, then
+    `target_model` scores all of them in a single forward pass and keeps the longest accepted prefix plus one token
+    of its own. With `do_sample=False` the output is the greedy decoding of `target_model`, with `do_sample=True`
+    the rejection sampling rule keeps the output distribution of `target_model` with the same warping.
+
+    Both models must share the tokenizer. The batch is advanced by the smallest number of accepted tokens over the
+    unfinished rows, rows that accepted more keep their draft token at that position, so every row gets a valid
+    sample, and both caches are cropped back to the committed tokens after every step. A model with
+    `config.sliding_window` therefore decodes with a [`DogeDynamicCache`] instead of the ring buffers of a
+    [`DogeSlidingWindowCache`], which can not be cropped.
+
+    Args:
+        target_model (`nn.Module`):
+            The large causal language model whose output is reproduced, e.g. Doge-320M.
+        draft_model (`nn.Module`):
+            The small causal language model proposing the tokens, e.g. Doge-20M.
+        input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
+            The left padded prompts.
+        attention_mask (`torch.Tensor` of shape `(batch_size, sequence_length)`, *optional*):
+            Mask of the prompt padding, defaults to attending to every token.
+        max_new_tokens (`int`, *optional*, defaults to 128):
+            Maximum number of tokens to generate.
+        num_lookahead_tokens (`int`, *optional*, defaults to 4):
+            Number of tokens proposed by the draft model at every step.
+        do_sample (`bool`, *optional*, defaults to `False`):
+            Whether to sample instead of greedy decoding.
+        temperature (`float`, *optional*, defaults to 1.0):
+            Sampling temperature, applied to both models.
+        top_k (`int`, *optional*):
+            Number of the most likely tokens kept when sampling, applied to both models.
+        top_p (`float`, *optional*):
+            Cumulative probability of the most likely tokens kept when sampling, applied to both models.
+        eos_token_id (`int` or `List[int]`, *optional*):
+            End of sequence token ids, defaults to `target_model.config.eos_token_id`.
+        pad_token_id (`int`, *optional*):
+            Token id used after the end of a sequence, defaults to `target_model.config.pad_token_id`.
+    """
+    if target_model.config.vocab_size != draft_model.config.vocab_size:
+        raise ValueError(
+            f"The draft model vocabulary ({draft_model.config.vocab_size}) must match the target model vocabulary "
+            f"({target_model.config.vocab_size})."
+        )
+    if num_lookahead_tokens < 1:
+        raise ValueError(f"`num_lookahead_tokens` must be at least 1, got {num_lookahead_tokens}.")
+
+    if eos_token_id is None:
+        eos_token_id = target_model.config.eos_token_id
+    if pad_token_id is None:
+        pad_token_id = target_model.config.pad_token_id
+    if isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    eos_token_id = torch.tensor(eos_token_id or [], dtype=torch.long, device=input_ids.device)
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+
+    batch_size, prompt_len = input_ids.shape
+    # every cache holds all the committed tokens except the last one, which is fed at the next step
+    # the caches are cropped, so the sliding window layers keep their whole history and apply the window as a mask
+    target_cache, draft_cache = DogeDynamicCache(), DogeDynamicCache()
+    unfinished = torch.ones(batch_size, dtype=torch.bool, device=input_ids.device)
+    num_draft_tokens, num_accepted_tokens = 0, 0
+
+    while unfinished.any() and input_ids.shape[1] - prompt_len < max_new_tokens:
+        num_lookahead = min(num_lookahead_tokens, max_new_tokens - (input_ids.shape[1] - prompt_len) - 1)
+
+        # draft phase, propose `num_lookahead` tokens
+        draft_ids, draft_mask = input_ids, attention_mask
+        draft_tokens, draft_probs = [], []
+        for _ in range(num_lookahead):
+            logits = _forward_new_tokens(draft_model, draft_ids, draft_mask, draft_cache, 1)[:, -1]
+            if do_sample:
+                probs = logits_to_probs(logits, temperature, top_k, top_p)
+                token = torch.multinomial(probs, 1)
+                draft_probs.append(probs)
+            else:
+                token = logits.argmax(dim=-1, keepdim=True)
+            draft_tokens.append(token)
+            draft_ids = torch.cat([draft_ids, token], dim=-1)
+            draft_mask = torch.cat([draft_mask, draft_mask.new_ones(batch_size, 1)], dim=-1)
+        draft_tokens = torch.cat(draft_tokens, dim=-1) if draft_tokens else input_ids.new_zeros(batch_size, 0)
+
+        # verification phase, score the last committed token and all the proposals in one forward pass
+        target_logits = _forward_new_tokens(target_model, draft_ids, draft_mask, target_cache, num_lookahead + 1)
+        if do_sample:
+            target_probs = logits_to_probs(target_logits, temperature, top_k, top_p)
+            if num_lookahead > 0:
+                draft_probs = torch.stack(draft_probs, dim=1)
+                p = target_probs[:, :-1].gather(-1, draft_tokens.unsqueeze(-1)).squeeze(-1)
+                q = draft_probs.gather(-1, draft_tokens.unsqueeze(-1)).squeeze(-1)
+                accepted = torch.rand_like(p) < p / q
+            else:
+                accepted = draft_tokens.new_zeros(batch_size, 0, dtype=torch.bool)
+        else:
+            target_tokens = target_logits.argmax(dim=-1)
+            accepted = draft_tokens == target_tokens[:, :-1]
+        num_accepted = accepted.long().cumprod(dim=-1).sum(dim=-1)
+        num_kept = int(num_accepted[unfinished].min())
+
+        # the token after the kept prefix: the correction sampled from the residual distribution, or the bonus token
+        if do_sample:
+            next_probs = target_probs[:, num_kept]
+            if num_kept < num_lookahead:
+                residual = (next_probs - draft_probs[:, num_kept]).clamp(min=0)
+                residual_sum = residual.sum(dim=-1, keepdim=True)
+                residual = residual / residual_sum.clamp(min=torch.finfo(residual.dtype).tiny)
+                next_probs = torch.where(residual_sum > 0, residual, next_probs)
+            next_token = torch.multinomial(next_probs, 1)
+        else:
+            next_token = target_tokens[:, num_kept : num_kept + 1]
+        if num_kept < num_lookahead:
+            # rows that accepted more proposals keep their draft token at this position
+            next_token = torch.where(
+                num_accepted.unsqueeze(-1) > num_kept, draft_tokens[:, num_kept : num_kept + 1], next_token
+            )
+        new_tokens = torch.cat([draft_tokens[:, :num_kept], next_token], dim=-1)
+
+        num_draft_tokens += num_lookahead * int(unfinished.sum())
+        num_accepted_tokens += num_kept * int(unfinished.sum())
+
+        # pad the finished rows and everything after an end of sequence token
+        new_tokens = new_tokens.masked_fill(~unfinished.unsqueeze(-1), pad_token_id)
+        is_eos = torch.isin(new_tokens, eos_token_id) & unfinished.unsqueeze(-1)
+        after_eos = (is_eos.long().cumsum(dim=-1) - is_eos.long()) > 0
+        new_tokens = new_tokens.masked_fill(after_eos, pad_token_id)
+        unfinished = unfinished & ~is_eos.any(dim=-1)
+
+        input_ids = torch.cat([input_ids, new_tokens], dim=-1)
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones(batch_size, new_tokens.shape[1])], dim=-1)
+
+        # roll both caches back to the committed tokens except the last one, together with their dynamic mask states
+        target_cache.crop(input_ids.shape[1] - 1)
+        if draft_cache.get_seq_length() > input_ids.shape[1] - 1:
+            draft_cache.crop(input_ids.shape[1] - 1)
+
+    return SpeculativeDecodingOutput(
+        sequences=input_ids,
+        num_draft_tokens=num_draft_tokens,
+        num_accepted_tokens=num_accepted_tokens,
+    )
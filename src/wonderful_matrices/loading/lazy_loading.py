@@ -0,0 +1,258 @@
+# coding=utf-8
+# Copyright 2024 Jingze Shi. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Layerwise lazy loading of Doge and Cheems checkpoints from memory-mapped safetensors files."""
+
+import json
+import mmap
+import os
+import struct
+from typing import Dict, Iterator, List, Optional, Tuple, Type, Union
+
+import torch
+from torch import nn
+from transformers import PreTrainedModel
+from transformers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME
+
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+    SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+
+class SafetensorsMmap:
+    """
+    Read only view of one safetensors file, the tensors are zero-copy views of a private memory map of the file.
+
+    Only the JSON header is parsed when the file is opened, the bytes of a tensor are paged in by the OS when the
+    tensor is first read. The mapping is copy-on-write, so the tensors are writable without touching the file.
+
+    Args:
+        path (`str`):
+            Path of the `.safetensors` file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            header_size = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_size))
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.metadata = header.pop("__metadata__", None) or {}
+        self.header = header
+        self.data_offset = 8 + header_size
+
+    def keys(self) -> List[str]:
+        return list(self.header.keys())
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        info = self.header[name]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        if end == start:
+            return torch.empty(info["shape"], dtype=dtype)
+        buffer = memoryview(self.mmap)[self.data_offset + start : self.data_offset + end]
+        return torch.frombuffer(buffer, dtype=dtype).view(info["shape"])
+
+
+class LazyCheckpoint:
+    """
+    The tensors of a single file or sharded safetensors checkpoint, by name, each file memory-mapped once.
+
+    Args:
+        checkpoint_dir (`str`):
+            Directory containing `model.safetensors` or `model.safetensors.index.json` and its shards.
+    """
+
+    def __init__(self, checkpoint_dir: str):
+        index_path = os.path.join(checkpoint_dir, SAFE_WEIGHTS_INDEX_NAME)
+        single_path = os.path.join(checkpoint_dir, SAFE_WEIGHTS_NAME)
+        if os.path.isfile(index_path):
+            with open(index_path, "r", encoding="utf-8") as f:
+                weight_map = json.load(f)["weight_map"]
+            self.files = {
+                file_name: SafetensorsMmap(os.path.join(checkpoint_dir, file_name))
+                for file_name in set(weight_map.values())
+            }
+        elif os.path.isfile(single_path):
+            self.files = {SAFE_WEIGHTS_NAME: SafetensorsMmap(single_path)}
+            weight_map = {name: SAFE_WEIGHTS_NAME for name in self.files[SAFE_WEIGHTS_NAME].keys()}
+        else:
+            raise FileNotFoundError(f"No {SAFE_WEIGHTS_NAME} or {SAFE_WEIGHTS_INDEX_NAME} found in {checkpoint_dir}.")
+        self.weight_map = weight_map
+
+    def keys(self) -> List[str]:
+        return list(self.weight_map.keys())
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        return self.files[self.weight_map[name]].get_tensor(name)
+
+    def state_dict(self, prefix: str = "") -> Dict[str, torch.Tensor]:
+        """The tensors whose name starts with `prefix`, with the prefix removed."""
+        return {
+            name[len(prefix) :]: self.get_tensor(name) for name in self.weight_map if name.startswith(prefix)
+        }
+
+
+def resolve_checkpoint_dir(pretrained_model_name_or_path: str, **kwargs) -> str:
+    """
+    Return `pretrained_model_name_or_path` if it is a local directory, otherwise download the config and safetensors
+    files of the Hub repository and return the local snapshot.
+    """
+    if os.path.isdir(pretrained_model_name_or_path):
+        return pretrained_model_name_or_path
+    from huggingface_hub import snapshot_download
+
+    return snapshot_download(pretrained_model_name_or_path, allow_patterns=["*.json", "*.safetensors", "*.py"], **kwargs)
+
+
+def _decoder_layers(model: PreTrainedModel) -> Iterator[Tuple[str, nn.Module]]:
+    base_model_prefix = f"{model.base_model_prefix}." if model.base_model is not model else ""
+    for layer_idx, layer in enumerate(model.base_model.layers):
+        yield f"{base_model_prefix}layers.{layer_idx}.", layer
+
+
+def _load_module(
+    module: nn.Module,
+    checkpoint: LazyCheckpoint,
+    prefix: str,
+    dtype: Optional[torch.dtype],
+    device: Optional[Union[str, torch.device]],
+    skip_prefixes: Tuple[str, ...] = (),
+):
+    state_dict = {
+        name: tensor
+        for name, tensor in checkpoint.state_dict(prefix).items()
+        if not any(name.startswith(skip_prefix) for skip_prefix in skip_prefixes)
+    }
+    if dtype is not None or device is not None:
+        state_dict = {
+            name: tensor.to(device=device, dtype=dtype if tensor.is_floating_point() else None)
+            for name, tensor in state_dict.items()
+        }
+    # `assign=True` swaps the meta parameters for the mapped tensors instead of copying into them, the load pre hooks
+    # still pack checkpoints saved with separate `q_proj`/`k_proj`/`v_proj` and `gate_proj`/`up_proj` weights
+    incompatible_keys = module.load_state_dict(state_dict, strict=False, assign=True)
+    missing_keys = [
+        key for key in incompatible_keys.missing_keys if not any(key.startswith(p) for p in skip_prefixes)
+    ]
+    if missing_keys:
+        raise ValueError(f"Missing weights for {prefix or 'the model'} in the checkpoint: {missing_keys}")
+
+
+def materialize_lazy_layers(model: PreTrainedModel):
+    """
+    Load every decoder layer of a model returned by [`load_lazy_model`] that has not been used yet, e.g. before
+    building an optimizer or saving it.
+    """
+    for _, layer in _decoder_layers(model):
+        materialize = getattr(layer, "_lazy_materialize", None)
+        if materialize is not None:
+            materialize()
+
+
+def load_lazy_model(
+    model_class: Type[PreTrainedModel],
+    pretrained_model_name_or_path: str,
+    torch_dtype: Optional[torch.dtype] = None,
+    device: Optional[Union[str, torch.device]] = None,
+    lazy: bool = True,
+    **kwargs,
+) -> PreTrainedModel:
+    """
+    Load a Doge or Cheems checkpoint with its safetensors files memory-mapped, for a fast cold start.
+
+    The model is built on the meta device. The embedding, final norm and head are loaded right away. Each decoder
+    layer keeps meta parameters until its first forward pass, when a forward pre hook swaps them for zero-copy views
+    of the mapped files. A tied `lm_head` shares the parameter of `word_embed`, so both read the same mapping.
+    Pages are only read from disk when a layer touches them, so a replica can serve its first token before the large
+    CDMoE `down_embed`/`up_embed` tables of the deeper layers are read.
+
+    Args:
+        model_class (`Type[PreTrainedModel]`):
+            The model class, e.g. [`DogeForCausalLM`] or [`CheemsForCausalLM`].
+        pretrained_model_name_or_path (`str`):
+            A local checkpoint directory or a Hub repository id.
+        torch_dtype (`torch.dtype`, *optional*):
+            Cast the floating point weights to this dtype, which copies them out of the mapping.
+        device (`str` or `torch.device`, *optional*):
+            Move the weights to this device when they are loaded, the mapping is kept on the CPU otherwise.
+        lazy (`bool`, *optional*, defaults to `True`):
+            Whether to defer loading the decoder layers until their first use. With `False` every layer is loaded
+            right away, still without copying the mapped weights, as needed before training.
+        kwargs (`dict`, *optional*):
+            Passed to `model_class.config_class.from_pretrained`.
+    """
+    from accelerate import init_empty_weights
+
+    checkpoint_dir = resolve_checkpoint_dir(pretrained_model_name_or_path)
+    config = model_class.config_class.from_pretrained(checkpoint_dir, **kwargs)
+    if torch_dtype is not None:
+        config.torch_dtype = torch_dtype
+    checkpoint = LazyCheckpoint(checkpoint_dir)
+
+    # the non persistent RoPE buffers are created for real, everything else stays on the meta device
+    with init_empty_weights(include_buffers=False):
+        model = model_class(config)
+    model.eval()
+
+    layer_prefixes = tuple(layer_prefix for layer_prefix, _ in _decoder_layers(model))
+    skip_prefixes = layer_prefixes
+    if getattr(config, "tie_word_embeddings", False):
+        # the head is tied to `word_embed` below instead of being read a second time
+        skip_prefixes += tuple(model._tied_weights_keys or [])
+    _load_module(model, checkpoint, "", torch_dtype, device, skip_prefixes=skip_prefixes)
+    model.tie_weights()
+
+    for layer_prefix, layer in _decoder_layers(model):
+        _attach_lazy_layer(layer, checkpoint, layer_prefix, torch_dtype, device)
+        if not lazy:
+            layer._lazy_materialize()
+
+    model.lazy_checkpoint = checkpoint
+    return model
+
+
+def _attach_lazy_layer(
+    layer: nn.Module,
+    checkpoint: LazyCheckpoint,
+    prefix: str,
+    dtype: Optional[torch.dtype],
+    device: Optional[Union[str, torch.device]],
+):
+    handle = None
+
+    def materialize():
+        nonlocal handle
+        _load_module(layer, checkpoint, prefix, dtype, device)
+        handle.remove()
+        del layer._lazy_materialize
+
+    def pre_hook(module, args, kwargs):
+        materialize()
+
+    handle = layer.register_forward_pre_hook(pre_hook, with_kwargs=True)
+    layer._lazy_materialize = materialize
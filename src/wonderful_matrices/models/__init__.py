@@ -44,10 +44,12 @@ else:
         "DogeConfig"
     ]
     _import_structure["modeling_doge"] = [
+        "DogeDynamicCache",
         "DogeForCausalLM",
         "DogeForSequenceClassification",
         "DogeModel",
         "DogePreTrainedModel",
+        "DogeSlidingWindowCache",
     ]
 
 
@@ -68,10 +70,12 @@ if TYPE_CHECKING:
             CheemsPreTrainedModel,
         )
         from .modeling_doge import (
+            DogeDynamicCache,
             DogeForCausalLM,
             DogeForSequenceClassification,
             DogeModel,
             DogePreTrainedModel,
+            DogeSlidingWindowCache,
         )
 
 
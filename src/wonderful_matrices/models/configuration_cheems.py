@@ -122,6 +122,12 @@ class CheemsConfig(PretrainedConfig):
             Number of Private Experts per head for the Cross Domain Mixture of Experts.
         expert_retrieval_size (`int`, *optional*, defaults to 256):
             Dimension of the Expert retrieval states for the Cross Domain Mixture of Experts.
+        compile_residual_norm (`bool`, *optional*, defaults to `False`):
+            Whether to compile the fused dropout + residual + RMSNorm of the decoder layers with `torch.compile`. It
+            falls back to eager mode when compilation is unavailable or fails.
+        prefill_chunk_size (`int`, *optional*):
+            If set, prompts longer than `prefill_chunk_size` tokens are fed through the cache in chunks of this size at
+            inference, so the attention mask and the attention score matrix only cover one chunk of queries at a time.
     """
 
     model_type = "doge"
@@ -156,6 +162,8 @@ class CheemsConfig(PretrainedConfig):
         num_cdmmoe_heads=4,
         num_cdmmoe_experts_per_head=8,
         expert_retrieval_size=256,
+        compile_residual_norm=False,
+        prefill_chunk_size=None,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -185,6 +193,8 @@ class CheemsConfig(PretrainedConfig):
         self.num_cdmmoe_heads = num_cdmmoe_heads
         self.num_cdmmoe_experts_per_head = num_cdmmoe_experts_per_head
         self.expert_retrieval_size = expert_retrieval_size
+        self.compile_residual_norm = compile_residual_norm
+        self.prefill_chunk_size = prefill_chunk_size
 
         # Validate the correctness of rotary position embeddings parameters
         # BC: if there is a 'type' field, copy it it to 'rope_type'.
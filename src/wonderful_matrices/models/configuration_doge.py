@@ -22,6 +22,9 @@ from transformers.configuration_utils import PretrainedConfig
 from transformers.modeling_rope_utils import rope_config_validation
 
 
+SELECTIVE_CHECKPOINTING_TARGETS = ("attn_scores", "expert_gather", "mlp_intermediate")
+
+
 class DogeConfig(PretrainedConfig):
     r"""
     This is the configuration class to store the configuration of a [`DogeModel`]. It is used to instantiate an Doge
@@ -116,6 +119,30 @@ class DogeConfig(PretrainedConfig):
             Number of Private Experts per head for the Cross Domain Mixture of Experts.
         expert_retrieval_size (`int`, *optional*, defaults to 256):
             Dimension of the Expert retrieval states for the Cross Domain Mixture of Experts.
+        compile_residual_norm (`bool`, *optional*, defaults to `False`):
+            Whether to compile the fused dropout + residual + RMSNorm of the decoder layers with `torch.compile`. It
+            falls back to eager mode when compilation is unavailable or fails.
+        gradient_checkpointing_policy (`str`, *optional*, defaults to `"full"`):
+            What is recomputed in backward when gradient checkpointing is enabled. `"full"` checkpoints whole decoder
+            layers, `"selective"` only checkpoints the parts listed in `selective_checkpointing_targets` and keeps the
+            cheap RMSNorm and Residual outputs.
+        selective_checkpointing_targets (`List[str]`, *optional*, defaults to `["attn_scores", "expert_gather", "mlp_intermediate"]`):
+            Parts checkpointed by the `"selective"` policy: `"attn_scores"` for the dynamic mask and attention score
+            matrix, `"expert_gather"` for the gathered `down_embed`/`up_embed` of the CDMoE and `"mlp_intermediate"`
+            for the intermediate states of the MLP.
+        loss_chunk_size (`int`, *optional*):
+            If set, the training loss of [`DogeForCausalLM`] is computed by a chunked linear + cross entropy over
+            `loss_chunk_size` tokens at a time, so the full vocabulary logits are never materialized and the logits are
+            recomputed in backward. The logits are not returned in this case.
+        prefill_chunk_size (`int`, *optional*):
+            If set, prompts longer than `prefill_chunk_size` tokens are fed through the cache in chunks of this size at
+            inference, so the attention mask and the attention score matrix only cover one chunk of queries at a time.
+        sliding_window (`int`, *optional*):
+            If set, the layers listed in `sliding_window_layers` only attend to the `sliding_window` most recent tokens,
+            the current one included, and keep a bounded [`DogeSlidingWindowCache`] when decoding.
+        sliding_window_layers (`List[int]`, *optional*):
+            Indices of the layers using `sliding_window`, all the layers if unset. The other layers attend to the whole
+            history.
     """
 
     model_type = "doge"
@@ -147,6 +174,13 @@ class DogeConfig(PretrainedConfig):
         num_cdmmoe_heads=4,
         num_cdmmoe_experts_per_head=8,
         expert_retrieval_size=256,
+        compile_residual_norm=False,
+        gradient_checkpointing_policy="full",
+        selective_checkpointing_targets=None,
+        loss_chunk_size=None,
+        prefill_chunk_size=None,
+        sliding_window=None,
+        sliding_window_layers=None,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -173,6 +207,34 @@ class DogeConfig(PretrainedConfig):
         self.num_cdmmoe_heads = num_cdmmoe_heads
         self.num_cdmmoe_experts_per_head = num_cdmmoe_experts_per_head
         self.expert_retrieval_size = expert_retrieval_size
+        self.compile_residual_norm = compile_residual_norm
+        self.gradient_checkpointing_policy = gradient_checkpointing_policy
+        self.selective_checkpointing_targets = (
+            selective_checkpointing_targets
+            if selective_checkpointing_targets is not None
+            else list(SELECTIVE_CHECKPOINTING_TARGETS)
+        )
+        self.loss_chunk_size = loss_chunk_size
+        self.prefill_chunk_size = prefill_chunk_size
+        self.sliding_window = sliding_window
+        self.sliding_window_layers = sliding_window_layers
+
+        if self.gradient_checkpointing_policy not in ("full", "selective"):
+            raise ValueError(
+                f"`gradient_checkpointing_policy` must be 'full' or 'selective', got {self.gradient_checkpointing_policy}."
+            )
+        for target in self.selective_checkpointing_targets:
+            if target not in SELECTIVE_CHECKPOINTING_TARGETS:
+                raise ValueError(
+                    f"Unknown selective checkpointing target {target}, expected one of {SELECTIVE_CHECKPOINTING_TARGETS}."
+                )
+        if self.sliding_window is not None and self.sliding_window < 1:
+            raise ValueError(f"`sliding_window` must be a positive number of tokens, got {self.sliding_window}.")
+        for layer_idx in self.sliding_window_layers or []:
+            if not 0 <= layer_idx < self.num_hidden_layers:
+                raise ValueError(
+                    f"Sliding window layer {layer_idx} is out of range for {self.num_hidden_layers} hidden layers."
+                )
 
         # Validate the correctness of rotary position embeddings parameters
         # BC: if there is a 'type' field, copy it it to 'rope_type'.
@@ -0,0 +1,332 @@
+# coding=utf-8
+# Copyright 2024 Jingze Shi. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Image processor for Doge vision models."""
+
+import io
+import os
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+from transformers.utils import is_vision_available
+
+
+if is_vision_available():
+    from PIL import Image
+
+
+ImageInput = Union[str, os.PathLike, bytes, "Image.Image", torch.Tensor]
+
+
+def center_to_corners_format(boxes: torch.Tensor) -> torch.Tensor:
+    """Convert boxes from `(center_x, center_y, width, height)` to `(x_min, y_min, x_max, y_max)`."""
+    center_x, center_y, width, height = boxes.unbind(-1)
+    return torch.stack(
+        [center_x - 0.5 * width, center_y - 0.5 * height, center_x + 0.5 * width, center_y + 0.5 * height], dim=-1
+    )
+
+
+def batched_box_iou(boxes: torch.Tensor) -> torch.Tensor:
+    """
+    Pairwise IoU of the boxes of every image, `boxes` of shape `(batch_size, num_boxes, 4)` in corners format,
+    returns `(batch_size, num_boxes, num_boxes)`.
+    """
+    area = (boxes[..., 2] - boxes[..., 0]).clamp(min=0) * (boxes[..., 3] - boxes[..., 1]).clamp(min=0)
+    top_left = torch.maximum(boxes[:, :, None, :2], boxes[:, None, :, :2])
+    bottom_right = torch.minimum(boxes[:, :, None, 2:], boxes[:, None, :, 2:])
+    intersection = (bottom_right - top_left).clamp(min=0).prod(dim=-1)
+    union = area[:, :, None] + area[:, None, :] - intersection
+    return intersection / union.clamp(min=torch.finfo(boxes.dtype).eps)
+
+
+def batched_nms(
+    boxes: torch.Tensor,
+    scores: torch.Tensor,
+    labels: torch.Tensor,
+    valid: torch.Tensor,
+    iou_threshold: float,
+) -> torch.Tensor:
+    """
+    Class aware greedy non maximum suppression of every image of a batch at once.
+
+    The boxes must be sorted by decreasing score. A box is kept when no kept box of the same class with a higher score
+    overlaps it by more than `iou_threshold`. The kept boxes only depend on the boxes before them, so iterating this
+    rule from keeping every box reaches the greedy result after at most as many steps as the longest chain of
+    suppressions, every step is a batched tensor operation instead of a loop over images and boxes.
+
+    Args:
+        boxes (`torch.Tensor` of shape `(batch_size, num_boxes, 4)`):
+            Boxes in corners format, sorted by decreasing score.
+        scores (`torch.Tensor` of shape `(batch_size, num_boxes)`):
+            Sorted scores, only used for their order.
+        labels (`torch.Tensor` of shape `(batch_size, num_boxes)`):
+            Class of every box, boxes of different classes never suppress each other.
+        valid (`torch.Tensor` of shape `(batch_size, num_boxes)`):
+            Boxes that take part, e.g. above the score threshold.
+        iou_threshold (`float`):
+            Overlap above which a box is suppressed.
+
+    Returns:
+        `torch.BoolTensor` of shape `(batch_size, num_boxes)`, the kept boxes.
+    """
+    num_boxes = scores.shape[-1]
+    earlier = torch.ones(num_boxes, num_boxes, dtype=torch.bool, device=boxes.device).triu(diagonal=1)
+    # suppresses[b, i, j]: box i would suppress box j if it is kept
+    suppresses = (batched_box_iou(boxes) > iou_threshold) & (labels[:, :, None] == labels[:, None, :])
+    suppresses &= earlier & valid[:, :, None] & valid[:, None, :]
+    keep = valid
+    for _ in range(num_boxes):
+        new_keep = valid & ~(suppresses & keep[:, :, None]).any(dim=1)
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return keep
+
+
+class DogeImageProcessor:
+    r"""
+    Image processor for Doge vision models: decodes, resizes to `config.image_size` and normalizes images into
+    `pixel_values`, and post-processes the detections of [`DogeForObjectDetection`].
+
+    The processor only holds plain attributes, so it can be sent to the worker processes of [`build_image_dataloader`].
+
+    Args:
+        image_size (`List[int]`, *optional*, defaults to [512, 672]):
+            The `(height, width)` the images are resized to.
+        image_mean (`List[float]`, *optional*, defaults to [0.5, 0.5, 0.5]):
+            Mean of every channel, on images scaled to [0, 1].
+        image_std (`List[float]`, *optional*, defaults to [0.5, 0.5, 0.5]):
+            Standard deviation of every channel, on images scaled to [0, 1].
+        resample (`str`, *optional*, defaults to `"bilinear"`):
+            Resampling filter of the resize, one of `"nearest"`, `"bilinear"` and `"bicubic"`.
+    """
+
+    def __init__(
+        self,
+        image_size: List[int] = [512, 672],
+        image_mean: List[float] = [0.5, 0.5, 0.5],
+        image_std: List[float] = [0.5, 0.5, 0.5],
+        resample: str = "bilinear",
+    ):
+        self.image_size = list(image_size)
+        self.image_mean = list(image_mean)
+        self.image_std = list(image_std)
+        self.resample = resample
+
+    @classmethod
+    def from_config(cls, config, **kwargs) -> "DogeImageProcessor":
+        """Build the processor matching the `image_size` of a vision [`DogeConfig`]."""
+        return cls(image_size=config.image_size, **kwargs)
+
+    def decode(self, image: ImageInput) -> Tuple[Union["Image.Image", torch.Tensor], Tuple[int, int]]:
+        """
+        Decode a path or encoded bytes into an RGB image and its original `(height, width)`. Encoded JPEG images are
+        decoded directly at the smallest scale that is still larger than `image_size`, which skips most of the
+        decoding work of large photos. Tensors of shape `(num_channels, height, width)` are returned as is.
+        """
+        if isinstance(image, torch.Tensor):
+            return image, tuple(image.shape[-2:])
+        if not is_vision_available():
+            raise ImportError("Decoding images requires Pillow, install it with `pip install pillow`.")
+        if isinstance(image, (bytes, str, os.PathLike)):
+            image = Image.open(io.BytesIO(image) if isinstance(image, bytes) else image)
+            original_size = image.size[::-1]
+            height, width = self.image_size
+            image.draft("RGB", (width, height))
+        else:
+            original_size = image.size[::-1]
+        return image.convert("RGB"), original_size
+
+    def preprocess(self, image: ImageInput) -> Tuple[torch.Tensor, Tuple[int, int]]:
+        """
+        Decode, resize and normalize one image. `uint8` tensors are scaled to [0, 1], floating point tensors are
+        expected in [0, 1] already.
+
+        Returns:
+            `Tuple[torch.Tensor, Tuple[int, int]]`: The `pixel_values` of shape `(num_channels, height, width)` and
+            the original `(height, width)` of the image, e.g. to scale the detected boxes.
+        """
+        image, original_size = self.decode(image)
+        height, width = self.image_size
+        if isinstance(image, torch.Tensor):
+            pixel_values = image.float()
+            if image.dtype == torch.uint8:
+                pixel_values = pixel_values / 255.0
+            if tuple(pixel_values.shape[-2:]) != (height, width):
+                pixel_values = torch.nn.functional.interpolate(
+                    pixel_values[None], size=(height, width), mode=self.resample, antialias=self.resample != "nearest"
+                )[0]
+        else:
+            if image.size != (width, height):
+                image = image.resize((width, height), resample=Image.Resampling[self.resample.upper()])
+            pixel_values = torch.frombuffer(bytearray(image.tobytes()), dtype=torch.uint8)
+            pixel_values = pixel_values.view(height, width, 3).permute(2, 0, 1).float() / 255.0
+
+        mean = torch.tensor(self.image_mean, dtype=pixel_values.dtype)[:, None, None]
+        std = torch.tensor(self.image_std, dtype=pixel_values.dtype)[:, None, None]
+        return (pixel_values - mean) / std, original_size
+
+    def __call__(self, images: Union[ImageInput, Sequence[ImageInput]]) -> Dict[str, torch.Tensor]:
+        """
+        Preprocess one image or a list of images in the current process.
+
+        Returns:
+            `Dict[str, torch.Tensor]`: `pixel_values` of shape `(batch_size, num_channels, height, width)` and
+            `original_sizes` of shape `(batch_size, 2)`.
+        """
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+        pixel_values, original_sizes = zip(*(self.preprocess(image) for image in images))
+        return {"pixel_values": torch.stack(pixel_values), "original_sizes": torch.tensor(original_sizes)}
+
+    def post_process_object_detection(
+        self,
+        outputs,
+        threshold: float = 0.5,
+        target_sizes: Optional[Union[torch.Tensor, List[Tuple[int, int]]]] = None,
+        nms_threshold: Optional[float] = 0.5,
+        top_k: Optional[int] = 100,
+    ) -> List[Dict[str, torch.Tensor]]:
+        """
+        Converts the raw output of [`DogeForObjectDetection`] into final detections in `(x_min, y_min, x_max, y_max)`
+        format, for the whole batch at once: score thresholding, box conversion and scaling, class aware NMS and the
+        `top_k` detections of every image.
+
+        Args:
+            outputs ([`DogeObjectDetectionOutputWithPast`]):
+                Raw outputs of the model, `logits` of shape `(batch_size, num_queries, num_labels + 1)` and
+                `pred_boxes` of shape `(batch_size, num_queries, 4)` in normalized center format.
+            threshold (`float`, *optional*, defaults to 0.5):
+                Score threshold to keep object detection predictions.
+            target_sizes (`torch.Tensor` or `List[Tuple[int, int]]`, *optional*):
+                Tensor of shape `(batch_size, 2)` or list of tuples (`Tuple[int, int]`) containing the target size
+                `(height, width)` of each image in the batch. If unset, predictions will not be resized.
+            nms_threshold (`float`, *optional*, defaults to 0.5):
+                IoU above which a box is suppressed by a higher scoring box of the same class, `None` to skip NMS.
+            top_k (`int`, *optional*, defaults to 100):
+                Maximum number of detections per image, `None` to keep all of them.
+
+        Returns:
+            `List[Dict]`: A list of dictionaries, each dictionary containing the scores, labels and boxes for an image
+            in the batch as predicted by the model.
+        """
+        logits, boxes = outputs.logits, outputs.pred_boxes
+        batch_size = logits.shape[0]
+        if target_sizes is not None and len(target_sizes) != batch_size:
+            raise ValueError("Make sure that you pass in as many target sizes as the batch dimension of the logits")
+
+        # the last class is the no object class
+        probs = logits.float().softmax(dim=-1)[..., :-1]
+        scores, labels = probs.max(dim=-1)
+
+        boxes = center_to_corners_format(boxes.float())
+        if target_sizes is not None:
+            if isinstance(target_sizes, list):
+                target_sizes = torch.tensor(target_sizes, device=boxes.device)
+            image_height, image_width = target_sizes.to(boxes.device).unbind(-1)
+            scale = torch.stack([image_width, image_height, image_width, image_height], dim=-1).to(boxes.dtype)
+            boxes = boxes * scale[:, None, :]
+
+        # sort every image by decreasing score, the boxes under the threshold go last
+        valid = scores > threshold
+        scores, order = scores.masked_fill(~valid, -1.0).sort(dim=-1, descending=True)
+        labels = labels.gather(-1, order)
+        boxes = boxes.gather(1, order[..., None].expand(-1, -1, 4))
+        valid = valid.gather(-1, order)
+
+        keep = batched_nms(boxes, scores, labels, valid, nms_threshold) if nms_threshold is not None else valid
+        if top_k is not None:
+            keep &= keep.cumsum(dim=-1) <= top_k
+
+        num_detections = keep.sum(dim=-1).tolist()
+        return [
+            {"scores": image_scores, "labels": image_labels, "boxes": image_boxes}
+            for image_scores, image_labels, image_boxes in zip(
+                scores[keep].split(num_detections),
+                labels[keep].split(num_detections),
+                boxes[keep].split(num_detections),
+            )
+        ]
+
+
+class DogeImageDataset(Dataset):
+    """
+    Dataset preprocessing every image with a [`DogeImageProcessor`] when it is loaded, so that the decoding runs in
+    the worker processes of a [`DataLoader`].
+    """
+
+    def __init__(self, images: Sequence[ImageInput], image_processor: DogeImageProcessor):
+        self.images = images
+        self.image_processor = image_processor
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        pixel_values, original_size = self.image_processor.preprocess(self.images[idx])
+        return {"pixel_values": pixel_values, "original_sizes": torch.tensor(original_size)}
+
+
+def _single_thread_worker_init_fn(worker_id: int):
+    # every worker decodes its own images, intra-op threads would only oversubscribe the cores
+    torch.set_num_threads(1)
+
+
+def build_image_dataloader(
+    images: Sequence[ImageInput],
+    image_processor: DogeImageProcessor,
+    batch_size: int = 8,
+    num_workers: int = 4,
+    prefetch_factor: Optional[int] = 2,
+    pin_memory: bool = False,
+    persistent_workers: bool = True,
+) -> DataLoader:
+    """
+    Build a [`DataLoader`] decoding, resizing and normalizing the images in a pool of `num_workers` processes.
+
+    The workers collate every batch straight into a shared memory tensor, the main process maps it without copying
+    and can feed it to the model as `pixel_values`. Each worker keeps `prefetch_factor` batches in flight, so the next
+    batches are decoded while the model runs on the current one.
+
+    Args:
+        images (`Sequence`):
+            Paths, encoded bytes, PIL images or tensors of shape `(num_channels, height, width)`.
+        image_processor ([`DogeImageProcessor`]):
+            The processor applied to every image.
+        batch_size (`int`, *optional*, defaults to 8):
+            Number of images per batch.
+        num_workers (`int`, *optional*, defaults to 4):
+            Number of worker processes, 0 to preprocess in the main process.
+        prefetch_factor (`int`, *optional*, defaults to 2):
+            Number of batches loaded in advance by every worker.
+        pin_memory (`bool`, *optional*, defaults to `False`):
+            Copy the batches into page-locked memory, to move them to the GPU with `non_blocking=True`.
+        persistent_workers (`bool`, *optional*, defaults to `True`):
+            Keep the workers alive between epochs, so a serving loop does not pay their start up again.
+
+    Returns:
+        `DataLoader`: Yields dictionaries with `pixel_values` of shape `(batch_size, num_channels, height, width)`
+        and `original_sizes` of shape `(batch_size, 2)`, usable as `target_sizes` of
+        [`DogeImageProcessor.post_process_object_detection`].
+    """
+    return DataLoader(
+        DogeImageDataset(images, image_processor),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        pin_memory=pin_memory,
+        persistent_workers=persistent_workers and num_workers > 0,
+        worker_init_fn=_single_thread_worker_init_fn if num_workers > 0 else None,
+    )
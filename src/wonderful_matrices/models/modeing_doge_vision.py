@@ -18,6 +18,7 @@
 # limitations under the License.
 """PyTorch Doge Vision model."""
 
+from collections import defaultdict
 from dataclasses import dataclass
 import math
 from typing import Dict, List, Optional, Tuple, Union
@@ -41,17 +42,11 @@ from transformers.modeling_utils import PreTrainedModel
 from transformers.utils import (
     add_start_docstrings,
     add_start_docstrings_to_model_forward,
-    # is_einx_available,
     logging,
     replace_return_docstrings,
 )
 from .configuration_doge_vision import DogeConfig
-
-try:
-    from einx import add as einx_add
-except ImportError:
-    einx_add = None
-
+from ..modules.cdmoe import _get_einx_add, is_einx_available
 
 logger = logging.get_logger(__name__)
 
@@ -86,7 +81,7 @@ class RotaryEmbedding(nn.Module):
         if config.rope_scaling is None:
             self.rope_type = "default"
         else:
-            self.rope_type = config.rope_scaling
+            self.rope_type = config.rope_scaling.get("rope_type", config.rope_scaling.get("type"))
         self.max_seq_len_cached = config.max_position_embeddings
         self.original_max_seq_len = config.max_position_embeddings
         self.base = config.rope_theta
@@ -98,6 +93,42 @@ class RotaryEmbedding(nn.Module):
         self.register_buffer("inv_freq", inv_freq, persistent=False)
         self.original_inv_freq = self.inv_freq
 
+        # cos and sin table indexed by position ids, grows geometrically beyond `max_position_embeddings`
+        self._set_cos_sin_cache(config.max_position_embeddings, device=inv_freq.device)
+
+    def _compute_cos_sin(self, position_ids, device_type):
+        # core RoPE block
+        inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
+        position_ids_expanded = position_ids[:, None, :].float()
+        device_type = device_type if isinstance(device_type, str) and device_type != "mps" else "cpu"
+        with torch.autocast(device_type=device_type, enabled=False):
+            freqs = (inv_freq_expanded.float() @ position_ids_expanded.float()).transpose(1, 2)
+            emb = torch.cat((freqs, freqs), dim=-1)
+            cos = emb.cos()
+            sin = emb.sin()
+
+        cos = cos * self.attention_scaling
+        sin = sin * self.attention_scaling
+        return cos, sin
+
+    def _set_cos_sin_cache(self, seq_len, device):
+        position_ids = torch.arange(seq_len, device=device)[None, :]
+        cos, sin = self._compute_cos_sin(position_ids, torch.device(device).type)
+        self.register_buffer("cos_cached", cos[0], persistent=False)
+        self.register_buffer("sin_cached", sin[0], persistent=False)
+        self.cos_sin_cache_len = seq_len
+
+    def extend_cos_sin_cache(self, seq_len):
+        """
+        Make sure the cos and sin table covers `seq_len` positions, doubling its length as needed. The model calls it
+        with the cached plus new length, or past the largest of the `position_ids` it is given.
+        """
+        if seq_len > self.cos_sin_cache_len:
+            new_len = self.cos_sin_cache_len
+            while new_len < seq_len:
+                new_len *= 2
+            self._set_cos_sin_cache(new_len, device=self.inv_freq.device)
+
     def _dynamic_frequency_update(self, position_ids, device):
         """
         dynamic RoPE layers should recompute `inv_freq` in the following situations:
@@ -121,19 +152,13 @@ class RotaryEmbedding(nn.Module):
         if "dynamic" in self.rope_type:
             self._dynamic_frequency_update(position_ids, device=x.device)
 
-        # core RoPE block
-        inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
-        position_ids_expanded = position_ids[:, None, :].float()
-        device_type = x.device.type
-        device_type = device_type if isinstance(device_type, str) and device_type != "mps" else "cpu"
-        with torch.autocast(device_type=device_type, enabled=False):
-            freqs = (inv_freq_expanded.float() @ position_ids_expanded.float()).transpose(1, 2)
-            emb = torch.cat((freqs, freqs), dim=-1)
-            cos = emb.cos()
-            sin = emb.sin()
-
-        cos = cos * self.attention_scaling
-        sin = sin * self.attention_scaling
+        if self.max_seq_len_cached > self.original_max_seq_len:
+            # the scaled `inv_freq` of dynamic RoPE depends on the exact sequence length, so it is not cached
+            cos, sin = self._compute_cos_sin(position_ids, x.device.type)
+        else:
+            # the model sizes the table on the host beforehand, reading `position_ids` here would synchronize
+            cos = self.cos_cached[position_ids]
+            sin = self.sin_cached[position_ids]
 
         return cos.to(dtype=x.dtype), sin.to(dtype=x.dtype)
 
@@ -216,6 +241,7 @@ class DogeInnerFuncAttn(nn.Module):
         self.dynamic_mask = nn.Parameter(
             torch.round(torch.ones(self.num_attention_heads, config.max_position_embeddings))
         )
+        self._dynamic_mask_cache = None
 
         # queries and keys for retrieval V
         self.v_queries = nn.Linear(
@@ -243,108 +269,58 @@ class DogeInnerFuncAttn(nn.Module):
             bias=config.hidden_bias,
         )
 
-    def _update_causal_mask(
-        self,
-        attention_mask: torch.Tensor = None,
-        input_tensor: torch.Tensor = None,
-        cache_position: torch.Tensor = None,
-        past_key_values: Cache = None,
-        output_attentions: bool = False,
-    ):
-        past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
-        using_static_cache = isinstance(past_key_values, StaticCache)
-
-        dtype, device = input_tensor.dtype, input_tensor.device
-        sequence_length = input_tensor.shape[1]
-        if using_static_cache:
-            target_length = past_key_values.get_max_cache_shape()
-        else:
-            target_length = (
-                attention_mask.shape[-1]
-                if isinstance(attention_mask, torch.Tensor)
-                else past_seen_tokens + sequence_length + 1
-            )
-
-        # in case the provided `attention` mask is 2D, we generate a causal mask here (4D).
-        causal_mask = self._prepare_4d_causal_attention_mask_with_cache_position_and_dynamic_mask(
-            attention_mask=attention_mask,
-            dynamic_mask=self.dynamic_mask,
-            sequence_length=sequence_length,
-            target_length=target_length,
-            dtype=dtype,
-            device=device,
-            cache_position=cache_position,
-            batch_size=input_tensor.shape[0],
-        )
-
-        return causal_mask
+    def dynamic_keep_mask(self, key_len: int) -> Tuple[torch.Tensor, bool]:
+        """
+        The boolean dynamic mask of the first `key_len` keys of shape `(num_heads, key_len)`, `True` where a key is
+        kept, and whether every key is kept. It is computed once per key length and reused until the parameter
+        changes, instead of rebuilding a dense float mask in every forward.
+        """
+        cache_key = (key_len, self.dynamic_mask.data_ptr(), self.dynamic_mask._version)
+        if self._dynamic_mask_cache is None or self._dynamic_mask_cache[0] != cache_key:
+            keep = self.dynamic_mask.detach()[:, :key_len] != 0
+            self._dynamic_mask_cache = (cache_key, keep, bool(keep.all()))
+        return self._dynamic_mask_cache[1], self._dynamic_mask_cache[2]
 
-    @staticmethod
-    def _prepare_4d_causal_attention_mask_with_cache_position_and_dynamic_mask(
-        attention_mask: torch.Tensor = None,
-        dynamic_mask: torch.Tensor = None,
-        sequence_length: int = None,
-        target_length: int = None,
-        dtype: torch.dtype = None,
-        device: torch.device = None,
-        cache_position: torch.Tensor = None,
-        batch_size: int = None,
-        **kwargs,
-    ):
+    def prepare_attention_mask(
+        self,
+        attention_mask: Optional[torch.Tensor],
+        key_len: int,
+        key_positions: Optional[torch.LongTensor] = None,
+    ) -> Optional[torch.Tensor]:
         """
-        Creates a causal 4D mask of shape `(batch_size, 1, query_length, key_value_length)` from a 2D mask of shape
-        `(batch_size, key_value_length)`, or if the input `attention_mask` is already 4D, do nothing.
+        Slice the mask shared by all the layers to the keys and combine a boolean mask with the dynamic mask of this
+        layer, skipped when it keeps every key. Float masks are additive and only sliced.
 
-        Args:
-            attention_mask (`torch.Tensor`):
-                A 2D attention mask of shape `(batch_size, key_value_length)` or a 4D attention mask of shape
-                `(batch_size, 1, query_length, key_value_length)`.
-            dynamic_mask (`torch.Tensor`):
-                A 2D dynamic mask of shape `(num_heads, max_position_embeddings)`.
-            sequence_length (`int`):
-                The sequence length being processed.
-            target_length (`int`):
-                The target length: when generating with static cache, the mask should be as long as the static cache,
-                to account for the 0 padding, the part of the cache that is not filled yet.
-            dtype (`torch.dtype`):
-                The dtype to use for the 4D attention mask.
-            device (`torch.device`):
-                The device to plcae the 4D attention mask on.
-            cache_position (`torch.Tensor`):
-                Indices depicting the position of the input sequence tokens in the sequence.
-            batch_size (`torch.Tensor`):
-                Batch size.
+        The dynamic mask of a key is the one of its position. With `key_positions` of shape `(batch_size, key_len)`,
+        e.g. the positions restarting at every sample of [`DogeForCausalVLM.pack_inputs`], it is gathered per key,
+        otherwise the key at index `i` of the cache is at position `i`.
         """
-        if attention_mask is not None and attention_mask.dim() == 4:
-            # In this case we assume that the mask comes already in inverted form and requires no inversion or slicing.
-            causal_mask = attention_mask
-        else:
-            num_heads = 1 if dynamic_mask is None else dynamic_mask.size(0)
-            min_dtype = torch.finfo(dtype).min
-            causal_mask = torch.full(
-                (sequence_length, target_length),
-                fill_value=min_dtype,
-                dtype=dtype,
-                device=device,
-            )
-            if sequence_length != 1:
-                causal_mask = torch.triu(causal_mask, diagonal=1)
-            causal_mask *= torch.arange(target_length, device=device) > cache_position.reshape(-1, 1)
-            causal_mask = causal_mask[None, None, :, :].expand(batch_size, num_heads, -1, -1)
-            if attention_mask is not None:
-                causal_mask = causal_mask.clone()  # copy to contiguous memory for in-place edit
-                mask_length = attention_mask.shape[-1]
-                attention_mask = attention_mask[:, None, None, :].expand(-1, num_heads, 1, -1)
-                if dynamic_mask is not None:
-                    dynamic_mask = dynamic_mask[None, :, None, :mask_length].expand(batch_size, -1, 1, -1)
-                    attention_mask = attention_mask.clone() * dynamic_mask
-
-                padding_mask = causal_mask[:, :, :, :mask_length] + attention_mask
-                causal_mask[:, :, :, :mask_length] = causal_mask[:, :, :, :mask_length].masked_fill(
-                    padding_mask == 0, min_dtype
+        if attention_mask is None:
+            return None
+        attention_mask = attention_mask[:, :, :, :key_len]
+        if attention_mask.dtype != torch.bool:
+            return attention_mask
+        max_positions = self.dynamic_mask.shape[-1]
+        if key_positions is None:
+            if key_len > max_positions:
+                raise ValueError(
+                    f"The dynamic mask covers {max_positions} positions (`max_position_embeddings`), "
+                    f"but the attention has {key_len} keys."
                 )
-
-        return causal_mask
+            dynamic_keep, keep_all = self.dynamic_keep_mask(key_len)
+            if keep_all:
+                return attention_mask
+            dynamic_keep = dynamic_keep[None, :, None, :]
+        else:
+            dynamic_keep, keep_all = self.dynamic_keep_mask(max_positions)
+            if keep_all:
+                return attention_mask
+            # (num_heads, batch_size, key_len) -> (batch_size, num_heads, 1, key_len)
+            dynamic_keep = dynamic_keep[:, key_positions].transpose(0, 1)[:, :, None, :]
+        dynamic_mask = attention_mask & dynamic_keep
+        # a query whose keys are all dropped by the dynamic mask keeps the causal and padding mask, instead of getting
+        # NaN from SDPA or attending to the other samples of a packed row
+        return torch.where(dynamic_mask.any(dim=-1, keepdim=True), dynamic_mask, attention_mask)
 
     def inner_func(
         self,
@@ -358,11 +334,68 @@ class DogeInnerFuncAttn(nn.Module):
         v_queries = self.v_queries(hidden_states)
         v_queries = v_queries.view(bsz, seq_len, self.num_inner_value_heads, -1).transpose(1, 2)
         sim = torch.matmul(v_queries, self.v_keys)
-        v_embed = self.v_embed(sim.topk(k=self.num_value_per_head, dim=-1).indices)
-        # b h t k d -> b t d
-        v = hidden_states * v_embed.sum(dim=-2).sum(dim=-3)
+        indices = sim.topk(k=self.num_value_per_head, dim=-1).indices
+        # b h t k -> (b t) (h k), the values retrieved by every head are summed in a single bag per token,
+        # so the b h t k d tensor of the gathered values is never materialized
+        indices = indices.permute(0, 2, 1, 3).reshape(bsz * seq_len, -1)
+        v_embed = F.embedding_bag(indices, self.v_embed.weight, mode="sum")
+        v = hidden_states * v_embed.view(bsz, seq_len, -1)
         return v
 
+    def attend(
+        self,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+    ) -> torch.Tensor:
+        """
+        Attention of `query_states` to `key_states` under a mask returned by `prepare_attention_mask`, of shape
+        `(batch_size, num_heads, q_len, head_dim)`.
+        """
+        # compute attention scores matrix
+        attn_weights = torch.matmul(query_states, key_states.transpose(-1, -2)) / math.sqrt(self.attention_head_dim)
+
+        # add mask to attention scores
+        if attention_mask is not None and attention_mask.dtype == torch.bool:
+            attn_weights = attn_weights.masked_fill(~attention_mask, torch.finfo(attn_weights.dtype).min)
+        elif attention_mask is not None:
+            attn_weights = attn_weights + attention_mask
+
+        # upcast attention to fp32
+        attn_weights = F.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+        attn_weights = F.dropout(attn_weights, p=self.attention_dropout, training=self.training)
+
+        # apply attention scores to value states
+        return torch.matmul(attn_weights, value_states)
+
+    def attend_segments(
+        self,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        position_ids: torch.LongTensor,
+        cu_seqlens: List[int],
+    ) -> torch.Tensor:
+        """
+        Attention of every segment `cu_seqlens[i]:cu_seqlens[i + 1]` of a packed row to itself only. Each segment gets
+        its own causal mask combined with the dynamic mask of its positions, so the cost is the sum of the squared
+        segment lengths instead of the square of the row length, and no mask of the whole row is built.
+        """
+        attn_outputs = []
+        for start, end in zip(cu_seqlens[:-1], cu_seqlens[1:]):
+            seq_len = end - start
+            causal_mask = torch.ones(seq_len, seq_len, dtype=torch.bool, device=query_states.device).tril()
+            causal_mask = self.prepare_attention_mask(causal_mask[None, None], seq_len, position_ids[:, start:end])
+            attn_outputs.append(
+                self.attend(
+                    query_states[:, :, start:end],
+                    key_states[:, :, start:end],
+                    value_states[:, :, start:end],
+                    causal_mask,
+                )
+            )
+        return torch.cat(attn_outputs, dim=-2)
 
     def forward(
         self,
@@ -372,6 +405,7 @@ class DogeInnerFuncAttn(nn.Module):
         past_key_value: Optional[Cache] = None,
         cache_position: Optional[torch.LongTensor] = None,
         position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        cu_seqlens: Optional[List[int]] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional[Cache]]:
         bsz, q_len, _ = hidden_states.shape
@@ -398,20 +432,13 @@ class DogeInnerFuncAttn(nn.Module):
             cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        # compute attention scores matrix
-        attn_weights = torch.matmul(query_states, key_states.transpose(-1, -2)) / math.sqrt(self.attention_head_dim)
-
-        # add mask to attention scores
-        causal_mask = self._update_causal_mask(attention_mask, hidden_states, cache_position, past_key_value)
-        causal_mask = causal_mask[:, :, :, : key_states.shape[-2]]
-        attn_weights = attn_weights + causal_mask
-
-        # upcast attention to fp32
-        attn_weights = F.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
-        attn_weights = F.dropout(attn_weights, p=self.attention_dropout, training=self.training)
-       
-        # apply attention scores to value states
-        attn_output = torch.matmul(attn_weights, value_states)
+        if cu_seqlens is not None:
+            attn_output = self.attend_segments(query_states, key_states, value_states, position_ids, cu_seqlens)
+        else:
+            # without cached keys the keys are the queries, the dynamic mask follows their positions
+            key_positions = position_ids if key_states.shape[-2] == q_len else None
+            causal_mask = self.prepare_attention_mask(attention_mask, key_states.shape[-2], key_positions)
+            attn_output = self.attend(query_states, key_states, value_states, causal_mask)
 
         attn_output = attn_output.transpose(1, 2).contiguous()
         attn_output = attn_output.reshape(bsz, q_len, -1)
@@ -436,6 +463,7 @@ class DogeSdpaInnerFuncAttn(DogeInnerFuncAttn):
         past_key_value: Optional[Cache] = None,
         cache_position: Optional[torch.LongTensor] = None,
         position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        cu_seqlens: Optional[List[int]] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional[Cache]]:
         bsz, q_len, _ = hidden_states.shape
@@ -456,20 +484,13 @@ class DogeSdpaInnerFuncAttn(DogeInnerFuncAttn):
             cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        causal_mask = self._update_causal_mask(attention_mask, hidden_states, cache_position, past_key_value)
-        causal_mask = causal_mask[:, :, :, : key_states.shape[-2]]
-
-        query_states = query_states.contiguous()
-        key_states = key_states.contiguous()
-        value_states = value_states.contiguous()
-
-        attn_output = F.scaled_dot_product_attention(
-            query_states,
-            key_states,
-            value_states,
-            attn_mask=causal_mask,
-            dropout_p=self.attention_dropout,
-        )
+        if cu_seqlens is not None:
+            attn_output = self.attend_segments(query_states, key_states, value_states, position_ids, cu_seqlens)
+        else:
+            # without cached keys the keys are the queries, the dynamic mask follows their positions
+            key_positions = position_ids if key_states.shape[-2] == q_len else None
+            causal_mask = self.prepare_attention_mask(attention_mask, key_states.shape[-2], key_positions)
+            attn_output = self.attend(query_states, key_states, value_states, causal_mask)
 
         attn_output = attn_output.transpose(1, 2).contiguous()
         attn_output = attn_output.view(bsz, q_len, -1)
@@ -477,6 +498,21 @@ class DogeSdpaInnerFuncAttn(DogeInnerFuncAttn):
 
         return attn_output, past_key_value
 
+    def attend(
+        self,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+    ) -> torch.Tensor:
+        return F.scaled_dot_product_attention(
+            query_states.contiguous(),
+            key_states.contiguous(),
+            value_states.contiguous(),
+            attn_mask=attention_mask,
+            dropout_p=self.attention_dropout,
+        )
+
 
 DOGE_ATTENTION_CLASSES = {
     "eager": DogeInnerFuncAttn,
@@ -551,7 +587,8 @@ class DogeCDMoE(nn.Module):
 
         # get expert scores and indices with the highest similarity
         (scores_x, scores_y), (indices_x, indices_y) = sim.topk(self.num_cdmmoe_experts_per_head, dim=-1)
-        if einx_add is not None:
+        if is_einx_available:
+            einx_add = _get_einx_add()
             all_scores = einx_add("... i, ... j -> ... (i j)", scores_x, scores_y)
             all_indices = einx_add("... i, ... j -> ... (i j)", indices_x * self.num_keys, indices_y)
         else:
@@ -596,14 +633,15 @@ class DogeDecoderLayer(nn.Module):
         use_cache: Optional[bool] = False,
         cache_position: Optional[torch.LongTensor] = None,
         position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        cu_seqlens: Optional[List[int]] = None,
         **kwargs,
     ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
         """
         Args:
             hidden_states (`torch.FloatTensor`): input to the layer of shape `(batch, seq_len, embed_dim)`
-            attention_mask (`torch.FloatTensor`, *optional*):
-                attention mask of size `(batch_size, sequence_length)` if flash attention is used or `(batch_size, 1,
-                query_sequence_length, key_sequence_length)` if default attention is used.
+            attention_mask (`torch.BoolTensor` or `torch.FloatTensor`, *optional*):
+                attention mask of size `(batch_size, 1, query_sequence_length, key_sequence_length)`, boolean with
+                `True` where a query attends to a key, or additive.
             output_attentions (`bool`, *optional*):
                 Whether or not to return the attentions tensors of all attention layers. See `attentions` under
                 returned tensors for more detail.
@@ -616,6 +654,8 @@ class DogeDecoderLayer(nn.Module):
             position_embeddings (`Tuple[torch.FloatTensor, torch.FloatTensor]`, *optional*):
                 Tuple containing the cosine and sine positional embeddings of shape `(batch_size, seq_len, head_dim)`,
                 with `head_dim` being the embedding dimension of each attention head.
+            cu_seqlens (`List[int]`, *optional*):
+                Offsets of the samples packed in every row, each sample only attends to itself.
             kwargs (`dict`, *optional*):
                 Arbitrary kwargs to be ignored, used for FSDP and other methods that injects code
                 into the model
@@ -631,6 +671,7 @@ class DogeDecoderLayer(nn.Module):
             past_key_value=past_key_value,
             cache_position=cache_position,
             position_embeddings=position_embeddings,
+            cu_seqlens=cu_seqlens,
             **kwargs,
         )
         self_attn_weights = None
@@ -751,6 +792,10 @@ DOGE_INPUTS_DOCSTRING = r"""
             Indices depicting the position of the input sequence tokens in the sequence. Contrarily to `position_ids`,
             this tensor is not affected by padding. It is used to update the cache in the correct position and to infer
             the complete sequence length.
+        cu_seqlens (`torch.LongTensor` of shape `(num_samples + 1,)`, *optional*):
+            Offsets of several samples packed into every row, e.g. by [`DogeForCausalVLM.pack_inputs`]. Each sample
+            only attends to itself, with its own causal and dynamic mask, and its positions restart at 0 unless
+            `position_ids` are given. Replaces `attention_mask` and cannot be used with a cache.
 """
 
 
@@ -784,14 +829,21 @@ class DogeModel(DogePreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         cache_position: Optional[torch.LongTensor] = None,
+        cu_seqlens: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         )
-        use_cache = use_cache if use_cache is not None else self.config.use_cache
+        use_cache = use_cache if use_cache is not None else self.config.use_cache and cu_seqlens is None
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
+        if cu_seqlens is not None and (use_cache or past_key_values is not None or attention_mask is not None):
+            raise ValueError(
+                "Packed samples with `cu_seqlens` are masked per sample and cannot be cached, pass `use_cache=False` "
+                "and no `past_key_values` or `attention_mask`."
+            )
+
         if self.gradient_checkpointing and self.training and use_cache:
             logger.warning_once(
                 "`use_cache=True` is incompatible with gradient checkpointing. Setting `use_cache=False`..."
@@ -819,15 +871,35 @@ class DogeModel(DogePreTrainedModel):
                 past_seen_tokens + inputs_embeds.shape[1],
                 device=inputs_embeds.device,
             )
-        if position_ids is None:
+        custom_position_ids = position_ids is not None
+        if position_ids is None and cu_seqlens is not None:
+            # the positions restart at every packed sample
+            sample_starts = cu_seqlens[:-1].repeat_interleave(cu_seqlens.diff())
+            position_ids = (cache_position - sample_starts).unsqueeze(0)
+        elif position_ids is None:
             position_ids = cache_position.unsqueeze(0)
 
-        # causal_mask = self._update_causal_mask(
-        #     attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions
-        # )
+        if cu_seqlens is not None:
+            # every layer masks each sample on its own, the offsets are read on the host once for all of them
+            causal_mask = None
+            cu_seqlens = cu_seqlens.tolist()
+        else:
+            # the causal and padding mask is built once and shared by every layer, each layer only adds its dynamic mask
+            causal_mask = self._update_causal_mask(attention_mask, inputs_embeds, cache_position, past_key_values)
         hidden_states = inputs_embeds
 
         # create position embeddings to be shared across the decoder layers
+        # size the cos and sin table on the host from the cache length, `position_ids` are only read when given
+        if isinstance(past_key_values, StaticCache):
+            # once for the whole static cache, so decoding never reallocates it
+            self.rotary_emb.extend_cos_sin_cache(past_key_values.get_max_cache_shape())
+        else:
+            past_seen_tokens = past_key_values.get_seq_length() if isinstance(past_key_values, Cache) else 0
+            rope_len = past_seen_tokens + inputs_embeds.shape[1]
+            if custom_position_ids and position_ids.numel() > 0:
+                # position ids of the caller, e.g. shifted or packed, may run past the cached plus new length
+                rope_len = max(rope_len, int(position_ids.max()) + 1)
+            self.rotary_emb.extend_cos_sin_cache(rope_len)
         position_embeddings = self.rotary_emb(hidden_states, position_ids)
 
         # decoder layers
@@ -842,24 +914,26 @@ class DogeModel(DogePreTrainedModel):
                 layer_outputs = self._gradient_checkpointing_func(
                     decoder_layer.__call__,
                     hidden_states,
-                    attention_mask,
+                    causal_mask,
                     position_ids,
                     past_key_values,
                     output_attentions,
                     use_cache,
                     cache_position,
                     position_embeddings,
+                    cu_seqlens,
                 )
             else:
                 layer_outputs = decoder_layer(
                     hidden_states,
-                    attention_mask=attention_mask,
+                    attention_mask=causal_mask,
                     position_ids=position_ids,
                     past_key_value=past_key_values,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
                     cache_position=cache_position,
                     position_embeddings=position_embeddings,
+                    cu_seqlens=cu_seqlens,
                 )
 
             hidden_states = layer_outputs[0]
@@ -890,106 +964,52 @@ class DogeModel(DogePreTrainedModel):
             attentions=all_self_attns,
         )
 
-    """Move to DogeInnerFuncAttn"""
-    # def _update_causal_mask(
-    #     self,
-    #     attention_mask: torch.Tensor,
-    #     input_tensor: torch.Tensor,
-    #     cache_position: torch.Tensor,
-    #     past_key_values: Cache,
-    #     output_attentions: bool,
-    # ):
-    #     # For SDPA, when possible, we will rely on its `is_causal` argument instead of its `attn_mask` argument, in
-    #     # order to dispatch on Flash Attention 2. This feature is not compatible with static cache, as SDPA will fail
-    #     # to infer the attention mask.
-    #     past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
-    #     using_static_cache = isinstance(past_key_values, StaticCache)
-
-    #     dtype, device = input_tensor.dtype, input_tensor.device
-    #     sequence_length = input_tensor.shape[1]
-    #     if using_static_cache:
-    #         target_length = past_key_values.get_max_cache_shape()
-    #     else:
-    #         target_length = (
-    #             attention_mask.shape[-1]
-    #             if isinstance(attention_mask, torch.Tensor)
-    #             else past_seen_tokens + sequence_length + 1
-    #         )
-
-    #     # In case the provided `attention` mask is 2D, we generate a causal mask here (4D).
-    #     causal_mask = self._prepare_4d_causal_attention_mask_with_cache_position(
-    #         attention_mask,
-    #         sequence_length=sequence_length,
-    #         target_length=target_length,
-    #         dtype=dtype,
-    #         device=device,
-    #         cache_position=cache_position,
-    #         batch_size=input_tensor.shape[0],
-    #     )
-
-    #     return causal_mask
-
-    # @staticmethod
-    # def _prepare_4d_causal_attention_mask_with_cache_position(
-    #     attention_mask: torch.Tensor,
-    #     sequence_length: int,
-    #     target_length: int,
-    #     dtype: torch.dtype,
-    #     device: torch.device,
-    #     cache_position: torch.Tensor,
-    #     batch_size: int,
-    #     **kwargs,
-    # ):
-    #     """
-    #     Creates a causal 4D mask of shape `(batch_size, 1, query_length, key_value_length)` from a 2D mask of shape
-    #     `(batch_size, key_value_length)`, or if the input `attention_mask` is already 4D, do nothing.
-
-    #     Args:
-    #         attention_mask (`torch.Tensor`):
-    #             A 2D attention mask of shape `(batch_size, key_value_length)` or a 4D attention mask of shape
-    #             `(batch_size, 1, query_length, key_value_length)`.
-    #         sequence_length (`int`):
-    #             The sequence length being processed.
-    #         target_length (`int`):
-    #             The target length: when generating with static cache, the mask should be as long as the static cache,
-    #             to account for the 0 padding, the part of the cache that is not filled yet.
-    #         dtype (`torch.dtype`):
-    #             The dtype to use for the 4D attention mask.
-    #         device (`torch.device`):
-    #             The device to plcae the 4D attention mask on.
-    #         cache_position (`torch.Tensor`):
-    #             Indices depicting the position of the input sequence tokens in the sequence.
-    #         batch_size (`torch.Tensor`):
-    #             Batch size.
-    #     """
-    #     if attention_mask is not None and attention_mask.dim() == 4:
-    #         # In this case we assume that the mask comes already in inverted form and requires no inversion or slicing.
-    #         causal_mask = attention_mask
-    #     else:
-    #         min_dtype = torch.finfo(dtype).min
-    #         causal_mask = torch.full(
-    #             (sequence_length, target_length), fill_value=min_dtype, dtype=dtype, device=device
-    #         )
-    #         if sequence_length != 1:
-    #             causal_mask = torch.triu(causal_mask, diagonal=1)
-    #         causal_mask *= torch.arange(target_length, device=device) > cache_position.reshape(-1, 1)
-    #         causal_mask = causal_mask[None, None, :, :].expand(batch_size, 1, -1, -1)
-    #         if attention_mask is not None:
-    #             causal_mask = causal_mask.clone()  # copy to contiguous memory for in-place edit
-    #             mask_length = attention_mask.shape[-1]
-    #             padding_mask = causal_mask[:, :, :, :mask_length] + attention_mask[:, None, None, :]
-    #             padding_mask = padding_mask == 0
-    #             causal_mask[:, :, :, :mask_length] = causal_mask[:, :, :, :mask_length].masked_fill(
-    #                 padding_mask, min_dtype
-    #             )
-
-    #     return causal_mask
+    def _update_causal_mask(
+        self,
+        attention_mask: torch.Tensor,
+        input_tensor: torch.Tensor,
+        cache_position: torch.Tensor,
+        past_key_values: Cache,
+    ) -> torch.Tensor:
+        """
+        Build the boolean mask shared by every layer of shape `(batch_size, 1, query_length, key_value_length)`,
+        `True` where a query attends to a key, from a 2D padding mask or none. A 4D mask is returned as it is.
+
+        A boolean mask takes a quarter of the memory of a float mask, and it is built once per forward instead of
+        once per layer. SDPA returns NaN for a row without any key, so the rows of the padding queries attend to
+        every key, their outputs are never attended to.
+        """
+        if attention_mask is not None and attention_mask.dim() == 4:
+            return attention_mask
+
+        past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
+        device = input_tensor.device
+        batch_size, sequence_length = input_tensor.shape[:2]
+        if isinstance(past_key_values, StaticCache):
+            target_length = past_key_values.get_max_cache_shape()
+        elif attention_mask is not None:
+            target_length = attention_mask.shape[-1]
+        else:
+            target_length = past_seen_tokens + sequence_length + 1
+
+        causal_mask = torch.arange(target_length, device=device) <= cache_position.reshape(-1, 1)
+        causal_mask = causal_mask[None, None, :, :].expand(batch_size, 1, -1, -1)
+        if attention_mask is not None:
+            causal_mask = causal_mask.clone()  # copy to contiguous memory for in-place edit
+            mask_length = attention_mask.shape[-1]
+            causal_mask[:, :, :, :mask_length] &= attention_mask[:, None, None, :].bool()
+            if self.config._attn_implementation == "sdpa":
+                causal_mask |= ~causal_mask.any(dim=-1, keepdim=True)
+        return causal_mask
 
 
 class DogePatchEmbedding(nn.Module):
     """
     This class turns `pixel_values` of shape `(batch_size, num_channels, height, width)` into the initial
-    `hidden_states` of shape `(batch_size, 1, hidden_size)` to be consumed by a Transformer.
+    `hidden_states` of shape `(batch_size, num_patches, hidden_size)` to be consumed by a Transformer.
+
+    Images of any size are accepted, their bottom and right edges are zero padded to a multiple of the patch size
+    instead of being resized to `config.image_size`.
     """
 
     def __init__(self, config: DogeConfig):
@@ -1007,6 +1027,32 @@ class DogePatchEmbedding(nn.Module):
 
         self.proj = nn.Conv2d(num_channels, self.hidden_size, kernel_size=patch_size, stride=patch_size)
 
+    def patch_grid(self, height: int, width: int) -> Tuple[int, int]:
+        """Number of patches along the height and the width of an image, after padding."""
+        return -(-height // self.patch_size[0]), -(-width // self.patch_size[1])
+
+    def pad_to_patch_multiple(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        height, width = pixel_values.shape[-2:]
+        pad_height = -height % self.patch_size[0]
+        pad_width = -width % self.patch_size[1]
+        if pad_height or pad_width:
+            pixel_values = F.pad(pixel_values, (0, pad_width, 0, pad_height))
+        return pixel_values
+
+    def fit_to_max_patches(self, image: torch.Tensor, max_num_patches: int) -> torch.Tensor:
+        """
+        Downscale an image of shape `(num_channels, height, width)` that has more than `max_num_patches` patches,
+        keeping its aspect ratio, smaller images are returned as they are.
+        """
+        height, width = image.shape[-2:]
+        grid_height, grid_width = self.patch_grid(height, width)
+        if grid_height * grid_width <= max_num_patches:
+            return image
+        scale = math.sqrt(max_num_patches / (grid_height * grid_width))
+        new_height = max(int(height * scale) // self.patch_size[0] * self.patch_size[0], self.patch_size[0])
+        new_width = max(int(width * scale) // self.patch_size[1] * self.patch_size[1], self.patch_size[1])
+        return F.interpolate(image[None], size=(new_height, new_width), mode="bilinear", align_corners=False)[0]
+
     def forward(
         self,
         pixel_values: torch.Tensor,
@@ -1016,15 +1062,63 @@ class DogePatchEmbedding(nn.Module):
             raise ValueError(
                 f"Input image should have {self.num_channels} number of channels, but got {num_channels} instead."
             )
-        
-        if height != self.image_size[0] or width != self.image_size[1]:
-            raise ValueError(
-                f"Input image should have size {self.image_size}, but got {height}*{width} instead."
-            )
-        
+
+        pixel_values = self.pad_to_patch_multiple(pixel_values)
         image_embedding = self.proj(pixel_values).flatten(2).transpose(1, 2)
         return image_embedding
 
+    def embed_images(
+        self,
+        images: List[torch.Tensor],
+        max_num_patches: Optional[int] = None,
+    ) -> List[torch.Tensor]:
+        """
+        Embed images of different sizes, each of shape `(num_channels, height, width)`, and return their patch
+        embeddings of shape `(num_patches, hidden_size)`.
+
+        The images are bucketed by their patch grid, which follows their aspect ratio, and every bucket is embedded
+        with one batched convolution, so no image is resized to a common resolution or padded by more than a patch.
+
+        Args:
+            images (`List[torch.Tensor]`):
+                The images, of any height and width.
+            max_num_patches (`int`, *optional*):
+                Downscale the images with more patches to this budget, keeping their aspect ratio.
+        """
+        if max_num_patches is not None:
+            images = [self.fit_to_max_patches(image, max_num_patches) for image in images]
+        buckets = defaultdict(list)
+        for image_idx, image in enumerate(images):
+            buckets[self.patch_grid(*image.shape[-2:])].append(image_idx)
+
+        image_embeddings = [None] * len(images)
+        for image_indices in buckets.values():
+            pixel_values = torch.stack([self.pad_to_patch_multiple(images[image_idx]) for image_idx in image_indices])
+            for image_idx, image_embedding in zip(image_indices, self(pixel_values)):
+                image_embeddings[image_idx] = image_embedding
+        return image_embeddings
+
+
+@dataclass
+class DogePackedVisionInputs(ModelOutput):
+    """
+    Text and images of several samples packed into a single row by [`DogeForCausalVLM.pack_inputs`], to be passed to
+    [`DogeForCausalVLM.forward`] as keyword arguments.
+
+    Args:
+        inputs_embeds (`torch.FloatTensor` of shape `(1, total_length, hidden_size)`):
+            The text embeddings of every sample followed by the patch embeddings of its images.
+        position_ids (`torch.LongTensor` of shape `(1, total_length)`):
+            Positions restarting at 0 at every sample.
+        cu_seqlens (`torch.LongTensor` of shape `(num_samples + 1,)`):
+            Offsets of the samples in the row. Every layer attends within each sample only, and they split the logits
+            per sample.
+    """
+
+    inputs_embeds: torch.FloatTensor = None
+    position_ids: torch.LongTensor = None
+    cu_seqlens: torch.LongTensor = None
+
 
 class DogeForCausalVLM(DogePreTrainedModel, GenerationMixin):
     _tied_weights_keys = ["lm_head.weight"]
@@ -1059,6 +1153,57 @@ class DogeForCausalVLM(DogePreTrainedModel, GenerationMixin):
     def get_decoder(self):
         return self.model
 
+    def pack_inputs(
+        self,
+        input_ids: List[torch.LongTensor],
+        images: List[List[torch.Tensor]],
+        max_num_patches: Optional[int] = None,
+    ) -> DogePackedVisionInputs:
+        """
+        Pack samples with any number of images of any size into a single row without padding, for batched
+        inference. Every sample is its text followed by the patches of its images, like `forward` lays out
+        `input_ids` and `pixel_values`.
+
+        The positions restart at every sample and `cu_seqlens` marks where each sample starts, so every sample gets the
+        same RoPE positions and attention as if it was run alone. Every layer attends within each sample with its
+        causal mask and its dynamic mask gathered by these positions, so no mask of the whole row is built and the
+        row can be longer than `max_position_embeddings` as long as every sample fits in it.
+
+        Args:
+            input_ids (`List[torch.LongTensor]`):
+                The unpadded token ids of every sample, of shape `(sequence_length,)`.
+            images (`List[List[torch.Tensor]]`):
+                The images of every sample, of shape `(num_channels, height, width)`, possibly none.
+            max_num_patches (`int`, *optional*):
+                Downscale the images with more patches to this budget, keeping their aspect ratio.
+
+        Example:
+
+        ```python
+        >>> packed = model.pack_inputs(input_ids, images)
+        >>> logits = model(**packed, use_cache=False).logits
+        >>> logits_per_sample = logits[0].split(packed.cu_seqlens.diff().tolist())
+        ```
+        """
+        flat_images = [image for sample_images in images for image in sample_images]
+        image_embeddings = iter(self.pixel_embed.embed_images(flat_images, max_num_patches) if flat_images else [])
+        sample_embeddings = []
+        for sample_input_ids, sample_images in zip(input_ids, images):
+            embeddings = [self.word_embed(sample_input_ids)] + [next(image_embeddings) for _ in sample_images]
+            sample_embeddings.append(torch.cat(embeddings, dim=0))
+
+        inputs_embeds = torch.cat(sample_embeddings, dim=0)
+        device = inputs_embeds.device
+        seq_lens = torch.tensor([len(embeddings) for embeddings in sample_embeddings], device=device)
+        cu_seqlens = F.pad(seq_lens.cumsum(0), (1, 0))
+        positions = torch.arange(inputs_embeds.shape[0], device=device)
+        position_ids = positions - cu_seqlens[:-1].repeat_interleave(seq_lens)
+        return DogePackedVisionInputs(
+            inputs_embeds=inputs_embeds[None],
+            position_ids=position_ids[None],
+            cu_seqlens=cu_seqlens,
+        )
+
     @add_start_docstrings_to_model_forward(DOGE_INPUTS_DOCSTRING)
     @replace_return_docstrings(output_type=CausalLMOutputWithPast, config_class=_CONFIG_FOR_DOC)
     def forward(
@@ -1076,10 +1221,15 @@ class DogeForCausalVLM(DogePreTrainedModel, GenerationMixin):
         return_dict: Optional[bool] = None,
         cache_position: Optional[torch.LongTensor] = None,
         num_logits_to_keep: int = 0,
+        cu_seqlens: Optional[torch.LongTensor] = None,
         **loss_kwargs,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
+            pixel_values (`torch.FloatTensor` of shape `(batch_size, [num_images,] num_channels, height, width)`, *optional*):
+                The images of every row, their patches are appended to the text in order. Samples with different
+                numbers or sizes of images are packed by [`~DogeForCausalVLM.pack_inputs`] instead.
+
             labels (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
                 Labels for computing the masked language modeling loss. Indices should either be in `[0, ...,
                 config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
@@ -1100,7 +1250,13 @@ class DogeForCausalVLM(DogePreTrainedModel, GenerationMixin):
 
         if input_ids is not None:
             inputs_embeds = self.word_embed(input_ids)
-        if pixel_values is not None:
+        if pixel_values is not None and pixel_values.dim() == 5:
+            # every image of a row is embedded in one batch, then their patches are laid out one image after another
+            batch_size, num_images = pixel_values.shape[:2]
+            pixel_embeds = self.pixel_embed(pixel_values.flatten(0, 1))
+            pixel_embeds = pixel_embeds.reshape(batch_size, num_images * pixel_embeds.shape[1], -1)
+            inputs_embeds = torch.cat([inputs_embeds, pixel_embeds], dim=1)
+        elif pixel_values is not None:
             pixel_embeds = self.pixel_embed(pixel_values)
             inputs_embeds = torch.cat([inputs_embeds, pixel_embeds], dim=1)
 
@@ -1115,6 +1271,7 @@ class DogeForCausalVLM(DogePreTrainedModel, GenerationMixin):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             cache_position=cache_position,
+            cu_seqlens=cu_seqlens,
         )
 
         hidden_states = outputs[0]
@@ -20,7 +20,8 @@
 
 import math
 from dataclasses import dataclass, field
-from typing import Optional, Tuple, Union, Any, Dict, List
+from functools import lru_cache
+from typing import Optional, Tuple, Union, Any, Dict, Iterator, List
 
 import torch
 import torch.nn.functional as F
@@ -45,23 +46,25 @@ from transformers.utils import (
 )
 from transformers.utils.import_utils import is_mamba_2_ssm_available
 from .configuration_cheems import CheemsConfig
-
-try:
-    from einx import add as einx_add
-except ImportError:
-    einx_add = None
-
+from ..modules.residual_norm import fused_residual_rms_norm
+from ..modules.cdmoe import _get_einx_add, is_einx_available
 
 logger = logging.get_logger(__name__)
 
 
-if is_mamba_2_ssm_available():
+@lru_cache
+def load_ssd_kernels():
+    """
+    Import the mamba_ssm Triton kernels of the SSD layers on first use, importing them is slow and needs CUDA.
+    """
+    if not is_mamba_2_ssm_available():
+        raise ImportError(
+            "The SSD layers of Cheems require `mamba_ssm` and a CUDA device, install it with `pip install mamba-ssm`."
+        )
     from mamba_ssm.ops.triton.selective_state_update import selective_state_update
-    from mamba_ssm.ops.triton.ssd_combined import mamba_chunk_scan_combined, mamba_split_conv1d_scan_combined
-else:
-    selective_state_update = None
+    from mamba_ssm.ops.triton.ssd_combined import mamba_chunk_scan_combined
 
-is_fast_path_available = all((selective_state_update, mamba_chunk_scan_combined, mamba_split_conv1d_scan_combined))
+    return selective_state_update, mamba_chunk_scan_combined
 
 _CONFIG_FOR_DOC = "CheemsConfig"
 
@@ -96,7 +99,7 @@ class Residual(nn.Module):
 
     def extra_repr(self):
         return f"{tuple(self.weight.shape)}"
-    
+
 
 class RotaryEmbedding(nn.Module):
     def __init__(self, config: Optional[CheemsConfig] = None):
@@ -106,7 +109,7 @@ class RotaryEmbedding(nn.Module):
         if config.rope_scaling is None:
             self.rope_type = "default"
         else:
-            self.rope_type = config.rope_scaling
+            self.rope_type = config.rope_scaling.get("rope_type", config.rope_scaling.get("type"))
         self.max_seq_len_cached = config.max_position_embeddings
         self.original_max_seq_len = config.max_position_embeddings
         self.base = config.rope_theta
@@ -118,6 +121,42 @@ class RotaryEmbedding(nn.Module):
         self.register_buffer("inv_freq", inv_freq, persistent=False)
         self.original_inv_freq = self.inv_freq
 
+        # cos and sin table indexed by position ids, grows geometrically beyond `max_position_embeddings`
+        self._set_cos_sin_cache(config.max_position_embeddings, device=inv_freq.device)
+
+    def _compute_cos_sin(self, position_ids, device_type):
+        # core RoPE block
+        inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
+        position_ids_expanded = position_ids[:, None, :].float()
+        device_type = device_type if isinstance(device_type, str) and device_type != "mps" else "cpu"
+        with torch.autocast(device_type=device_type, enabled=False):
+            freqs = (inv_freq_expanded.float() @ position_ids_expanded.float()).transpose(1, 2)
+            emb = torch.cat((freqs, freqs), dim=-1)
+            cos = emb.cos()
+            sin = emb.sin()
+
+        cos = cos * self.attention_scaling
+        sin = sin * self.attention_scaling
+        return cos, sin
+
+    def _set_cos_sin_cache(self, seq_len, device):
+        position_ids = torch.arange(seq_len, device=device)[None, :]
+        cos, sin = self._compute_cos_sin(position_ids, torch.device(device).type)
+        self.register_buffer("cos_cached", cos[0], persistent=False)
+        self.register_buffer("sin_cached", sin[0], persistent=False)
+        self.cos_sin_cache_len = seq_len
+
+    def extend_cos_sin_cache(self, seq_len):
+        """
+        Make sure the cos and sin table covers `seq_len` positions, doubling its length as needed. The model calls it
+        with the cached plus new length, or past the largest of the `position_ids` it is given.
+        """
+        if seq_len > self.cos_sin_cache_len:
+            new_len = self.cos_sin_cache_len
+            while new_len < seq_len:
+                new_len *= 2
+            self._set_cos_sin_cache(new_len, device=self.inv_freq.device)
+
     def _dynamic_frequency_update(self, position_ids, device):
         """
         dynamic RoPE layers should recompute `inv_freq` in the following situations:
@@ -141,19 +180,13 @@ class RotaryEmbedding(nn.Module):
         if "dynamic" in self.rope_type:
             self._dynamic_frequency_update(position_ids, device=x.device)
 
-        # core RoPE block
-        inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
-        position_ids_expanded = position_ids[:, None, :].float()
-        device_type = x.device.type
-        device_type = device_type if isinstance(device_type, str) and device_type != "mps" else "cpu"
-        with torch.autocast(device_type=device_type, enabled=False):
-            freqs = (inv_freq_expanded.float() @ position_ids_expanded.float()).transpose(1, 2)
-            emb = torch.cat((freqs, freqs), dim=-1)
-            cos = emb.cos()
-            sin = emb.sin()
-
-        cos = cos * self.attention_scaling
-        sin = sin * self.attention_scaling
+        if self.max_seq_len_cached > self.original_max_seq_len:
+            # the scaled `inv_freq` of dynamic RoPE depends on the exact sequence length, so it is not cached
+            cos, sin = self._compute_cos_sin(position_ids, x.device.type)
+        else:
+            # the model sizes the table on the host beforehand, reading `position_ids` here would synchronize
+            cos = self.cos_cached[position_ids]
+            sin = self.sin_cached[position_ids]
 
         return cos.to(dtype=x.dtype), sin.to(dtype=x.dtype)
 
@@ -213,10 +246,30 @@ class HybridSSDAttnDynamicCache(DynamicCache):
 
     For ssd layers, `key_cache` and `value_cache` have a shape of `(batch_size, 0)` (empty tensors),
     while `ssm_states` represents the ssm state and has a shape of `(batch_size, num_ssd_heads, ssd_head_dim, ssd_state_size)`.
+
+    The ssd states can not be truncated, so [`~HybridSSDAttnDynamicCache.checkpoint`] saves a copy of them at the
+    current position and [`~HybridSSDAttnDynamicCache.crop`] rolls the cache back to a checkpointed position.
+
+    With `block_size` set, the keys and values of every attn layer live in a buffer allocated in blocks of
+    `block_size` tokens, and `key_cache`/`value_cache` are views of its filled part. Every row keeps a table with the
+    id of the content of each of its blocks, the rows holding the same id hold the same tokens.
+    [`~HybridSSDAttnDynamicCache.reorder_cache`] only composes the beam parents of every layer, and the next update
+    of the layer copies the blocks whose id differs from the one of the parent. Beams share the blocks of the prompt
+    and of their common history, so a beam step copies the last blocks of the beams that switched parent instead of
+    their whole rows. `block_size=None` concatenates the keys and values and reorders them with `index_select`.
     """
-    def __init__(self, config: CheemsConfig, batch_size, dtype=torch.float16, device=None, layer_type=None):
+    def __init__(
+        self,
+        config: CheemsConfig,
+        batch_size,
+        dtype=torch.float16,
+        device=None,
+        layer_type=None,
+        block_size: Optional[int] = 64,
+    ):
         self.dtype = dtype
         self.layer_type = layer_type
+        self.block_size = block_size
 
         self.has_previous_state = False  # only used by ssd
         self.ssd_head_dim = config.hidden_size // config.num_attention_heads
@@ -240,10 +293,116 @@ class HybridSSDAttnDynamicCache(DynamicCache):
             else:
                 self.ssd_states += [torch.tensor([[]] * batch_size, device=device, dtype=dtype)]
         self.ssd_past_length = [0 for _ in range(config.num_hidden_layers)]
+        # copies of the ssd states keyed by the sequence length they were saved at
+        self.ssd_checkpoints: Dict[int, List[torch.Tensor]] = {}
         
         self.key_cache = [torch.tensor([[]] * batch_size, device=device, dtype=dtype) for _ in range(config.num_hidden_layers)]
         self.value_cache = [torch.tensor([[]] * batch_size, device=device, dtype=dtype) for _ in range(config.num_hidden_layers)]
-    
+
+        # block buffers of the attn layers, the content id of every block of every row, and the beam parents not
+        # applied to the buffers yet, `None` until the layer is updated with `block_size` set
+        self.key_buffers: List[Optional[torch.Tensor]] = [None for _ in range(config.num_hidden_layers)]
+        self.value_buffers: List[Optional[torch.Tensor]] = [None for _ in range(config.num_hidden_layers)]
+        self.block_ids: List[Optional[torch.LongTensor]] = [None for _ in range(config.num_hidden_layers)]
+        self.beam_parents: List[Optional[torch.LongTensor]] = [None for _ in range(config.num_hidden_layers)]
+        self.next_block_id = 0
+
+    def _materialize(self, layer_idx: int):
+        """Copy into the buffers of the layer `layer_idx` the blocks whose id differs from the one of their parent."""
+        parents = self.beam_parents[layer_idx]
+        if parents is None:
+            return
+        self.beam_parents[layer_idx] = None
+        num_blocks = -(-self.key_cache[layer_idx].shape[-2] // self.block_size)
+        block_ids = self.block_ids[layer_idx]
+        parent_block_ids = block_ids[parents, :num_blocks]
+        rows, blocks = (parent_block_ids != block_ids[:, :num_blocks]).nonzero(as_tuple=True)
+        if rows.numel() > 0:
+            for buffer in (self.key_buffers[layer_idx], self.value_buffers[layer_idx]):
+                bsz, num_heads, capacity, head_dim = buffer.shape
+                buffer = buffer.view(bsz, num_heads, capacity // self.block_size, self.block_size, head_dim)
+                # the right hand side is gathered before the assignment, so swapped beams read the old blocks
+                buffer[rows, :, blocks] = buffer[parents[rows], :, blocks]
+        block_ids[:, :num_blocks] = parent_block_ids
+
+    def materialize(self):
+        """Apply the pending beam reorders of every layer, e.g. before reading `key_cache` or `value_cache` directly."""
+        for layer_idx in range(len(self.key_cache)):
+            self._materialize(layer_idx)
+
+    def _new_block_ids(
+        self, layer_idx: int, key_states: torch.Tensor, value_states: torch.Tensor, seq_len: int
+    ) -> torch.LongTensor:
+        """
+        Ids of the blocks written by an update at `seq_len`. Every row gets new ids, except that a row takes the ids of
+        the previous row for the blocks that are equal in both, e.g. the prompt of the beams expanded by `generate`.
+        """
+        first_block = seq_len // self.block_size
+        end_block = -(-(seq_len + key_states.shape[-2]) // self.block_size)
+        bsz, num_blocks = key_states.shape[0], end_block - first_block
+        new_ids = torch.arange(bsz * num_blocks, device=key_states.device).view(bsz, num_blocks) + self.next_block_id
+        self.next_block_id += bsz * num_blocks
+        if bsz == 1:
+            return new_ids
+
+        # the written tokens equal to those of the previous row, padded to whole blocks
+        same_tokens = (key_states[1:] == key_states[:-1]).all(-1).all(1)
+        same_tokens &= (value_states[1:] == value_states[:-1]).all(-1).all(1)
+        start = seq_len - first_block * self.block_size
+        end = num_blocks * self.block_size - start - key_states.shape[-2]
+        same_tokens = F.pad(same_tokens, (start, end), value=True)
+        same_blocks = same_tokens.view(bsz - 1, num_blocks, self.block_size).all(-1)
+        # and the tokens the blocks already held before the update
+        old_ids = self.block_ids[layer_idx][:, first_block:end_block]
+        same_blocks &= old_ids[1:] == old_ids[:-1]
+        for row in range(1, bsz):
+            new_ids[row] = torch.where(same_blocks[row - 1], new_ids[row - 1], new_ids[row])
+        return new_ids
+
+    def _update_blocks(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        key_buffer, value_buffer = self.key_buffers[layer_idx], self.value_buffers[layer_idx]
+        seq_len = 0
+        if key_buffer is not None:
+            self._materialize(layer_idx)
+            seq_len = self.key_cache[layer_idx].shape[-2]
+        new_seq_len = seq_len + key_states.shape[-2]
+
+        if key_buffer is None or new_seq_len > key_buffer.shape[-2]:
+            # grow by whole blocks, at least doubling, so that a long generation copies the cache a logarithmic number
+            # of times
+            capacity = -(-new_seq_len // self.block_size) * self.block_size
+            if key_buffer is not None:
+                capacity = max(capacity, 2 * key_buffer.shape[-2])
+            bsz, num_heads, _, head_dim = key_states.shape
+            new_key_buffer = key_states.new_zeros(bsz, num_heads, capacity, head_dim)
+            new_value_buffer = value_states.new_zeros(bsz, num_heads, capacity, value_states.shape[-1])
+            # -1 for the blocks never written, which hold the same zeros in every row
+            new_block_ids = torch.full(
+                (bsz, capacity // self.block_size), -1, dtype=torch.long, device=key_states.device
+            )
+            if key_buffer is not None:
+                new_key_buffer[:, :, :seq_len] = key_buffer[:, :, :seq_len]
+                new_value_buffer[:, :, :seq_len] = value_buffer[:, :, :seq_len]
+                new_block_ids[:, : self.block_ids[layer_idx].shape[-1]] = self.block_ids[layer_idx]
+            key_buffer, value_buffer = new_key_buffer, new_value_buffer
+            self.key_buffers[layer_idx], self.value_buffers[layer_idx] = key_buffer, value_buffer
+            self.block_ids[layer_idx] = new_block_ids
+
+        first_block, end_block = seq_len // self.block_size, -(-new_seq_len // self.block_size)
+        self.block_ids[layer_idx][:, first_block:end_block] = self._new_block_ids(
+            layer_idx, key_states, value_states, seq_len
+        )
+        key_buffer[:, :, seq_len:new_seq_len] = key_states
+        value_buffer[:, :, seq_len:new_seq_len] = value_states
+        self.key_cache[layer_idx] = key_buffer[:, :, :new_seq_len]
+        self.value_cache[layer_idx] = value_buffer[:, :, :new_seq_len]
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
     def update(
         self,
         key_states: torch.Tensor,
@@ -251,6 +410,9 @@ class HybridSSDAttnDynamicCache(DynamicCache):
         layer_idx: int,
         cache_kwargs: Optional[Dict[str, Any]] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.block_size is not None:
+            return self._update_blocks(key_states, value_states, layer_idx)
+
         # Update the cache
         if self.key_cache[layer_idx].shape[-1] == 0:
             self.key_cache[layer_idx] = key_states
@@ -262,20 +424,81 @@ class HybridSSDAttnDynamicCache(DynamicCache):
         return self.key_cache[layer_idx], self.value_cache[layer_idx]
 
     def reorder_cache(self, beam_idx: torch.LongTensor):
-        """Reorders the cache for beam search, given the selected beam indices."""
+        """
+        Reorders the cache for beam search, given the selected beam indices. The attn layers with block buffers only
+        compose the beam parents, their blocks are copied by the next update, see [`HybridSSDAttnDynamicCache`].
+        """
         for layer_idx in range(len(self.key_cache)):
-            device = self.key_cache[layer_idx].device
-            self.key_cache[layer_idx] = self.key_cache[layer_idx].index_select(0, beam_idx.to(device))
-            device = self.value_cache[layer_idx].device
-            self.value_cache[layer_idx] = self.value_cache[layer_idx].index_select(0, beam_idx.to(device))
+            if self.key_buffers[layer_idx] is not None:
+                layer_beam_idx = beam_idx.to(self.key_buffers[layer_idx].device)
+                parents = self.beam_parents[layer_idx]
+                self.beam_parents[layer_idx] = layer_beam_idx if parents is None else parents[layer_beam_idx]
+            else:
+                device = self.key_cache[layer_idx].device
+                self.key_cache[layer_idx] = self.key_cache[layer_idx].index_select(0, beam_idx.to(device))
+                device = self.value_cache[layer_idx].device
+                self.value_cache[layer_idx] = self.value_cache[layer_idx].index_select(0, beam_idx.to(device))
             device = self.ssd_states[layer_idx].device
             self.ssd_states[layer_idx] = self.ssd_states[layer_idx].index_select(0, beam_idx.to(device))
-    
+        for ssd_states in self.ssd_checkpoints.values():
+            for layer_idx in range(len(ssd_states)):
+                device = ssd_states[layer_idx].device
+                ssd_states[layer_idx] = ssd_states[layer_idx].index_select(0, beam_idx.to(device))
+
+    def checkpoint(self) -> int:
+        """
+        Save a copy of the ssd states at the current sequence length, so that the cache can be cropped back to it.
+        Returns the checkpointed position.
+        """
+        position = self.get_seq_length()
+        self.ssd_checkpoints[position] = [ssd_state.clone() for ssd_state in self.ssd_states]
+        return position
+
+    def crop(self, max_length: int):
+        """
+        Crop the cache to `max_length` tokens, or drop the last `abs(max_length)` tokens if it is negative.
+
+        The attn layers truncate their keys and values, the ssd layers restore the states saved by
+        [`~HybridSSDAttnDynamicCache.checkpoint`] at exactly `max_length`. Checkpoints after `max_length` are dropped.
+        """
+        seq_length = self.get_seq_length()
+        if max_length < 0:
+            max_length = seq_length - abs(max_length)
+        if max_length >= seq_length:
+            return
+        has_ssd_states = any(ssd_state.shape[-1] != 0 for ssd_state in self.ssd_states)
+        if has_ssd_states and max_length > 0 and max_length not in self.ssd_checkpoints:
+            raise ValueError(
+                f"Cannot crop the ssd states to {max_length} tokens, checkpoints are only available at "
+                f"{sorted(self.ssd_checkpoints)}. Call `checkpoint()` at that position first."
+            )
+        self.materialize()
+
+        for layer_idx in range(len(self.key_cache)):
+            if self.key_cache[layer_idx].shape[-1] != 0:
+                self.key_cache[layer_idx] = self.key_cache[layer_idx][..., :max_length, :]
+                self.value_cache[layer_idx] = self.value_cache[layer_idx][..., :max_length, :]
+            if self.ssd_states[layer_idx].shape[-1] != 0:
+                # restore in place, the ssd layers update their states in place
+                if max_length == 0:
+                    self.ssd_states[layer_idx].zero_()
+                else:
+                    self.ssd_states[layer_idx].copy_(self.ssd_checkpoints[max_length][layer_idx])
+                self.ssd_past_length[layer_idx] = max_length
+        self.ssd_checkpoints = {
+            position: ssd_states for position, ssd_states in self.ssd_checkpoints.items() if position <= max_length
+        }
+        self.has_previous_state = max_length > 0
+
+    def clear_checkpoints(self):
+        """Drop all the saved ssd states."""
+        self.ssd_checkpoints = {}
+
     def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
         """Returns the sequence length of the cached states. A layer index can be optionally passed."""
         # take any layer that contains cache and not empty tensor
 
-        if self.layer_type[layer_idx] == 'ssd':
+        if self.layer_type is None or self.layer_type[layer_idx] == 'ssd':
             return self.ssd_past_length[layer_idx]
 
         if self.key_cache[layer_idx].shape[-1] == 0:
@@ -344,6 +567,7 @@ class CheemsSSD(nn.Module):
         position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **kwargs,
     ) -> torch.Tensor:
+        selective_state_update, mamba_chunk_scan_combined = load_ssd_kernels()
         bsz, c_len, _ = hidden_states.shape
         use_precomputed_states = (
             cache_params is not None
@@ -407,6 +631,11 @@ class CheemsSSD(nn.Module):
             cos, sin = position_embeddings
             c_states, b_states = apply_CB_rotary_pos_emb(c_states, b_states, cos, sin)
 
+            initial_states = None
+            if cache_params is not None and cache_params.ssd_past_length[self.layer_idx] > 0:
+                # continue from the states of the cached tokens, e.g. the previous chunk of a chunked prefill
+                initial_states = cache_params.ssd_states[self.layer_idx]
+
             ssd_output, ssd_state = mamba_chunk_scan_combined(
                 x_states,
                 dt_states,
@@ -415,6 +644,7 @@ class CheemsSSD(nn.Module):
                 c_states,
                 chunk_size=self.chunk_len,
                 z=None,
+                initial_states=initial_states,
                 seq_idx=None,
                 return_final_states=True,
                 dt_bias=None,
@@ -423,6 +653,8 @@ class CheemsSSD(nn.Module):
             if ssd_state is not None and cache_params is not None:
                 cache_params.ssd_states[self.layer_idx].copy_(ssd_state)
             ssd_output = ssd_output.view(bsz, c_len, -1)
+        if cache_params is not None:
+            cache_params.ssd_past_length[self.layer_idx] += c_len
         ssd_output = self.out_proj(ssd_output)
         return ssd_output
 
@@ -685,7 +917,8 @@ class CheemsCDMoE(CheemsMLP):
 
         # get experts with the highest similarity
         (scores_x, scores_y), (indices_x, indices_y) = sim.topk(self.num_cdmmoe_experts_per_head, dim=-1)
-        if einx_add is not None:
+        if is_einx_available:
+            einx_add = _get_einx_add()
             all_scores = einx_add("... i, ... j -> ... (i j)", scores_x, scores_y)
             all_indices = einx_add("... i, ... j -> ... (i j)", indices_x * self.num_keys, indices_y)
         else:
@@ -719,6 +952,7 @@ class CheemsSSDDecoderLayer(nn.Module):
         self.pre_state_layernorm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.feed_forward = CheemsMLP(config) if config.is_moe == False else CheemsCDMoE(config)
         self.post_state_residual = Residual(config.hidden_size)
+        self.compile_residual_norm = config.compile_residual_norm
 
     def forward(
         self,
@@ -730,6 +964,9 @@ class CheemsSSDDecoderLayer(nn.Module):
         use_cache: Optional[bool] = False,
         cache_position: Optional[torch.LongTensor] = None,
         position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        residual_states: Optional[torch.Tensor] = None,
+        previous_residual: Optional[nn.Module] = None,
+        defer_residual: Optional[bool] = False,
         **kwargs,
     ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
         """
@@ -750,14 +987,32 @@ class CheemsSSDDecoderLayer(nn.Module):
             position_embeddings (`Tuple[torch.FloatTensor, torch.FloatTensor]`, *optional*):
                 Tuple containing the cosine and sine positional embeddings of shape `(batch_size, seq_len, head_dim)`,
                 with `head_dim` being the embedding dimension of each attention head.
+            residual_states (`torch.FloatTensor`, *optional*):
+                residual states of the previous layer, when `hidden_states` is the output of its feed forward returned
+                with `defer_residual=True`. Their residual connection is fused with the input norm of this layer.
+            previous_residual (`Residual`, *optional*): `post_state_residual` of the previous layer
+            defer_residual (`bool`, *optional*):
+                Whether to return the output of the feed forward followed by the residual states instead of their
+                sum, so that the next layer or the final norm fuses the residual connection with its RMSNorm.
             kwargs (`dict`, *optional*):
                 Arbitrary kwargs to be ignored, used for FSDP and other methods that injects code
                 into the model
         """
 
-        # sequence transformation
-        residual = hidden_states
-        hidden_states = self.pre_sequence_layernorm(hidden_states)
+        # sequence transformation, fused with the residual of the previous layer when it was deferred
+        if residual_states is None:
+            residual = hidden_states
+            hidden_states = self.pre_sequence_layernorm(hidden_states)
+        else:
+            residual, hidden_states = fused_residual_rms_norm(
+                residual_states,
+                hidden_states,
+                previous_residual,
+                self.pre_sequence_layernorm,
+                dropout_p=self.hidden_dropout,
+                training=self.training,
+                use_compile=self.compile_residual_norm,
+            )
         hidden_states = self.ssd(
             hidden_states,
             attention_mask,
@@ -768,15 +1023,21 @@ class CheemsSSDDecoderLayer(nn.Module):
             **kwargs,
         )
         self_attn_weights = None
-        hidden_states = F.dropout(hidden_states, p=self.hidden_dropout, training=self.training)
-        hidden_states = self.post_sequence_residual(residual, hidden_states)
 
-        # state transformation
-        residual = hidden_states
-        hidden_states = self.pre_state_layernorm(hidden_states)
+        # state transformation, fused with the residual of the sequence transformation
+        residual, hidden_states = fused_residual_rms_norm(
+            residual,
+            hidden_states,
+            self.post_sequence_residual,
+            self.pre_state_layernorm,
+            dropout_p=self.hidden_dropout,
+            training=self.training,
+            use_compile=self.compile_residual_norm,
+        )
         hidden_states = self.feed_forward(hidden_states)
-        hidden_states = F.dropout(hidden_states, p=self.hidden_dropout, training=self.training)
-        hidden_states = self.post_state_residual(residual, hidden_states)
+        if not defer_residual:
+            hidden_states = F.dropout(hidden_states, p=self.hidden_dropout, training=self.training)
+            hidden_states = self.post_state_residual(residual, hidden_states)
 
         outputs = (hidden_states,)
 
@@ -786,6 +1047,9 @@ class CheemsSSDDecoderLayer(nn.Module):
         if use_cache:
             outputs += (past_key_value,)
 
+        if defer_residual:
+            outputs += (residual,)
+
         return outputs
 
 
@@ -801,6 +1065,7 @@ class CheemsAttnDecoderLayer(nn.Module):
         self.pre_state_layernorm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.feed_forward = CheemsMLP(config) if config.is_moe == False else CheemsCDMoE(config)
         self.post_state_residual = Residual(config.hidden_size)
+        self.compile_residual_norm = config.compile_residual_norm
 
     def forward(
         self,
@@ -812,6 +1077,9 @@ class CheemsAttnDecoderLayer(nn.Module):
         use_cache: Optional[bool] = False,
         cache_position: Optional[torch.LongTensor] = None,
         position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        residual_states: Optional[torch.Tensor] = None,
+        previous_residual: Optional[nn.Module] = None,
+        defer_residual: Optional[bool] = False,
         **kwargs,
     ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
         """
@@ -832,14 +1100,32 @@ class CheemsAttnDecoderLayer(nn.Module):
             position_embeddings (`Tuple[torch.FloatTensor, torch.FloatTensor]`, *optional*):
                 Tuple containing the cosine and sine positional embeddings of shape `(batch_size, seq_len, head_dim)`,
                 with `head_dim` being the embedding dimension of each attention head.
+            residual_states (`torch.FloatTensor`, *optional*):
+                residual states of the previous layer, when `hidden_states` is the output of its feed forward returned
+                with `defer_residual=True`. Their residual connection is fused with the input norm of this layer.
+            previous_residual (`Residual`, *optional*): `post_state_residual` of the previous layer
+            defer_residual (`bool`, *optional*):
+                Whether to return the output of the feed forward followed by the residual states instead of their
+                sum, so that the next layer or the final norm fuses the residual connection with its RMSNorm.
             kwargs (`dict`, *optional*):
                 Arbitrary kwargs to be ignored, used for FSDP and other methods that injects code
                 into the model
         """
 
-        # sequence transformation
-        residual = hidden_states
-        hidden_states = self.pre_sequence_layernorm(hidden_states)
+        # sequence transformation, fused with the residual of the previous layer when it was deferred
+        if residual_states is None:
+            residual = hidden_states
+            hidden_states = self.pre_sequence_layernorm(hidden_states)
+        else:
+            residual, hidden_states = fused_residual_rms_norm(
+                residual_states,
+                hidden_states,
+                previous_residual,
+                self.pre_sequence_layernorm,
+                dropout_p=self.hidden_dropout,
+                training=self.training,
+                use_compile=self.compile_residual_norm,
+            )
         hidden_states, present_key_value = self.attn(
             hidden_states,
             attention_mask,
@@ -850,15 +1136,21 @@ class CheemsAttnDecoderLayer(nn.Module):
             **kwargs,
         )
         self_attn_weights = None
-        hidden_states = F.dropout(hidden_states, p=self.hidden_dropout, training=self.training)
-        hidden_states = self.post_sequence_residual(residual, hidden_states)
 
-        # state transformation
-        residual = hidden_states
-        hidden_states = self.pre_state_layernorm(hidden_states)
+        # state transformation, fused with the residual of the sequence transformation
+        residual, hidden_states = fused_residual_rms_norm(
+            residual,
+            hidden_states,
+            self.post_sequence_residual,
+            self.pre_state_layernorm,
+            dropout_p=self.hidden_dropout,
+            training=self.training,
+            use_compile=self.compile_residual_norm,
+        )
         hidden_states = self.feed_forward(hidden_states)
-        hidden_states = F.dropout(hidden_states, p=self.hidden_dropout, training=self.training)
-        hidden_states = self.post_state_residual(residual, hidden_states)
+        if not defer_residual:
+            hidden_states = F.dropout(hidden_states, p=self.hidden_dropout, training=self.training)
+            hidden_states = self.post_state_residual(residual, hidden_states)
 
         outputs = (hidden_states,)
 
@@ -868,6 +1160,9 @@ class CheemsAttnDecoderLayer(nn.Module):
         if use_cache:
             outputs += (present_key_value,)
 
+        if defer_residual:
+            outputs += (residual,)
+
         return outputs
 
 
@@ -1045,13 +1340,53 @@ class CheemsModel(CheemsPreTrainedModel):
             )
 
         if cache_position is None:
+            past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
             cache_position = torch.arange(
-                hidden_states.shape[1],
+                past_seen_tokens,
+                past_seen_tokens + hidden_states.shape[1],
                 device=hidden_states.device,
             )
+        custom_position_ids = position_ids is not None
         if position_ids is None:
             position_ids = cache_position.unsqueeze(0)
 
+        if (
+            self.config.prefill_chunk_size is not None
+            and use_cache
+            and past_key_values is not None
+            and not self.training
+            and not output_attentions
+            and hidden_states.shape[1] > self.config.prefill_chunk_size
+            and (attention_mask is None or attention_mask.dim() == 2)
+        ):
+            # feed the prompt through the cache chunk by chunk, the ssd states carry over from one chunk to the next
+            chunk_outputs = list(
+                self.iter_prefill(
+                    inputs_embeds=inputs_embeds,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=past_key_values,
+                    cache_position=cache_position,
+                    output_hidden_states=output_hidden_states,
+                )
+            )
+            hidden_states = torch.cat([outputs.last_hidden_state for outputs in chunk_outputs], dim=1)
+            all_hidden_states = None
+            if output_hidden_states:
+                all_hidden_states = tuple(
+                    torch.cat(layer_states, dim=1)
+                    for layer_states in zip(*(outputs.hidden_states for outputs in chunk_outputs))
+                )
+
+            if not return_dict:
+                return tuple(v for v in [hidden_states, past_key_values, all_hidden_states] if v is not None)
+
+            return BaseModelOutputWithPast(
+                last_hidden_state=hidden_states,
+                past_key_values=past_key_values,
+                hidden_states=all_hidden_states,
+            )
+
 
         attn_mask = self._update_attn_mask(
             attention_mask, hidden_states, cache_position
@@ -1061,12 +1396,27 @@ class CheemsModel(CheemsPreTrainedModel):
         )
     
         # create position embeddings to be shared across the decoder layers
+        # size the cos and sin table on the host from the cache length, `position_ids` are only read when given
+        if isinstance(past_key_values, StaticCache):
+            # once for the whole static cache, so decoding never reallocates it
+            self.rotary_emb.extend_cos_sin_cache(past_key_values.get_max_cache_shape())
+        else:
+            past_seen_tokens = past_key_values.get_seq_length() if isinstance(past_key_values, Cache) else 0
+            rope_len = past_seen_tokens + hidden_states.shape[1]
+            if custom_position_ids and position_ids.numel() > 0:
+                # position ids of the caller, e.g. shifted or packed, may run past the cached plus new length
+                rope_len = max(rope_len, int(position_ids.max()) + 1)
+            self.rotary_emb.extend_cos_sin_cache(rope_len)
         position_embeddings = self.rotary_emb(hidden_states, position_ids)
 
         # decoder layers
         all_hidden_states = () if output_hidden_states else None
         all_self_attns = () if output_attentions else None
         next_decoder_cache = None
+        # the residual connection closing every layer is fused with the input norm of the next layer, and the last one
+        # with the final norm, unless the hidden states between the layers are returned
+        defer_residual = not output_hidden_states
+        residual_states, previous_residual = None, None
 
         for decoder_layer in self.layers:
             layer_mask = ssd_mask if isinstance(decoder_layer, CheemsSSDDecoderLayer) else attn_mask
@@ -1085,6 +1435,9 @@ class CheemsModel(CheemsPreTrainedModel):
                     use_cache,
                     cache_position,
                     position_embeddings,
+                    residual_states,
+                    previous_residual,
+                    defer_residual,
                 )
             else:
                 layer_outputs = decoder_layer(
@@ -1096,14 +1449,30 @@ class CheemsModel(CheemsPreTrainedModel):
                     use_cache=use_cache,
                     cache_position=cache_position,
                     position_embeddings=position_embeddings,
+                    residual_states=residual_states,
+                    previous_residual=previous_residual,
+                    defer_residual=defer_residual,
                 )
 
             hidden_states = layer_outputs[0]
+            if defer_residual:
+                residual_states, previous_residual = layer_outputs[-1], decoder_layer.post_state_residual
 
             if output_attentions:
                 all_self_attns += (layer_outputs[1],)
 
-        hidden_states = self.final_layernorm(hidden_states)
+        if residual_states is not None:
+            _, hidden_states = fused_residual_rms_norm(
+                residual_states,
+                hidden_states,
+                previous_residual,
+                self.final_layernorm,
+                dropout_p=self.config.hidden_dropout,
+                training=self.training,
+                use_compile=self.config.compile_residual_norm,
+            )
+        else:
+            hidden_states = self.final_layernorm(hidden_states)
 
         # add hidden states from the last decoder layer
         if output_hidden_states:
@@ -1124,6 +1493,69 @@ class CheemsModel(CheemsPreTrainedModel):
             attentions=all_self_attns,
         )
 
+    def iter_prefill(
+        self,
+        input_ids: Optional[torch.LongTensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        past_key_values: Optional[HybridSSDAttnDynamicCache] = None,
+        inputs_embeds: Optional[torch.FloatTensor] = None,
+        cache_position: Optional[torch.LongTensor] = None,
+        chunk_size: Optional[int] = None,
+        output_hidden_states: Optional[bool] = None,
+    ) -> Iterator[BaseModelOutputWithPast]:
+        """
+        Feed a prompt through `past_key_values` `chunk_size` tokens at a time and yield the output of every chunk.
+
+        The attn layers attend to the cached tokens and to the chunk, and the ssd layers start the scan of every chunk
+        from the states left by the previous one, so the result matches a single pass over the prompt. The generator
+        can be advanced one chunk at a time to interleave the prefill of a long prompt with the decoding steps of
+        other requests. The arguments not listed below are the ones of [`CheemsModel.forward`] for the whole prompt.
+
+        Args:
+            attention_mask (`torch.Tensor` of shape `(batch_size, past_length + sequence_length)`, *optional*):
+                2D padding mask of the cached tokens followed by the prompt.
+            past_key_values (`HybridSSDAttnDynamicCache`, *optional*):
+                The cache filled by the prefill, a new one is created if not given.
+            chunk_size (`int`, *optional*):
+                Number of tokens fed at a time, defaults to `config.prefill_chunk_size`.
+        """
+        chunk_size = chunk_size if chunk_size is not None else self.config.prefill_chunk_size
+        if chunk_size is None:
+            raise ValueError("`chunk_size` must be given when `config.prefill_chunk_size` is not set.")
+        if inputs_embeds is None:
+            inputs_embeds = self.word_embed(input_ids)
+        if past_key_values is None:
+            past_key_values = HybridSSDAttnDynamicCache(
+                self.config,
+                inputs_embeds.shape[0],
+                dtype=inputs_embeds.dtype,
+                device=inputs_embeds.device,
+                layer_type=self.config.layers_type,
+            )
+
+        seq_len = inputs_embeds.shape[1]
+        if cache_position is None:
+            past_seen_tokens = past_key_values.get_seq_length()
+            cache_position = torch.arange(past_seen_tokens, past_seen_tokens + seq_len, device=inputs_embeds.device)
+        if position_ids is None:
+            position_ids = cache_position.unsqueeze(0)
+        mask_offset = attention_mask.shape[-1] - seq_len if attention_mask is not None else 0
+
+        for start in range(0, seq_len, chunk_size):
+            end = min(start + chunk_size, seq_len)
+            yield self(
+                inputs_embeds=inputs_embeds[:, start:end],
+                attention_mask=attention_mask[:, : mask_offset + end] if attention_mask is not None else None,
+                position_ids=position_ids[:, start:end],
+                past_key_values=past_key_values,
+                use_cache=True,
+                output_attentions=False,
+                output_hidden_states=output_hidden_states,
+                return_dict=True,
+                cache_position=cache_position[start:end],
+            )
+
     def _update_attn_mask(
         self,
         attention_mask: torch.Tensor = None,
@@ -1202,6 +1634,32 @@ class CheemsForCausalLM(CheemsPreTrainedModel, GenerationMixin):
     def get_decoder(self):
         return self.model
 
+    def _prepare_cache_for_generation(
+        self, generation_config, model_kwargs: Dict, assistant_model, batch_size: int, max_cache_length: int, device
+    ):
+        """
+        `generate` decodes with a [`HybridSSDAttnDynamicCache`] instead of the `DynamicCache` it builds by default,
+        which has no ssd states. It holds a row for every sequence `generate` expands the batch to, e.g. every beam,
+        and beam search reorders it through the block tables of its attn layers.
+        """
+        if (
+            model_kwargs.get("past_key_values") is None
+            and generation_config.use_cache
+            and generation_config.cache_implementation is None
+        ):
+            num_sequences = max(generation_config.num_beams, generation_config.num_return_sequences or 1)
+            model_kwargs["past_key_values"] = HybridSSDAttnDynamicCache(
+                self.config,
+                batch_size * num_sequences,
+                dtype=self.dtype,
+                device=device,
+                layer_type=self.config.layers_type,
+            )
+            return
+        return super()._prepare_cache_for_generation(
+            generation_config, model_kwargs, assistant_model, batch_size, max_cache_length, device
+        )
+
     @add_start_docstrings_to_model_forward(CHEEMS_INPUTS_DOCSTRING)
     @replace_return_docstrings(output_type=CausalLMOutputWithPast, config_class=_CONFIG_FOR_DOC)
     def forward(
@@ -18,8 +18,11 @@
 # limitations under the License.
 """PyTorch Doge model."""
 
+import json
 import math
-from typing import List, Optional, Tuple, Union
+import os
+import tempfile
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
@@ -27,6 +30,7 @@ import torch.utils.checkpoint
 from torch import nn
 
 from transformers.activations import ACT2FN
+from transformers.configuration_utils import PretrainedConfig
 from transformers.cache_utils import Cache, DynamicCache, StaticCache
 from transformers.generation import GenerationMixin
 from transformers.modeling_outputs import (
@@ -43,12 +47,8 @@ from transformers.utils import (
     replace_return_docstrings,
 )
 from .configuration_doge import DogeConfig
-
-try:
-    from einx import add as einx_add
-except ImportError:
-    einx_add = None
-
+from ..modules.residual_norm import fused_residual_rms_norm
+from ..modules.cdmoe import _get_einx_add, is_einx_available
 
 logger = logging.get_logger(__name__)
 
@@ -95,7 +95,7 @@ class RotaryEmbedding(nn.Module):
         if config.rope_scaling is None:
             self.rope_type = "default"
         else:
-            self.rope_type = config.rope_scaling
+            self.rope_type = config.rope_scaling.get("rope_type", config.rope_scaling.get("type"))
         self.max_seq_len_cached = config.max_position_embeddings
         self.original_max_seq_len = config.max_position_embeddings
         self.base = config.rope_theta
@@ -107,6 +107,42 @@ class RotaryEmbedding(nn.Module):
         self.register_buffer("inv_freq", inv_freq, persistent=False)
         self.original_inv_freq = self.inv_freq
 
+        # cos and sin table indexed by position ids, grows geometrically beyond `max_position_embeddings`
+        self._set_cos_sin_cache(config.max_position_embeddings, device=inv_freq.device)
+
+    def _compute_cos_sin(self, position_ids, device_type):
+        # core RoPE block
+        inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
+        position_ids_expanded = position_ids[:, None, :].float()
+        device_type = device_type if isinstance(device_type, str) and device_type != "mps" else "cpu"
+        with torch.autocast(device_type=device_type, enabled=False):
+            freqs = (inv_freq_expanded.float() @ position_ids_expanded.float()).transpose(1, 2)
+            emb = torch.cat((freqs, freqs), dim=-1)
+            cos = emb.cos()
+            sin = emb.sin()
+
+        cos = cos * self.attention_scaling
+        sin = sin * self.attention_scaling
+        return cos, sin
+
+    def _set_cos_sin_cache(self, seq_len, device):
+        position_ids = torch.arange(seq_len, device=device)[None, :]
+        cos, sin = self._compute_cos_sin(position_ids, torch.device(device).type)
+        self.register_buffer("cos_cached", cos[0], persistent=False)
+        self.register_buffer("sin_cached", sin[0], persistent=False)
+        self.cos_sin_cache_len = seq_len
+
+    def extend_cos_sin_cache(self, seq_len):
+        """
+        Make sure the cos and sin table covers `seq_len` positions, doubling its length as needed. The model calls it
+        with the cached plus new length, or past the largest of the `position_ids` it is given.
+        """
+        if seq_len > self.cos_sin_cache_len:
+            new_len = self.cos_sin_cache_len
+            while new_len < seq_len:
+                new_len *= 2
+            self._set_cos_sin_cache(new_len, device=self.inv_freq.device)
+
     def _dynamic_frequency_update(self, position_ids, device):
         """
         dynamic RoPE layers should recompute `inv_freq` in the following situations:
@@ -130,19 +166,13 @@ class RotaryEmbedding(nn.Module):
         if "dynamic" in self.rope_type:
             self._dynamic_frequency_update(position_ids, device=x.device)
 
-        # core RoPE block
-        inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
-        position_ids_expanded = position_ids[:, None, :].float()
-        device_type = x.device.type
-        device_type = device_type if isinstance(device_type, str) and device_type != "mps" else "cpu"
-        with torch.autocast(device_type=device_type, enabled=False):
-            freqs = (inv_freq_expanded.float() @ position_ids_expanded.float()).transpose(1, 2)
-            emb = torch.cat((freqs, freqs), dim=-1)
-            cos = emb.cos()
-            sin = emb.sin()
-
-        cos = cos * self.attention_scaling
-        sin = sin * self.attention_scaling
+        if self.max_seq_len_cached > self.original_max_seq_len:
+            # the scaled `inv_freq` of dynamic RoPE depends on the exact sequence length, so it is not cached
+            cos, sin = self._compute_cos_sin(position_ids, x.device.type)
+        else:
+            # the model sizes the table on the host beforehand, reading `position_ids` here would synchronize
+            cos = self.cos_cached[position_ids]
+            sin = self.sin_cached[position_ids]
 
         return cos.to(dtype=x.dtype), sin.to(dtype=x.dtype)
 
@@ -183,6 +213,335 @@ def apply_QK_rotary_pos_emb(q, k, cos, sin, position_ids=None, unsqueeze_dim=1):
     return q_embed, k_embed
 
 
+class DogeDynamicCache(DynamicCache):
+    """
+    A [`DynamicCache`] that also keeps the `dt_states` of the dynamic mask of every layer, so that `dt_proj` only
+    runs on the value states of the new tokens, and that can be rolled back with [`~DogeDynamicCache.crop`].
+
+    `dt_states` has a shape of `(batch_size, seq_len, num_attention_heads)` for every layer.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.dt_cache: List[torch.Tensor] = []
+
+    def get_dt_length(self, layer_idx: int = 0) -> int:
+        """Returns the number of tokens whose `dt_states` are cached for the layer `layer_idx`."""
+        if len(self.dt_cache) <= layer_idx:
+            return 0
+        return self.dt_cache[layer_idx].shape[-2]
+
+    def update_dt(self, dt_states: torch.Tensor, layer_idx: int) -> torch.Tensor:
+        """
+        Appends the `dt_states` of the new tokens of the layer `layer_idx` and returns the `dt_states` of all the
+        cached tokens.
+        """
+        if len(self.dt_cache) <= layer_idx:
+            self.dt_cache.append(dt_states)
+        else:
+            self.dt_cache[layer_idx] = torch.cat([self.dt_cache[layer_idx], dt_states], dim=-2)
+        return self.dt_cache[layer_idx]
+
+    def crop(self, max_length: int):
+        """
+        Crop the cache to `max_length` tokens, or drop the last `abs(max_length)` tokens if it is negative, the
+        `dt_states` of the dynamic mask are cropped together with the keys and values.
+        """
+        if max_length < 0:
+            max_length = self.get_seq_length() - abs(max_length)
+        super().crop(max_length)
+        for layer_idx in range(len(self.dt_cache)):
+            self.dt_cache[layer_idx] = self.dt_cache[layer_idx][..., :max_length, :]
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        """Reorders the cache for beam search, given the selected beam indices."""
+        super().reorder_cache(beam_idx)
+        for layer_idx in range(len(self.dt_cache)):
+            device = self.dt_cache[layer_idx].device
+            self.dt_cache[layer_idx] = self.dt_cache[layer_idx].index_select(0, beam_idx.to(device))
+
+    def batch_repeat_interleave(self, repeats: int):
+        """Repeat the cache `repeats` times in the batch dimension."""
+        super().batch_repeat_interleave(repeats)
+        for layer_idx in range(len(self.dt_cache)):
+            self.dt_cache[layer_idx] = self.dt_cache[layer_idx].repeat_interleave(repeats, dim=0)
+
+    def batch_select_indices(self, indices: torch.Tensor):
+        """Only keep the `indices` in the batch dimension of the cache."""
+        super().batch_select_indices(indices)
+        for layer_idx in range(len(self.dt_cache)):
+            self.dt_cache[layer_idx] = self.dt_cache[layer_idx][indices, ...]
+
+
+class DogeSlidingWindowCache(DogeDynamicCache):
+    """
+    A [`DogeDynamicCache`] whose sliding window layers keep their key, value and `dt_states` in a ring buffer of
+    `sliding_window` slots, so their memory stays constant however long the conversation gets. The other layers keep
+    the whole history like [`DogeDynamicCache`].
+
+    A new token overwrites the slot of the token `sliding_window` positions before it, `key_positions` keeps the
+    position held by every slot, `-1` for the empty ones, to build the sliding window mask. Every update returns the
+    ring buffer followed by the new tokens, so the queries of a chunk see the window before the chunk as well as the
+    chunk itself.
+    """
+
+    def __init__(self, sliding_window: int, sliding_window_layers: Optional[List[int]] = None) -> None:
+        super().__init__()
+        self.sliding_window = sliding_window
+        self.sliding_window_layers = sliding_window_layers
+        self.key_positions: Dict[int, torch.LongTensor] = {}
+        self._ring_slots: Dict[int, torch.LongTensor] = {}
+        self._seen_tokens_per_layer: List[int] = []
+
+    @classmethod
+    def from_config(cls, config: DogeConfig) -> "DogeSlidingWindowCache":
+        """An empty cache for the sliding window layers of `config`."""
+        return cls(config.sliding_window, config.sliding_window_layers)
+
+    def is_sliding_window_layer(self, layer_idx: int) -> bool:
+        """Whether the layer `layer_idx` is kept in a ring buffer."""
+        return self.sliding_window_layers is None or layer_idx in self.sliding_window_layers
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        """Returns the number of tokens seen by the layer `layer_idx`, including the ones that left the window."""
+        if len(self._seen_tokens_per_layer) <= layer_idx:
+            return 0
+        return self._seen_tokens_per_layer[layer_idx]
+
+    def get_key_positions(self, cache_position: torch.LongTensor, layer_idx: int) -> torch.LongTensor:
+        """
+        Returns the positions of the keys that the next update of the layer `layer_idx` with the tokens at
+        `cache_position` returns, `-1` for the empty slots.
+        """
+        if layer_idx not in self.key_positions:
+            return cache_position
+        return torch.cat([self.key_positions[layer_idx], cache_position])
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Writes the new `key_states` and `value_states` of the layer `layer_idx` and returns the states to attend to:
+        the ring buffer followed by the new tokens for a sliding window layer, the whole history for the others.
+        """
+        num_new_tokens = key_states.shape[-2]
+        if len(self._seen_tokens_per_layer) <= layer_idx:
+            self._seen_tokens_per_layer.append(0)
+        self._seen_tokens_per_layer[layer_idx] += num_new_tokens
+        if not self.is_sliding_window_layer(layer_idx):
+            return super().update(key_states, value_states, layer_idx, cache_kwargs)
+
+        cache_position = cache_kwargs.get("cache_position") if cache_kwargs is not None else None
+        if cache_position is None:
+            seen_tokens = self._seen_tokens_per_layer[layer_idx]
+            cache_position = torch.arange(seen_tokens - num_new_tokens, seen_tokens, device=key_states.device)
+
+        if len(self.key_cache) <= layer_idx:
+            bsz, num_heads, _, head_dim = key_states.shape
+            self.key_cache.append(key_states.new_zeros(bsz, num_heads, self.sliding_window, head_dim))
+            self.value_cache.append(value_states.new_zeros(bsz, num_heads, self.sliding_window, head_dim))
+            self.key_positions[layer_idx] = torch.full(
+                (self.sliding_window,), -1, dtype=torch.long, device=key_states.device
+            )
+            attended_key_states, attended_value_states = key_states, value_states
+        else:
+            attended_key_states = torch.cat([self.key_cache[layer_idx], key_states], dim=-2)
+            attended_value_states = torch.cat([self.value_cache[layer_idx], value_states], dim=-2)
+
+        # only the last `sliding_window` new tokens can be attended to by the next tokens
+        num_kept = min(num_new_tokens, self.sliding_window)
+        kept_positions = cache_position[-num_kept:]
+        slots = kept_positions % self.sliding_window
+        self.key_cache[layer_idx].index_copy_(2, slots, key_states[:, :, -num_kept:])
+        self.value_cache[layer_idx].index_copy_(2, slots, value_states[:, :, -num_kept:])
+        self.key_positions[layer_idx].index_copy_(0, slots, kept_positions)
+        self._ring_slots[layer_idx] = slots
+        return attended_key_states, attended_value_states
+
+    def update_dt(self, dt_states: torch.Tensor, layer_idx: int) -> torch.Tensor:
+        """
+        Writes the `dt_states` of the new tokens of the layer `layer_idx` to the slots of their keys and returns the
+        `dt_states` of the keys returned by the last [`~DogeSlidingWindowCache.update`].
+        """
+        if not self.is_sliding_window_layer(layer_idx):
+            return super().update_dt(dt_states, layer_idx)
+
+        if len(self.dt_cache) <= layer_idx:
+            bsz, _, num_heads = dt_states.shape
+            self.dt_cache.append(dt_states.new_zeros(bsz, self.sliding_window, num_heads))
+            attended_dt_states = dt_states
+        else:
+            attended_dt_states = torch.cat([self.dt_cache[layer_idx], dt_states], dim=-2)
+        slots = self._ring_slots[layer_idx]
+        self.dt_cache[layer_idx].index_copy_(1, slots, dt_states[:, -slots.shape[0] :])
+        return attended_dt_states
+
+    def crop(self, max_length: int):
+        """The ring buffers can not be rolled back, the tokens they overwrote are gone."""
+        raise ValueError(f"{self.__class__.__name__} can not be cropped, use a `DogeDynamicCache` instead.")
+
+
+def pack_projections_state_dict(
+    state_dict: dict,
+    prefix: str,
+    unpacked_names: List[str],
+    packed_name: str,
+) -> dict:
+    """
+    Concatenate, in place, the weights and biases of the separate projections `unpacked_names` found under `prefix`
+    along the output dimension into the packed projection `packed_name`.
+    """
+    for param_name in ("weight", "bias"):
+        keys = [f"{prefix}{name}.{param_name}" for name in unpacked_names]
+        if all(key in state_dict for key in keys):
+            state_dict[f"{prefix}{packed_name}.{param_name}"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+    return state_dict
+
+
+# separate projections of the checkpoints saved before they were packed into one GEMM
+UNPACKED_PROJECTIONS = {
+    "qkv_proj": ["q_proj", "k_proj", "v_proj"],
+    "gate_up_proj": ["gate_proj", "up_proj"],
+}
+
+
+def pack_unpacked_projections(state_dict: dict) -> dict:
+    """Pack, in place, every group of separate projections of a whole model state dict, see [`UNPACKED_PROJECTIONS`]."""
+    for packed_name, unpacked_names in UNPACKED_PROJECTIONS.items():
+        suffix = f"{unpacked_names[0]}.weight"
+        prefixes = [key[: -len(suffix)] for key in state_dict if key.endswith(f".{suffix}")]
+        for prefix in prefixes:
+            pack_projections_state_dict(state_dict, prefix, unpacked_names, packed_name)
+    return state_dict
+
+
+def _has_unpacked_projections(keys) -> bool:
+    names = {f".{name}.weight" for unpacked_names in UNPACKED_PROJECTIONS.values() for name in unpacked_names}
+    return any(key.endswith(name) for key in keys for name in names)
+
+
+def _load_checkpoint_file(checkpoint_file: str) -> dict:
+    """The state dict of one checkpoint file, a `.bin` file is memory-mapped so only the tensors used are read."""
+    if checkpoint_file.endswith(".safetensors"):
+        from safetensors.torch import load_file
+
+        return load_file(checkpoint_file)
+    try:
+        return torch.load(checkpoint_file, map_location="cpu", weights_only=True, mmap=True)
+    except RuntimeError:
+        # the legacy non-zip serialization can not be memory-mapped
+        from transformers.modeling_utils import load_state_dict
+
+        return load_state_dict(checkpoint_file)
+
+
+def _unpacked_checkpoint_files(pretrained_model_name_or_path: str, **kwargs) -> Optional[List[str]]:
+    """
+    The files of a checkpoint saved with separate projections, `None` for a packed checkpoint. Only the keys are read
+    to tell them apart, from the safetensors header, the index of a sharded checkpoint or the pickle of a
+    memory-mapped `.bin` file.
+    """
+    from transformers.utils import (
+        SAFE_WEIGHTS_INDEX_NAME,
+        SAFE_WEIGHTS_NAME,
+        WEIGHTS_INDEX_NAME,
+        WEIGHTS_NAME,
+        cached_file,
+    )
+
+    hub_kwargs = {
+        name: kwargs[name]
+        for name in ("cache_dir", "force_download", "proxies", "local_files_only", "token", "revision", "subfolder")
+        if name in kwargs
+    }
+    for weights_name, index_name in ((SAFE_WEIGHTS_NAME, SAFE_WEIGHTS_INDEX_NAME), (WEIGHTS_NAME, WEIGHTS_INDEX_NAME)):
+        weights_file = cached_file(
+            pretrained_model_name_or_path, weights_name, _raise_exceptions_for_missing_entries=False, **hub_kwargs
+        )
+        if weights_file is not None:
+            if weights_name == SAFE_WEIGHTS_NAME:
+                from safetensors import safe_open
+
+                with safe_open(weights_file, framework="pt") as f:
+                    keys = list(f.keys())
+            else:
+                keys = list(_load_checkpoint_file(weights_file).keys())
+            return [weights_file] if _has_unpacked_projections(keys) else None
+
+        index_file = cached_file(
+            pretrained_model_name_or_path, index_name, _raise_exceptions_for_missing_entries=False, **hub_kwargs
+        )
+        if index_file is not None:
+            with open(index_file, encoding="utf-8") as f:
+                weight_map = json.load(f)["weight_map"]
+            if not _has_unpacked_projections(weight_map):
+                return None
+            return [
+                cached_file(pretrained_model_name_or_path, shard_name, **hub_kwargs)
+                for shard_name in sorted(set(weight_map.values()))
+            ]
+    return None
+
+
+def _save_packed_checkpoint(checkpoint_files: List[str], save_directory: str):
+    """
+    Pack the separate projections of `checkpoint_files` into safetensors files in `save_directory`, one shard at a
+    time. The parts of a projection whose other parts are in a later shard wait for it, so only one shard and those
+    parts are in memory at once.
+    """
+    from safetensors.torch import save_file
+    from transformers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME
+
+    num_shards = len(checkpoint_files)
+    weight_map, pending, total_size = {}, {}, 0
+    for shard_idx, checkpoint_file in enumerate(checkpoint_files):
+        state_dict = pack_unpacked_projections({**pending, **_load_checkpoint_file(checkpoint_file)})
+        pending = {}
+        if shard_idx < num_shards - 1:
+            pending = {key: state_dict.pop(key) for key in list(state_dict) if _has_unpacked_projections([key])}
+
+        # safetensors refuses tensors sharing memory, e.g. tied embeddings loaded from a `.bin` checkpoint
+        data_ptrs = set()
+        for key, value in state_dict.items():
+            if value.data_ptr() in data_ptrs:
+                state_dict[key] = value.clone()
+            data_ptrs.add(state_dict[key].data_ptr())
+
+        shard_name = SAFE_WEIGHTS_NAME
+        if num_shards > 1:
+            shard_suffix = f"-{shard_idx + 1:05d}-of-{num_shards:05d}.safetensors"
+            shard_name = SAFE_WEIGHTS_NAME.replace(".safetensors", shard_suffix)
+        save_file(state_dict, os.path.join(save_directory, shard_name), metadata={"format": "pt"})
+        weight_map.update(dict.fromkeys(state_dict, shard_name))
+        total_size += sum(value.numel() * value.element_size() for value in state_dict.values())
+        del state_dict
+
+    if num_shards > 1:
+        with open(os.path.join(save_directory, SAFE_WEIGHTS_INDEX_NAME), "w", encoding="utf-8") as f:
+            json.dump({"metadata": {"total_size": total_size}, "weight_map": weight_map}, f)
+
+
+def _selective_checkpointing_targets(config: DogeConfig) -> Tuple[str, ...]:
+    """
+    Parts of the decoder layer recomputed in backward when gradient checkpointing is enabled with the
+    `"selective"` policy, empty for the `"full"` policy.
+    """
+    if config.gradient_checkpointing_policy != "selective":
+        return ()
+    return tuple(config.selective_checkpointing_targets)
+
+
+def _uses_sliding_window(config: DogeConfig, layer_idx: Optional[int]) -> bool:
+    """Whether the layer `layer_idx` only attends to the `config.sliding_window` most recent tokens."""
+    if config.sliding_window is None:
+        return False
+    return config.sliding_window_layers is None or layer_idx in config.sliding_window_layers
+
+
 class DogeDynamicMaskAttention(nn.Module):
     """Dynamic Mask Attention from 'Wonderful Matrices' paper."""
 
@@ -202,19 +561,18 @@ class DogeDynamicMaskAttention(nn.Module):
         self.num_attention_heads = config.num_attention_heads
         self.attention_dropout = config.attention_dropout
         self.attention_head_dim = self.hidden_dim // self.num_attention_heads
+        # the model gives the sliding window layers a mask restricted to the `sliding_window` most recent tokens
+        self.sliding_window = config.sliding_window if _uses_sliding_window(config, layer_idx) else None
 
-        # Q K V O projections
-        self.q_proj = nn.Linear(
+        # Q K V projections packed into a single GEMM, followed by the O projection
+        self.qkv_proj = nn.Linear(
             self.hidden_dim,
-            self.num_attention_heads * self.attention_head_dim,
-            bias=config.hidden_bias,
-        )
-        self.k_proj = nn.Linear(
-            self.hidden_dim,
-            self.num_attention_heads * self.attention_head_dim,
+            3 * self.num_attention_heads * self.attention_head_dim,
             bias=config.hidden_bias,
         )
         # dynamic mask for the QK^T attention score matrix
+        # `dt_proj` is not folded into `qkv_proj` as `W_dt @ W_v`: caches without `dt_states`, e.g. `StaticCache`,
+        # recompute it from the cached value states, and LoRA adapters of `v_proj` must reach the dynamic mask too
         self.A = nn.Parameter(
             torch.ones(self.num_attention_heads)
         )
@@ -223,16 +581,76 @@ class DogeDynamicMaskAttention(nn.Module):
             self.num_attention_heads,
             bias=config.hidden_bias,
         )
-        self.v_proj = nn.Linear(
-            self.hidden_dim,
-            self.num_attention_heads * self.attention_head_dim,
-            bias=config.hidden_bias,
-        )
         self.o_proj = nn.Linear(
             self.hidden_dim,
             self.hidden_dim,
             bias=config.hidden_bias,
         )
+        self.gradient_checkpointing = False
+        # checkpoints saved with separate `q_proj`, `k_proj` and `v_proj` are packed by `load_state_dict` and by
+        # `DogePreTrainedModel.from_pretrained`
+        self._register_load_state_dict_pre_hook(self._pack_qkv_proj_hook)
+
+    @staticmethod
+    def _pack_qkv_proj_hook(state_dict, prefix, *args):
+        pack_projections_state_dict(state_dict, prefix, ["q_proj", "k_proj", "v_proj"], "qkv_proj")
+
+    def compute_dt_states(self, value_states: torch.Tensor) -> torch.Tensor:
+        bsz, _, kv_len, _ = value_states.shape
+        return self.dt_proj(value_states.transpose(1, 2).reshape(bsz, kv_len, -1))
+
+    def prepare_dynamic_mask(
+        self,
+        value_states: torch.Tensor,
+        attention_mask: torch.Tensor,
+        dt_states: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Combine the causal mask with the dynamic mask computed from the value states, or from the cached
+        `dt_states` when they are given.
+        """
+        kv_len = value_states.shape[-2]
+        if dt_states is None:
+            dt_states = self.compute_dt_states(value_states)
+        dynamic_mask = torch.exp(self.A * F.softplus(dt_states)).transpose(-1, -2)
+        dynamic_mask = dynamic_mask < 1.0
+        return attention_mask[:, :, :, :kv_len].masked_fill(
+            dynamic_mask[:, :, None, :], torch.finfo(attention_mask.dtype).min
+        )
+
+    def attention_core(
+        self,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        # compute attention scores matrix
+        attn_weights = torch.matmul(query_states, key_states.transpose(-1, -2)) / math.sqrt(self.attention_head_dim)
+
+        # add mask to attention scores
+        if attention_mask is not None:
+            attn_weights = attn_weights + attention_mask
+
+        # upcast attention scores to fp32
+        attn_weights = F.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+        attn_weights = F.dropout(attn_weights, p=self.attention_dropout, training=self.training)
+
+        # apply attention scores to value states
+        attn_output = torch.matmul(attn_weights, value_states)
+        return attn_output
+
+    def dynamic_mask_attention(
+        self,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        dt_states: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        if attention_mask is not None:
+            attention_mask = self.prepare_dynamic_mask(value_states, attention_mask, dt_states)
+        return self.attention_core(query_states, key_states, value_states, attention_mask)
 
     def forward(
         self,
@@ -246,9 +664,9 @@ class DogeDynamicMaskAttention(nn.Module):
     ) -> Tuple[torch.Tensor, Optional[Cache]]:
         bsz, q_len, _ = hidden_states.shape
 
-        query_states = self.q_proj(hidden_states)
-        key_states = self.k_proj(hidden_states)
-        value_states = self.v_proj(hidden_states)
+        query_states, key_states, value_states = self.qkv_proj(hidden_states).split(
+            self.num_attention_heads * self.attention_head_dim, dim=-1
+        )
 
         query_states = query_states.view(bsz, q_len, self.num_attention_heads, self.attention_head_dim).transpose(
             1, 2
@@ -268,23 +686,27 @@ class DogeDynamicMaskAttention(nn.Module):
             cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        # compute attention scores matrix
-        attn_weights = torch.matmul(query_states, key_states.transpose(-1, -2)) / math.sqrt(self.attention_head_dim)
-
-        # add mask to attention scores
-        if attention_mask is not None:
-            dt_states = self.dt_proj(value_states.transpose(1, 2).reshape(bsz, value_states.shape[-2], -1))
-            dynamic_mask = torch.exp(self.A * F.softplus(dt_states)).transpose(-1, -2)
-            dynamic_mask = dynamic_mask < 1.0
-            causal_mask = attention_mask[:, :, :, : key_states.shape[-2]].masked_fill(dynamic_mask[:, :, None, :], torch.finfo(hidden_states.dtype).min)
-            attn_weights = attn_weights + causal_mask
-
-        # upcast attention scores to fp32
-        attn_weights = F.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
-        attn_weights = F.dropout(attn_weights, p=self.attention_dropout, training=self.training)
+        dt_states = None
+        if isinstance(past_key_value, DogeDynamicCache):
+            # `dt_proj` only runs on the value states that have no cached `dt_states` yet
+            dt_len = past_key_value.get_dt_length(self.layer_idx)
+            dt_states = past_key_value.update_dt(
+                self.compute_dt_states(value_states[:, :, dt_len:, :]), self.layer_idx
+            )
 
-        # apply attention scores to value states
-        attn_output = torch.matmul(attn_weights, value_states)
+        if (
+            self.gradient_checkpointing
+            and self.training
+            and "attn_scores" in _selective_checkpointing_targets(self.config)
+        ):
+            # only keep the inputs, the dynamic mask and the attention score matrix are recomputed in backward
+            attn_output = self._gradient_checkpointing_func(
+                self.dynamic_mask_attention, query_states, key_states, value_states, attention_mask, dt_states
+            )
+        else:
+            attn_output = self.dynamic_mask_attention(
+                query_states, key_states, value_states, attention_mask, dt_states
+            )
 
         attn_output = attn_output.transpose(1, 2).contiguous()
         attn_output = attn_output.reshape(bsz, q_len, -1)
@@ -295,40 +717,13 @@ class DogeDynamicMaskAttention(nn.Module):
 
 class DogeSdpaDynamicMaskAttn(DogeDynamicMaskAttention):
 
-    def forward(
+    def attention_core(
         self,
-        hidden_states: torch.Tensor,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
         attention_mask: Optional[torch.Tensor] = None,
-        position_ids: Optional[torch.LongTensor] = None,
-        past_key_value: Optional[Cache] = None,
-        cache_position: Optional[torch.LongTensor] = None,
-        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
-        **kwargs,
-    ) -> Tuple[torch.Tensor, Optional[Cache]]:
-        bsz, q_len, _ = hidden_states.shape
-
-        query_states = self.q_proj(hidden_states)
-        key_states = self.k_proj(hidden_states)
-        value_states = self.v_proj(hidden_states)
-
-        query_states = query_states.view(bsz, q_len, self.num_attention_heads, self.attention_head_dim).transpose(1, 2)
-        key_states = key_states.view(bsz, q_len, self.num_attention_heads, self.attention_head_dim).transpose(1, 2)
-        value_states = value_states.view(bsz, q_len, self.num_attention_heads, self.attention_head_dim).transpose(1, 2)
-
-        cos, sin = position_embeddings
-        query_states, key_states = apply_QK_rotary_pos_emb(query_states, key_states, cos, sin)
-
-        if past_key_value is not None:
-            # sin and cos are specific to RoPE models; cache_position needed for the static cache
-            cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}
-            key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
-
-        if attention_mask is not None:
-            dt_states = self.dt_proj(value_states.transpose(1, 2).reshape(bsz, value_states.shape[-2], -1))
-            dynamic_mask = torch.exp(self.A * F.softplus(dt_states)).transpose(-1, -2)
-            dynamic_mask = dynamic_mask < 1.0
-            causal_mask = attention_mask[:, :, :, : key_states.shape[-2]].masked_fill(dynamic_mask[:, :, None, :], torch.finfo(hidden_states.dtype).min)
-
+    ) -> torch.Tensor:
         query_states = query_states.contiguous()
         key_states = key_states.contiguous()
         value_states = value_states.contiguous()
@@ -337,15 +732,10 @@ class DogeSdpaDynamicMaskAttn(DogeDynamicMaskAttention):
             query_states,
             key_states,
             value_states,
-            attn_mask=causal_mask,
-            dropout_p=self.attention_dropout,
+            attn_mask=attention_mask,
+            dropout_p=self.attention_dropout if self.training else 0.0,
         )
-
-        attn_output = attn_output.transpose(1, 2).contiguous()
-        attn_output = attn_output.view(bsz, q_len, -1)
-        attn_output = self.o_proj(attn_output)
-
-        return attn_output, past_key_value
+        return attn_output
 
 
 DOGE_ATTENTION_CLASSES = {
@@ -358,18 +748,15 @@ class DogeMLP(nn.Module):
 
     def __init__(self, config: DogeConfig):
         super().__init__()
+        self.config = config
         self.hidden_dim = config.hidden_size
         self.intermediate_dim = config.intermediate_size
         self.act_fn = ACT2FN[config.hidden_act]
 
-        self.gate_proj = nn.Linear(
+        # gate and up projections packed into a single GEMM
+        self.gate_up_proj = nn.Linear(
             self.hidden_dim,
-            self.intermediate_dim,
-            bias=config.hidden_bias,
-        )
-        self.up_proj = nn.Linear(
-            self.hidden_dim,
-            self.intermediate_dim,
+            2 * self.intermediate_dim,
             bias=config.hidden_bias,
         )
         self.down_proj = nn.Linear(
@@ -377,14 +764,32 @@ class DogeMLP(nn.Module):
             self.hidden_dim,
             bias=config.hidden_bias,
         )
+        self.gradient_checkpointing = False
+        # checkpoints saved with separate `gate_proj` and `up_proj` are packed by `load_state_dict` and by
+        # `DogePreTrainedModel.from_pretrained`
+        self._register_load_state_dict_pre_hook(self._pack_gate_up_proj_hook)
+
+    @staticmethod
+    def _pack_gate_up_proj_hook(state_dict, prefix, *args):
+        pack_projections_state_dict(state_dict, prefix, ["gate_proj", "up_proj"], "gate_up_proj")
+
+    def mlp(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        gate_states, up_states = self.gate_up_proj(hidden_states).chunk(2, dim=-1)
+        return self.down_proj(self.act_fn(gate_states) * up_states)
 
     def forward(
         self,
         hidden_states: torch.Tensor,
         **kwargs,
     ) -> torch.Tensor:
-        hidden_states = self.down_proj(self.act_fn(self.gate_proj(hidden_states)) * self.up_proj(hidden_states))
-        return hidden_states
+        if (
+            self.gradient_checkpointing
+            and self.training
+            and "mlp_intermediate" in _selective_checkpointing_targets(self.config)
+        ):
+            # only keep the input, the intermediate states are recomputed in backward
+            return self._gradient_checkpointing_func(self.mlp, hidden_states)
+        return self.mlp(hidden_states)
 
 
 class DogeCDMoE(DogeMLP):
@@ -427,11 +832,7 @@ class DogeCDMoE(DogeMLP):
         )
         
 
-    def forward(
-        self,
-        hidden_states: torch.Tensor,
-        **kwargs,
-    ) -> torch.Tensor:
+    def route(self, hidden_states: torch.Tensor) -> Tuple[torch.Tensor, torch.LongTensor]:
         bsz, seq_len, _ = hidden_states.shape
 
         # get similarity with queries and keys
@@ -441,7 +842,9 @@ class DogeCDMoE(DogeMLP):
 
         # get experts with the highest similarity
         (scores_x, scores_y), (indices_x, indices_y) = sim.topk(self.num_cdmmoe_experts_per_head, dim=-1)
-        if einx_add is not None:
+        # einx builds its graph with Python side caching, so plain broadcasting is traced for ONNX and TorchScript
+        if is_einx_available and not torch.jit.is_tracing():
+            einx_add = _get_einx_add()
             all_scores = einx_add("... i, ... j -> ... (i j)", scores_x, scores_y)
             all_indices = einx_add("... i, ... j -> ... (i j)", indices_x * self.num_keys, indices_y)
         else:
@@ -451,6 +854,14 @@ class DogeCDMoE(DogeMLP):
             all_indices = all_indices.view(*indices_x.shape[:-1], -1)
         scores, pk_indices = all_scores.topk(self.num_cdmmoe_experts_per_head, dim=-1)
         indices = all_indices.gather(-1, pk_indices)
+        return scores, indices
+
+    def mix_experts(
+        self,
+        hidden_states: torch.Tensor,
+        scores: torch.Tensor,
+        indices: torch.LongTensor,
+    ) -> torch.Tensor:
         down_embed = self.down_embed(indices)
         up_embed = self.up_embed(indices)
 
@@ -458,7 +869,24 @@ class DogeCDMoE(DogeMLP):
         experts_weights = torch.einsum("b t d, b t h k d -> b t h k", hidden_states, down_embed)
         experts_weights = self.act_fn(experts_weights) * scores.softmax(dim=-1)
         experts_states = torch.einsum("b t h k, b t h k d -> b t d", experts_weights, up_embed)
-        hidden_states = self.down_proj(self.act_fn(self.gate_proj(hidden_states)) * self.up_proj(hidden_states))
+        return experts_states
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        **kwargs,
+    ) -> torch.Tensor:
+        scores, indices = self.route(hidden_states)
+        if (
+            self.gradient_checkpointing
+            and self.training
+            and "expert_gather" in _selective_checkpointing_targets(self.config)
+        ):
+            # the gathered `down_embed` and `up_embed` are recomputed in backward instead of being kept
+            experts_states = self._gradient_checkpointing_func(self.mix_experts, hidden_states, scores, indices)
+        else:
+            experts_states = self.mix_experts(hidden_states, scores, indices)
+        hidden_states = super().forward(hidden_states)
         hidden_states = hidden_states + experts_states
         return hidden_states
 
@@ -475,6 +903,7 @@ class DogeDecoderLayer(nn.Module):
         self.pre_state_layernorm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.feed_forward = DogeMLP(config) if config.is_moe == False else DogeCDMoE(config)
         self.post_state_residual = Residual(config.hidden_size)
+        self.compile_residual_norm = config.compile_residual_norm
 
     def forward(
         self,
@@ -486,6 +915,9 @@ class DogeDecoderLayer(nn.Module):
         use_cache: Optional[bool] = False,
         cache_position: Optional[torch.LongTensor] = None,
         position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        residual_states: Optional[torch.Tensor] = None,
+        previous_residual: Optional[nn.Module] = None,
+        defer_residual: Optional[bool] = False,
         **kwargs,
     ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
         """
@@ -506,14 +938,32 @@ class DogeDecoderLayer(nn.Module):
             position_embeddings (`Tuple[torch.FloatTensor, torch.FloatTensor]`, *optional*):
                 Tuple containing the cosine and sine positional embeddings of shape `(batch_size, seq_len, head_dim)`,
                 with `head_dim` being the embedding dimension of each attention head.
+            residual_states (`torch.FloatTensor`, *optional*):
+                residual states of the previous layer, when `hidden_states` is the output of its feed forward returned
+                with `defer_residual=True`. Their residual connection is fused with the input norm of this layer.
+            previous_residual (`Residual`, *optional*): `post_state_residual` of the previous layer
+            defer_residual (`bool`, *optional*):
+                Whether to return the output of the feed forward followed by the residual states instead of their
+                sum, so that the next layer or the final norm fuses the residual connection with its RMSNorm.
             kwargs (`dict`, *optional*):
                 Arbitrary kwargs to be ignored, used for FSDP and other methods that injects code
                 into the model
         """
 
-        # sequence transformation
-        residual = hidden_states
-        hidden_states = self.pre_sequence_layernorm(hidden_states)
+        # sequence transformation, fused with the residual of the previous layer when it was deferred
+        if residual_states is None:
+            residual = hidden_states
+            hidden_states = self.pre_sequence_layernorm(hidden_states)
+        else:
+            residual, hidden_states = fused_residual_rms_norm(
+                residual_states,
+                hidden_states,
+                previous_residual,
+                self.pre_sequence_layernorm,
+                dropout_p=self.hidden_dropout,
+                training=self.training,
+                use_compile=self.compile_residual_norm,
+            )
         hidden_states, present_key_value = self.attn(
             hidden_states=hidden_states,
             attention_mask=attention_mask,
@@ -524,15 +974,21 @@ class DogeDecoderLayer(nn.Module):
             **kwargs,
         )
         self_attn_weights = None
-        hidden_states = F.dropout(hidden_states, p=self.hidden_dropout, training=self.training)
-        hidden_states = self.post_sequence_residual(residual, hidden_states)
 
-        # state transformation
-        residual = hidden_states
-        hidden_states = self.pre_state_layernorm(hidden_states)
+        # state transformation, fused with the residual of the sequence transformation
+        residual, hidden_states = fused_residual_rms_norm(
+            residual,
+            hidden_states,
+            self.post_sequence_residual,
+            self.pre_state_layernorm,
+            dropout_p=self.hidden_dropout,
+            training=self.training,
+            use_compile=self.compile_residual_norm,
+        )
         hidden_states = self.feed_forward(hidden_states)
-        hidden_states = F.dropout(hidden_states, p=self.hidden_dropout, training=self.training)
-        hidden_states = self.post_state_residual(residual, hidden_states)
+        if not defer_residual:
+            hidden_states = F.dropout(hidden_states, p=self.hidden_dropout, training=self.training)
+            hidden_states = self.post_state_residual(residual, hidden_states)
 
         outputs = (hidden_states,)
 
@@ -542,6 +998,9 @@ class DogeDecoderLayer(nn.Module):
         if use_cache:
             outputs += (present_key_value,)
 
+        if defer_residual:
+            outputs += (residual,)
+
         return outputs
 
 
@@ -557,6 +1016,52 @@ class DogePreTrainedModel(PreTrainedModel):
     _supports_quantized_cache = True
     _supports_static_cache = True
 
+    @classmethod
+    def from_pretrained(cls, pretrained_model_name_or_path, *model_args, **kwargs):
+        """
+        [`~PreTrainedModel.from_pretrained`] that also loads the checkpoints saved with separate projections, see
+        [`UNPACKED_PROJECTIONS`]. The load hooks of the modules only run on the `nn.Module.load_state_dict` path, the
+        `low_cpu_mem_usage` and `device_map` paths read the checkpoint files and assign the parameters by name. So
+        such a checkpoint is packed shard by shard into temporary safetensors files first, and every loading option
+        applies to them.
+        """
+        checkpoint_files = None
+        if pretrained_model_name_or_path is not None and kwargs.get("state_dict") is None:
+            checkpoint_files = _unpacked_checkpoint_files(str(pretrained_model_name_or_path), **kwargs)
+        if checkpoint_files is None:
+            if kwargs.get("state_dict") is not None:
+                kwargs["state_dict"] = pack_unpacked_projections(dict(kwargs["state_dict"]))
+            return super().from_pretrained(pretrained_model_name_or_path, *model_args, **kwargs)
+
+        from transformers import GenerationConfig
+
+        hub_kwargs = {
+            name: kwargs.pop(name)
+            for name in ("cache_dir", "force_download", "proxies", "local_files_only", "token", "revision", "subfolder")
+            if name in kwargs
+        }
+        config = kwargs.pop("config", None)
+        if not isinstance(config, PretrainedConfig):
+            config, kwargs = cls.config_class.from_pretrained(
+                config if config is not None else pretrained_model_name_or_path,
+                return_unused_kwargs=True,
+                **hub_kwargs,
+                **kwargs,
+            )
+
+        with tempfile.TemporaryDirectory() as packed_dir:
+            _save_packed_checkpoint(checkpoint_files, packed_dir)
+            outputs = super().from_pretrained(packed_dir, *model_args, config=config, **kwargs)
+
+        model = outputs[0] if isinstance(outputs, tuple) else outputs
+        model.name_or_path = model.config.name_or_path = str(pretrained_model_name_or_path)
+        if model.can_generate():
+            try:
+                model.generation_config = GenerationConfig.from_pretrained(pretrained_model_name_or_path, **hub_kwargs)
+            except OSError:
+                pass
+        return outputs
+
     def _init_weights(self, module):
         std = self.config.initializer_range
         if isinstance(module, (nn.Linear)):
@@ -669,6 +1174,18 @@ class DogeModel(DogePreTrainedModel):
     def set_input_embeddings(self, value):
         self.word_embed = value
 
+    def set_sliding_window(self, sliding_window: Optional[int], sliding_window_layers: Optional[List[int]] = None):
+        """
+        Change the `sliding_window` of the model without reloading it, e.g. to compare window sizes, `None` to attend
+        to the whole history in every layer. Caches filled with another window must not be reused.
+        """
+        self.config.sliding_window = sliding_window
+        self.config.sliding_window_layers = sliding_window_layers
+        for layer_idx, decoder_layer in enumerate(self.layers):
+            decoder_layer.attn.sliding_window = (
+                sliding_window if _uses_sliding_window(self.config, layer_idx) else None
+            )
+
     @add_start_docstrings_to_model_forward(DOGE_INPUTS_DOCSTRING)
     def forward(
         self,
@@ -707,9 +1224,13 @@ class DogeModel(DogePreTrainedModel):
         if use_cache and not isinstance(past_key_values, Cache):
             return_legacy_cache = True
             if past_key_values is None:
-                past_key_values = DynamicCache()
+                past_key_values = (
+                    DogeSlidingWindowCache.from_config(self.config)
+                    if self.config.sliding_window is not None
+                    else DogeDynamicCache()
+                )
             else:
-                past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+                past_key_values = DogeDynamicCache.from_legacy_cache(past_key_values)
                 logger.warning_once(
                     "We detected that you are passing `past_key_values` as a tuple of tuples. This is deprecated and "
                     "will be removed in v4.47. Please convert your cache or use an appropriate `Cache` class "
@@ -723,51 +1244,122 @@ class DogeModel(DogePreTrainedModel):
                 past_seen_tokens + inputs_embeds.shape[1],
                 device=inputs_embeds.device,
             )
+        custom_position_ids = position_ids is not None
         if position_ids is None:
             position_ids = cache_position.unsqueeze(0)
 
-        causal_mask = self._update_causal_mask(
-            attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions
-        )
+        if (
+            self.config.prefill_chunk_size is not None
+            and use_cache
+            and not self.training
+            and not output_attentions
+            and inputs_embeds.shape[1] > self.config.prefill_chunk_size
+            and (attention_mask is None or attention_mask.dim() == 2)
+        ):
+            # feed the prompt through the cache chunk by chunk, the mask and score matrix only cover one chunk of queries
+            chunk_outputs = list(
+                self.iter_prefill(
+                    inputs_embeds=inputs_embeds,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=past_key_values,
+                    cache_position=cache_position,
+                    output_hidden_states=output_hidden_states,
+                )
+            )
+            hidden_states = torch.cat([outputs.last_hidden_state for outputs in chunk_outputs], dim=1)
+            all_hidden_states = None
+            if output_hidden_states:
+                all_hidden_states = tuple(
+                    torch.cat(layer_states, dim=1)
+                    for layer_states in zip(*(outputs.hidden_states for outputs in chunk_outputs))
+                )
+            next_cache = past_key_values.to_legacy_cache() if return_legacy_cache else past_key_values
+
+            if not return_dict:
+                return tuple(v for v in [hidden_states, next_cache, all_hidden_states] if v is not None)
+
+            return BaseModelOutputWithPast(
+                last_hidden_state=hidden_states,
+                past_key_values=next_cache,
+                hidden_states=all_hidden_states,
+            )
+
+        sliding_window_layers = [decoder_layer.attn.sliding_window is not None for decoder_layer in self.layers]
+        causal_mask = None
+        if not all(sliding_window_layers) or not isinstance(past_key_values, DogeSlidingWindowCache):
+            # the full causal mask grows with the history, it is skipped when every layer keeps a bounded window
+            causal_mask = self._update_causal_mask(
+                attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions
+            )
+        sliding_window_mask = None
+        if any(sliding_window_layers):
+            sliding_window_mask = self._update_sliding_window_mask(
+                attention_mask, inputs_embeds, causal_mask, cache_position, past_key_values
+            )
         hidden_states = inputs_embeds
 
         # create position embeddings to be shared across the decoder layers
+        # size the cos and sin table on the host from the cache length, `position_ids` are only read when given
+        if isinstance(past_key_values, StaticCache):
+            # once for the whole static cache, so decoding never reallocates it
+            self.rotary_emb.extend_cos_sin_cache(past_key_values.get_max_cache_shape())
+        else:
+            past_seen_tokens = past_key_values.get_seq_length() if isinstance(past_key_values, Cache) else 0
+            rope_len = past_seen_tokens + inputs_embeds.shape[1]
+            if custom_position_ids and position_ids.numel() > 0:
+                # position ids of the caller, e.g. shifted or packed, may run past the cached plus new length
+                rope_len = max(rope_len, int(position_ids.max()) + 1)
+            self.rotary_emb.extend_cos_sin_cache(rope_len)
         position_embeddings = self.rotary_emb(hidden_states, position_ids)
 
         # decoder layers
         all_hidden_states = () if output_hidden_states else None
         all_self_attns = () if output_attentions else None
         next_decoder_cache = None
+        # the residual connection closing every layer is fused with the input norm of the next layer, and the last one
+        # with the final norm, unless the hidden states between the layers are returned
+        defer_residual = not output_hidden_states
+        residual_states, previous_residual = None, None
 
         for decoder_layer in self.layers:
             if output_hidden_states:
                 all_hidden_states += (hidden_states,)
+            layer_mask = sliding_window_mask if decoder_layer.attn.sliding_window is not None else causal_mask
 
-            if self.gradient_checkpointing and self.training:
+            if self.gradient_checkpointing and self.training and self.config.gradient_checkpointing_policy == "full":
                 layer_outputs = self._gradient_checkpointing_func(
                     decoder_layer.__call__,
                     hidden_states,
-                    causal_mask,
+                    layer_mask,
                     position_ids,
                     past_key_values,
                     output_attentions,
                     use_cache,
                     cache_position,
                     position_embeddings,
+                    residual_states,
+                    previous_residual,
+                    defer_residual,
                 )
             else:
                 layer_outputs = decoder_layer(
                     hidden_states,
-                    attention_mask=causal_mask,
+                    attention_mask=layer_mask,
                     position_ids=position_ids,
                     past_key_value=past_key_values,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
                     cache_position=cache_position,
                     position_embeddings=position_embeddings,
+                    residual_states=residual_states,
+                    previous_residual=previous_residual,
+                    defer_residual=defer_residual,
                 )
 
             hidden_states = layer_outputs[0]
+            if defer_residual:
+                residual_states, previous_residual = layer_outputs[-1], decoder_layer.post_state_residual
 
             if use_cache:
                 next_decoder_cache = layer_outputs[2 if output_attentions else 1]
@@ -775,7 +1367,18 @@ class DogeModel(DogePreTrainedModel):
             if output_attentions:
                 all_self_attns += (layer_outputs[1],)
 
-        hidden_states = self.final_layernorm(hidden_states)
+        if residual_states is not None:
+            _, hidden_states = fused_residual_rms_norm(
+                residual_states,
+                hidden_states,
+                previous_residual,
+                self.final_layernorm,
+                dropout_p=self.config.hidden_dropout,
+                training=self.training,
+                use_compile=self.config.compile_residual_norm,
+            )
+        else:
+            hidden_states = self.final_layernorm(hidden_states)
 
         # add hidden states from the last decoder layer
         if output_hidden_states:
@@ -795,6 +1398,68 @@ class DogeModel(DogePreTrainedModel):
             attentions=all_self_attns,
         )
 
+    def iter_prefill(
+        self,
+        input_ids: Optional[torch.LongTensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        past_key_values: Optional[Cache] = None,
+        inputs_embeds: Optional[torch.FloatTensor] = None,
+        cache_position: Optional[torch.LongTensor] = None,
+        chunk_size: Optional[int] = None,
+        output_hidden_states: Optional[bool] = None,
+    ) -> Iterator[BaseModelOutputWithPast]:
+        """
+        Feed a prompt through `past_key_values` `chunk_size` tokens at a time and yield the output of every chunk.
+
+        Every chunk attends to the cached tokens and to itself, so the peak memory of the attention mask and score
+        matrix is bounded by `chunk_size` queries instead of the prompt length. The generator can be advanced one
+        chunk at a time to interleave the prefill of a long prompt with the decoding steps of other requests. The
+        arguments not listed below are the ones of [`DogeModel.forward`] for the whole prompt.
+
+        Args:
+            attention_mask (`torch.Tensor` of shape `(batch_size, past_length + sequence_length)`, *optional*):
+                2D padding mask of the cached tokens followed by the prompt.
+            past_key_values (`Cache`, *optional*):
+                The cache filled by the prefill, a new [`DogeDynamicCache`], or [`DogeSlidingWindowCache`] when
+                `config.sliding_window` is set, if not given.
+            chunk_size (`int`, *optional*):
+                Number of tokens fed at a time, defaults to `config.prefill_chunk_size`.
+        """
+        chunk_size = chunk_size if chunk_size is not None else self.config.prefill_chunk_size
+        if chunk_size is None:
+            raise ValueError("`chunk_size` must be given when `config.prefill_chunk_size` is not set.")
+        if inputs_embeds is None:
+            inputs_embeds = self.word_embed(input_ids)
+        if past_key_values is None:
+            past_key_values = (
+                DogeSlidingWindowCache.from_config(self.config)
+                if self.config.sliding_window is not None
+                else DogeDynamicCache()
+            )
+
+        seq_len = inputs_embeds.shape[1]
+        if cache_position is None:
+            past_seen_tokens = past_key_values.get_seq_length()
+            cache_position = torch.arange(past_seen_tokens, past_seen_tokens + seq_len, device=inputs_embeds.device)
+        if position_ids is None:
+            position_ids = cache_position.unsqueeze(0)
+        mask_offset = attention_mask.shape[-1] - seq_len if attention_mask is not None else 0
+
+        for start in range(0, seq_len, chunk_size):
+            end = min(start + chunk_size, seq_len)
+            yield self(
+                inputs_embeds=inputs_embeds[:, start:end],
+                attention_mask=attention_mask[:, : mask_offset + end] if attention_mask is not None else None,
+                position_ids=position_ids[:, start:end],
+                past_key_values=past_key_values,
+                use_cache=True,
+                output_attentions=False,
+                output_hidden_states=output_hidden_states,
+                return_dict=True,
+                cache_position=cache_position[start:end],
+            )
+
     def _update_causal_mask(
         self,
         attention_mask: torch.Tensor = None,
@@ -829,7 +1494,43 @@ class DogeModel(DogePreTrainedModel):
         )
 
         return causal_mask
-    
+
+    def _update_sliding_window_mask(
+        self,
+        attention_mask: Optional[torch.Tensor],
+        input_tensor: torch.Tensor,
+        causal_mask: Optional[torch.Tensor],
+        cache_position: torch.LongTensor,
+        past_key_values: Optional[Cache],
+    ) -> torch.Tensor:
+        """
+        Mask of the sliding window layers, the causal and padding mask restricted to the `config.sliding_window` most
+        recent tokens. A [`DogeSlidingWindowCache`] returns its ring buffer followed by the new tokens, so the mask
+        covers these keys, with the padding of every key gathered from its position. The other caches return every
+        token in order and the window is applied on top of `causal_mask`. The dynamic mask is added by every layer.
+        """
+        dtype, device = input_tensor.dtype, input_tensor.device
+        min_dtype = torch.finfo(dtype).min
+        if not isinstance(past_key_values, DogeSlidingWindowCache):
+            key_positions = torch.arange(causal_mask.shape[-1], device=device)
+            distance = cache_position[:, None] - key_positions[None, :]
+            return causal_mask.masked_fill(distance >= self.config.sliding_window, min_dtype)
+
+        if attention_mask is not None and attention_mask.dim() == 4:
+            raise ValueError(
+                "A 4D `attention_mask` can not be combined with a `DogeSlidingWindowCache`, pass a 2D padding mask."
+            )
+        layer_idx = next(idx for idx, layer in enumerate(self.layers) if layer.attn.sliding_window is not None)
+        key_positions = past_key_values.get_key_positions(cache_position, layer_idx)
+        distance = cache_position[:, None] - key_positions[None, :]
+        attend = (key_positions >= 0) & (distance >= 0) & (distance < self.config.sliding_window)
+        attend = attend[None, None, :, :]
+        if attention_mask is not None:
+            padding = attention_mask[:, key_positions.clamp(0, attention_mask.shape[-1] - 1)].bool()
+            attend = attend & padding[:, None, None, :]
+        sliding_window_mask = torch.zeros(attend.shape, dtype=dtype, device=device)
+        return sliding_window_mask.masked_fill(~attend, min_dtype)
+
     @staticmethod
     def _prepare_4d_causal_attention_mask_with_cache_position(
         attention_mask: torch.Tensor = None,
@@ -888,6 +1589,79 @@ class DogeModel(DogePreTrainedModel):
         return causal_mask
 
 
+class ChunkedLinearCrossEntropy(torch.autograd.Function):
+    """
+    Summed cross entropy of `hidden_states @ weight.T` against `labels`, computed `chunk_size` rows at a time.
+    Only the log-sum-exp of every row is kept for backward, the logits of each chunk are recomputed there,
+    so the full `(num_tokens, vocab_size)` logits are never materialized.
+    """
+
+    @staticmethod
+    def forward(ctx, hidden_states, weight, labels, chunk_size):
+        with torch.autocast(device_type=hidden_states.device.type, enabled=False):
+            loss = torch.zeros((), dtype=torch.float32, device=hidden_states.device)
+            logsumexp = torch.empty(hidden_states.shape[0], dtype=torch.float32, device=hidden_states.device)
+            for start in range(0, hidden_states.shape[0], chunk_size):
+                end = start + chunk_size
+                logits = F.linear(hidden_states[start:end], weight).float()
+                logsumexp[start:end] = torch.logsumexp(logits, dim=-1)
+                target_logits = logits.gather(-1, labels[start:end, None]).squeeze(-1)
+                loss += (logsumexp[start:end] - target_logits).sum()
+
+        ctx.save_for_backward(hidden_states, weight, labels, logsumexp)
+        ctx.chunk_size = chunk_size
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        hidden_states, weight, labels, logsumexp = ctx.saved_tensors
+        grad_hidden_states = torch.empty_like(hidden_states) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32) if ctx.needs_input_grad[1] else None
+
+        with torch.autocast(device_type=hidden_states.device.type, enabled=False):
+            for start in range(0, hidden_states.shape[0], ctx.chunk_size):
+                end = start + ctx.chunk_size
+                chunk_hidden_states = hidden_states[start:end]
+                logits = F.linear(chunk_hidden_states, weight).float()
+                # d(loss)/d(logits) = softmax(logits) - one_hot(labels)
+                grad_logits = torch.exp(logits - logsumexp[start:end, None])
+                grad_logits.scatter_add_(
+                    -1, labels[start:end, None], grad_logits.new_full((grad_logits.shape[0], 1), -1.0)
+                )
+                grad_logits = (grad_logits * grad_output).to(weight.dtype)
+                if grad_hidden_states is not None:
+                    grad_hidden_states[start:end] = grad_logits @ weight
+                if grad_weight is not None:
+                    grad_weight += (grad_logits.t() @ chunk_hidden_states).float()
+
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        return grad_hidden_states, grad_weight, None, None
+
+
+def chunked_causal_lm_loss(
+    hidden_states: torch.Tensor,
+    weight: torch.Tensor,
+    labels: torch.LongTensor,
+    chunk_size: int,
+    num_items_in_batch: Optional[int] = None,
+    ignore_index: int = -100,
+    **kwargs,
+) -> torch.Tensor:
+    """
+    Same loss as `ForCausalLMLoss` on `lm_head(hidden_states)`, but through [`ChunkedLinearCrossEntropy`].
+    Positions whose label is `ignore_index` are dropped before the projection, so they cost no compute.
+    """
+    # shift so that tokens < n predict n
+    shift_labels = F.pad(labels, (0, 1), value=ignore_index)[..., 1:].reshape(-1).to(hidden_states.device)
+    valid = shift_labels != ignore_index
+    hidden_states = hidden_states.reshape(-1, hidden_states.shape[-1])[valid].to(weight.dtype)
+    loss = ChunkedLinearCrossEntropy.apply(hidden_states, weight, shift_labels[valid], chunk_size)
+    if num_items_in_batch is None:
+        return loss / valid.sum()
+    return loss / num_items_in_batch
+
+
 class DogeForCausalLM(DogePreTrainedModel, GenerationMixin):
     _tied_weights_keys = ["lm_head.weight"]
 
@@ -919,6 +1693,21 @@ class DogeForCausalLM(DogePreTrainedModel, GenerationMixin):
     def get_decoder(self):
         return self.model
 
+    def _prepare_cache_for_generation(self, generation_config, model_kwargs: Dict, *args, **kwargs):
+        """
+        With `config.sliding_window` set, `generate` decodes with a [`DogeSlidingWindowCache`] instead of the
+        `DynamicCache` it builds by default, in which the sliding window layers would keep their whole history.
+        """
+        if (
+            self.config.sliding_window is not None
+            and model_kwargs.get("past_key_values") is None
+            and generation_config.use_cache
+            and generation_config.cache_implementation is None
+        ):
+            model_kwargs["past_key_values"] = DogeSlidingWindowCache.from_config(self.config)
+            return
+        return super()._prepare_cache_for_generation(generation_config, model_kwargs, *args, **kwargs)
+
     @add_start_docstrings_to_model_forward(DOGE_INPUTS_DOCSTRING)
     @replace_return_docstrings(output_type=CausalLMOutputWithPast, config_class=_CONFIG_FOR_DOC)
     def forward(
@@ -973,12 +1762,18 @@ class DogeForCausalLM(DogePreTrainedModel, GenerationMixin):
 
         hidden_states = outputs[0]
 
-        # only compute necessary logits, and do not upcast them to float if we are not computing the loss
-        logits = self.lm_head(hidden_states[:, -num_logits_to_keep:, :])
-
+        logits = None
         loss = None
-        if labels is not None:
-            loss = self.loss_function(logits=logits, labels=labels, vocab_size=self.vocab_size, **loss_kwargs)
+        if labels is not None and self.training and self.config.loss_chunk_size is not None:
+            # chunked linear + cross entropy, the full vocabulary logits are never materialized
+            loss = chunked_causal_lm_loss(
+                hidden_states, self.lm_head.weight, labels, self.config.loss_chunk_size, **loss_kwargs
+            )
+        else:
+            # only compute necessary logits, and do not upcast them to float if we are not computing the loss
+            logits = self.lm_head(hidden_states[:, -num_logits_to_keep:, :])
+            if labels is not None:
+                loss = self.loss_function(logits=logits, labels=labels, vocab_size=self.vocab_size, **loss_kwargs)
 
         if not return_dict:
             output = (logits,) + outputs[1:]
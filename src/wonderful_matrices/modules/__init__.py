@@ -50,6 +50,10 @@ else:
         "MLP",
         "GatedMLP",
     ]
+    _import_structure["residual_norm"] = [
+        "fused_residual_rms_norm",
+        "residual_rms_norm",
+    ]
 
 
 if TYPE_CHECKING:
@@ -66,6 +70,7 @@ if TYPE_CHECKING:
         from .peer import PEER
         from .seimoe import SEIMoE
         from .mlp import MLP, GatedMLP
+        from .residual_norm import fused_residual_rms_norm, residual_rms_norm
 
 
 else:
@@ -17,16 +17,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import importlib.util
 import math
 from typing import Tuple
 import torch
 from torch import nn
 from transformers.activations import ACT2FN
 
-try:
-    from einx import add as einx_add
-except ImportError:
-    einx_add = None
+# einx is only needed by the CDMoE router and slow to import, so it is imported on first use
+is_einx_available = importlib.util.find_spec("einx") is not None
+_einx_add = None
+
+
+def _get_einx_add():
+    """Returns `einx.add`, imported once on the first call."""
+    global _einx_add
+    if _einx_add is None:
+        from einx import add
+
+        _einx_add = add
+    return _einx_add
 
 
 class CDMoE(nn.Module):
@@ -106,7 +116,8 @@ class CDMoE(nn.Module):
 
         # get experts with the highest similarity
         (scores_x, scores_y), (indices_x, indices_y) = sim.topk(self.num_cdmmoe_experts_per_head, dim=-1)
-        if einx_add is not None:
+        if is_einx_available:
+            einx_add = _get_einx_add()
             all_scores = einx_add("... i, ... j -> ... (i j)", scores_x, scores_y)
             all_indices = einx_add("... i, ... j -> ... (i j)", indices_x * self.num_keys, indices_y)
         else:
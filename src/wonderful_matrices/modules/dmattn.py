@@ -33,7 +33,8 @@ class DMAttn(nn.Module):
         d_model: int,
         n_heads: int,
         max_position_embeddings: int,
-        layer_idx: Optional[int] = None
+        layer_idx: Optional[int] = None,
+        attention_dropout: float = 0.0,
     ):
         super().__init__()
 
@@ -41,6 +42,7 @@ class DMAttn(nn.Module):
 
         self.hidden_dim = d_model
         self.num_attention_heads = n_heads
+        self.attention_dropout = attention_dropout
         self.attention_head_dim = self.hidden_dim // self.num_attention_heads
      
         # Q K V O projections
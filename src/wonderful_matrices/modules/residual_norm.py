@@ -0,0 +1,97 @@
+# coding=utf-8
+# Copyright 2024 Jingze Shi. All rights reserved.
+#
+# This code is based on the Wonderful Matrices paper implementation.
+#
+#     https://arxiv.org/abs/2412.11834
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Residual connection fused with the following RMSNorm, shared by the Doge and Cheems decoder layers."""
+
+from typing import Tuple
+import torch
+import torch.nn.functional as F
+from torch import nn
+from transformers.utils import logging
+
+
+logger = logging.get_logger(__name__)
+
+
+def residual_rms_norm(
+    residual_states: torch.Tensor,
+    hidden_states: torch.Tensor,
+    residual_weight: torch.Tensor,
+    norm_weight: torch.Tensor,
+    eps: float,
+    dropout_p: float = 0.0,
+    training: bool = False,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Dropout, `Residual` and the following `RMSNorm` in a single function, returns the new residual states and the
+    normalized states. Compiled by `torch.compile` this becomes one pass over the hidden states.
+    """
+    hidden_states = F.dropout(hidden_states, p=dropout_p, training=training)
+    residual_states = residual_weight * residual_states + hidden_states
+    input_dtype = residual_states.dtype
+    hidden_states = residual_states.to(torch.float32)
+    variance = hidden_states.pow(2).mean(-1, keepdim=True)
+    hidden_states = hidden_states * torch.rsqrt(variance + eps)
+    return residual_states, norm_weight * hidden_states.to(input_dtype)
+
+
+_compiled_residual_rms_norm = None
+
+
+def _compilation_errors() -> Tuple[type, ...]:
+    """Errors raised when `torch.compile` can not compile a function, as opposed to errors of the computation."""
+    from torch._dynamo.exc import BackendCompilerFailed, Unsupported
+
+    return (BackendCompilerFailed, Unsupported)
+
+
+def fused_residual_rms_norm(
+    residual_states: torch.Tensor,
+    hidden_states: torch.Tensor,
+    residual: nn.Module,
+    norm: nn.Module,
+    dropout_p: float = 0.0,
+    training: bool = False,
+    use_compile: bool = False,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Run [`residual_rms_norm`] with the weights of `residual` and `norm`, compiled with `torch.compile` if
+    `use_compile`. When compilation fails, `norm` falls back to eager mode, other errors are raised as is.
+    """
+    global _compiled_residual_rms_norm
+    args = (residual_states, hidden_states, residual.weight, norm.weight, norm.variance_epsilon, dropout_p, training)
+    # inside an outer `torch.compile` or a TorchScript/ONNX trace the eager function is captured instead
+    is_compiling = getattr(getattr(torch, "compiler", None), "is_compiling", None)
+    if (
+        not use_compile
+        or getattr(norm, "compile_failed", False)
+        or not hasattr(torch, "compile")
+        or torch.jit.is_tracing()
+        or torch.jit.is_scripting()
+        or (is_compiling is not None and is_compiling())
+    ):
+        return residual_rms_norm(*args)
+
+    if _compiled_residual_rms_norm is None:
+        _compiled_residual_rms_norm = torch.compile(residual_rms_norm, dynamic=True)
+    try:
+        return _compiled_residual_rms_norm(*args)
+    except _compilation_errors() as e:
+        logger.warning_once(f"Failed to compile the fused residual RMSNorm, falling back to eager mode: {e}")
+        norm.compile_failed = True
+        return residual_rms_norm(*args)
@@ -0,0 +1,35 @@
+from argparse import Namespace
+
+import torch
+
+from wonderful_matrices.bench.modules import run_sweep
+from wonderful_matrices.bench.utils import count_allocations
+
+
+def test_count_allocations():
+    x, w = torch.randn(256, 256), torch.randn(256, 512)
+    # 512KB for `x @ w` and for the relu, 256KB for the output
+    num_allocations, allocated_mb = count_allocations(lambda: (x @ w).relu() @ w.T)
+    assert num_allocations >= 3
+    assert allocated_mb >= 1.25
+
+
+def test_sweep_records_failed_configurations():
+    args = Namespace(
+        modules=["SSD", "CDMoE"],
+        batch_sizes=[1],
+        seq_lens=[16, 64],
+        hidden_sizes=[64],
+        num_experts=[15, 16],
+        warmup=0,
+        repeats=1,
+        dtype="float32",
+    )
+    results = run_sweep(args)
+    errors = {(result["module"], result["seq_len"], result["num_experts"]): result.get("error") for result in results}
+    # `seq_len` 16 is not a multiple of the SSD `chunk_len` 64, 15 experts are not a perfect square
+    assert "chunk_len" in errors.pop(("SSD", 16, None))
+    assert "perfect square" in errors.pop(("CDMoE", 16, 15))
+    assert "perfect square" in errors.pop(("CDMoE", 64, 15))
+    assert errors == {("SSD", 64, None): None, ("CDMoE", 16, 16): None, ("CDMoE", 64, 16): None}
+    assert all(result["num_allocations"] > 0 for result in results if "error" not in result)
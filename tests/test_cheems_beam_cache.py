@@ -0,0 +1,103 @@
+import pytest
+import torch
+
+from wonderful_matrices.models.configuration_cheems import CheemsConfig
+from wonderful_matrices.models.modeling_cheems import CheemsForCausalLM, HybridSSDAttnDynamicCache
+
+
+def tiny_config(**kwargs):
+    # attention layers only, the ssd layers need the CUDA kernels of mamba_ssm
+    return CheemsConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        attn_layer_period=1,
+        attn_layer_offset=0,
+        pad_token_id=0,
+        eos_token_id=None,
+        **kwargs,
+    )
+
+
+def test_block_reorder_matches_index_select():
+    config = tiny_config()
+    generator = torch.Generator().manual_seed(0)
+    num_beams, block_size = 6, 4
+    caches = [
+        HybridSSDAttnDynamicCache(
+            config, num_beams, dtype=torch.float32, layer_type=config.layers_type, block_size=size
+        )
+        for size in (None, block_size)
+    ]
+    # two prompts expanded to three beams each, as `generate` does
+    prompt = torch.randn(2, 2, 10, 16, generator=generator).repeat_interleave(3, dim=0)
+    for cache in caches:
+        for layer_idx in range(config.num_hidden_layers):
+            cache.update(prompt, -prompt, layer_idx)
+    block_ids = caches[1].block_ids[0][:, : 10 // block_size]
+    assert torch.equal(block_ids[:3], block_ids[:1].expand(3, -1))
+    assert torch.equal(block_ids[3:], block_ids[3:4].expand(3, -1))
+    assert not torch.equal(block_ids[0], block_ids[3])
+
+    for _ in range(24):
+        beam_idx = torch.randint(0, num_beams, (num_beams,), generator=generator)
+        key_states = torch.randn(num_beams, 2, 1, 16, generator=generator)
+        for cache in caches:
+            cache.reorder_cache(beam_idx)
+            for layer_idx in range(config.num_hidden_layers):
+                cache.update(key_states, key_states + 1, layer_idx)
+        for layer_idx in range(config.num_hidden_layers):
+            torch.testing.assert_close(caches[1].key_cache[layer_idx], caches[0].key_cache[layer_idx], rtol=0, atol=0)
+            torch.testing.assert_close(
+                caches[1].value_cache[layer_idx], caches[0].value_cache[layer_idx], rtol=0, atol=0
+            )
+
+    # a pending reorder is applied before cropping
+    for cache in caches:
+        cache.reorder_cache(torch.arange(num_beams).flip(0))
+        cache.crop(21)
+    caches[1].materialize()
+    torch.testing.assert_close(caches[1].key_cache[0], caches[0].key_cache[0], rtol=0, atol=0)
+
+
+def test_block_reorder_copies_only_diverged_blocks():
+    config = tiny_config()
+    cache = HybridSSDAttnDynamicCache(config, 4, dtype=torch.float32, layer_type=config.layers_type, block_size=4)
+    prompt = torch.randn(1, 2, 16, 16).expand(4, -1, -1, -1)
+    cache.update(prompt, prompt, 0)
+    cache.update(torch.randn(4, 2, 1, 16), torch.randn(4, 2, 1, 16), 0)
+
+    copied = []
+    buffer = cache.key_buffers[0]
+    cache.reorder_cache(torch.tensor([1, 1, 2, 0]))
+    before = buffer.clone()
+    cache.update(torch.randn(4, 2, 1, 16), torch.randn(4, 2, 1, 16), 0)
+    for row in range(4):
+        changed = (buffer[row, :, :17] != before[row, :, :17]).any(-1).any(0)
+        copied.append(changed.nonzero().flatten().tolist())
+    # the prompt blocks are shared by every beam, only the last block of the beams with a new parent is copied
+    assert copied == [[16], [], [], [16]]
+
+
+@pytest.mark.parametrize("num_beams", [4, 8])
+@torch.no_grad()
+def test_generate_beam_search_with_block_tables(num_beams):
+    torch.manual_seed(0)
+    model = CheemsForCausalLM(tiny_config()).eval()
+    input_ids = torch.randint(3, 64, (2, 7))
+    outputs = model.generate(
+        input_ids, max_new_tokens=12, num_beams=num_beams, do_sample=False, return_dict_in_generate=True
+    )
+    assert isinstance(outputs.past_key_values, HybridSSDAttnDynamicCache)
+    assert outputs.past_key_values.block_size is not None
+
+    config = model.config
+    cache = HybridSSDAttnDynamicCache(
+        config, 2 * num_beams, dtype=model.dtype, layer_type=config.layers_type, block_size=None
+    )
+    expected = model.generate(
+        input_ids, max_new_tokens=12, num_beams=num_beams, do_sample=False, past_key_values=cache
+    )
+    torch.testing.assert_close(outputs.sequences, expected)
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from wonderful_matrices.models.configuration_doge import DogeConfig
+from wonderful_matrices.models.modeling_doge import DogeForCausalLM, _unpacked_checkpoint_files
+
+
+def unpack_projections(state_dict, config):
+    """Split the packed projections back into the layout of the checkpoints saved before they were packed."""
+    head_dim = config.hidden_size // config.num_attention_heads
+    unpacked = {}
+    for key, value in state_dict.items():
+        if ".qkv_proj." in key:
+            for name, part in zip(("q_proj", "k_proj", "v_proj"), value.split(config.num_attention_heads * head_dim)):
+                unpacked[key.replace("qkv_proj", name)] = part.clone()
+        elif ".gate_up_proj." in key:
+            for name, part in zip(("gate_proj", "up_proj"), value.split(config.intermediate_size)):
+                unpacked[key.replace("gate_up_proj", name)] = part.clone()
+        else:
+            unpacked[key] = value.clone()
+    return unpacked
+
+
+@pytest.fixture(params=[("safetensors", False), ("bin", False), ("safetensors", True), ("sharded", False)])
+def old_checkpoint(request, tmp_path):
+    torch.manual_seed(0)
+    weights_format, is_moe = request.param
+    config = DogeConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        is_moe=is_moe,
+        num_cdmmoe_experts=16,
+        num_cdmmoe_heads=2,
+        num_cdmmoe_experts_per_head=2,
+        expert_retrieval_size=16,
+    )
+    model = DogeForCausalLM(config).eval()
+    config.save_pretrained(tmp_path)
+    state_dict = unpack_projections(model.state_dict(), config)
+    if weights_format == "safetensors":
+        save_file(state_dict, str(tmp_path / "model.safetensors"), {"format": "pt"})
+    elif weights_format == "sharded":
+        # every `q_proj` in the first shard, so all the projections are split across the two shards
+        shard_names = ["model-00001-of-00002.safetensors", "model-00002-of-00002.safetensors"]
+        weight_map = {key: shard_names[".q_proj." not in key] for key in state_dict}
+        for shard_name in shard_names:
+            shard = {key: value for key, value in state_dict.items() if weight_map[key] == shard_name}
+            save_file(shard, str(tmp_path / shard_name), {"format": "pt"})
+        with open(tmp_path / "model.safetensors.index.json", "w") as f:
+            json.dump({"metadata": {}, "weight_map": weight_map}, f)
+    else:
+        torch.save(state_dict, tmp_path / "pytorch_model.bin")
+    return tmp_path, model
+
+
+@pytest.mark.parametrize("low_cpu_mem_usage", [False, True])
+def test_from_pretrained_packs_old_projections(old_checkpoint, low_cpu_mem_usage):
+    path, model = old_checkpoint
+    loaded = DogeForCausalLM.from_pretrained(path, low_cpu_mem_usage=low_cpu_mem_usage).eval()
+    expected = model.state_dict()
+    for key, value in loaded.state_dict().items():
+        torch.testing.assert_close(value, expected[key], msg=key)
+
+    input_ids = torch.randint(3, 64, (1, 8))
+    torch.testing.assert_close(loaded(input_ids).logits, model(input_ids).logits)
+
+
+def test_from_pretrained_keeps_loading_info(old_checkpoint):
+    path, _ = old_checkpoint
+    loaded, loading_info = DogeForCausalLM.from_pretrained(path, output_loading_info=True)
+    assert loading_info["missing_keys"] == [] and loading_info["unexpected_keys"] == []
+    assert loaded.name_or_path == str(path)
+
+
+def test_packed_bin_checkpoint_is_not_repacked(tmp_path):
+    torch.manual_seed(0)
+    config = DogeConfig(vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=2)
+    model = DogeForCausalLM(config).eval()
+    model.save_pretrained(tmp_path, safe_serialization=False)
+    assert _unpacked_checkpoint_files(str(tmp_path)) is None
+
+    loaded = DogeForCausalLM.from_pretrained(tmp_path).eval()
+    input_ids = torch.randint(3, 64, (1, 8))
+    torch.testing.assert_close(loaded(input_ids).logits, model(input_ids).logits)
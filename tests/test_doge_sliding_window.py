@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from wonderful_matrices.generation.speculative import speculative_generate
+from wonderful_matrices.models.configuration_doge import DogeConfig
+from wonderful_matrices.models.modeling_doge import DogeDynamicCache, DogeForCausalLM, DogeSlidingWindowCache
+
+
+def tiny_model(seed, **kwargs):
+    torch.manual_seed(seed)
+    config = DogeConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        pad_token_id=0,
+        eos_token_id=None,
+        **kwargs,
+    )
+    return DogeForCausalLM(config).eval()
+
+
+@pytest.mark.parametrize("sliding_window_layers", [None, [0]])
+@torch.no_grad()
+def test_generate_decodes_with_ring_buffer(sliding_window_layers):
+    model = tiny_model(0, sliding_window=4, sliding_window_layers=sliding_window_layers)
+    input_ids = torch.randint(3, 64, (2, 6))
+    outputs = model.generate(input_ids, max_new_tokens=8, do_sample=False, return_dict_in_generate=True)
+
+    cache = outputs.past_key_values
+    assert isinstance(cache, DogeSlidingWindowCache)
+    for layer_idx in range(model.config.num_hidden_layers):
+        if cache.is_sliding_window_layer(layer_idx):
+            assert cache.key_cache[layer_idx].shape[-2] == model.config.sliding_window
+            assert cache.dt_cache[layer_idx].shape[-2] == model.config.sliding_window
+        else:
+            assert cache.key_cache[layer_idx].shape[-2] == outputs.sequences.shape[1] - 1
+
+    # the same tokens as keeping the whole history and applying the window through the mask
+    expected = model.generate(input_ids, max_new_tokens=8, do_sample=False, past_key_values=DogeDynamicCache())
+    torch.testing.assert_close(outputs.sequences, expected)
+
+
+def test_sliding_window_cache_can_not_be_cropped():
+    cache = DogeSlidingWindowCache(sliding_window=4)
+    with pytest.raises(ValueError, match="can not be cropped"):
+        cache.crop(2)
+
+
+@torch.no_grad()
+def test_speculative_generate_with_sliding_window():
+    target_model = tiny_model(0, sliding_window=4)
+    draft_model = tiny_model(1)
+    input_ids = torch.randint(3, 64, (1, 6))
+    outputs = speculative_generate(target_model, draft_model, input_ids, max_new_tokens=8, num_lookahead_tokens=3)
+    expected = target_model.generate(input_ids, max_new_tokens=8, do_sample=False)
+    torch.testing.assert_close(outputs.sequences, expected)
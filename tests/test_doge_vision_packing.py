@@ -0,0 +1,67 @@
+import pytest
+import torch
+
+from wonderful_matrices.models.configuration_doge_vision import DogeConfig
+from wonderful_matrices.models.modeing_doge_vision import DogeForCausalVLM
+
+
+def tiny_model(attn_implementation):
+    torch.manual_seed(0)
+    config = DogeConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        image_size=[16, 16],
+        patch_size=8,
+        max_position_embeddings=32,
+    )
+    config._attn_implementation = attn_implementation
+    model = DogeForCausalVLM(config).eval()
+    # a trained dynamic mask drops some positions, the initial one keeps them all
+    for layer in model.model.layers:
+        layer.attn.dynamic_mask[:, torch.rand(config.max_position_embeddings) < 0.3] = 0
+    return model
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+@torch.no_grad()
+def test_packed_samples_match_alone(attn_implementation):
+    model = tiny_model(attn_implementation)
+    input_ids = [torch.randint(3, 64, (length,)) for length in (10, 20, 7)]
+    images = [[torch.randn(3, 16, 8)], [], [torch.randn(3, 8, 16), torch.randn(3, 16, 16)]]
+    packed = model.pack_inputs(input_ids, images)
+    assert "attention_mask" not in packed
+    # the row is longer than `max_position_embeddings`, every sample fits in it
+    assert packed.inputs_embeds.shape[1] > model.config.max_position_embeddings
+    logits = model(**packed, use_cache=False).logits
+    # the positions restart at every sample without being passed
+    no_positions = model(inputs_embeds=packed.inputs_embeds, cu_seqlens=packed.cu_seqlens).logits
+    torch.testing.assert_close(no_positions, logits, rtol=0, atol=0)
+
+    for sample_idx, sample_logits in enumerate(logits[0].split(packed.cu_seqlens.diff().tolist())):
+        alone = model.pack_inputs(input_ids[sample_idx : sample_idx + 1], images[sample_idx : sample_idx + 1])
+        alone_logits = model(inputs_embeds=alone.inputs_embeds, use_cache=False).logits[0]
+        torch.testing.assert_close(sample_logits, alone_logits)
+
+
+@torch.no_grad()
+def test_packed_samples_cannot_be_cached():
+    model = tiny_model("sdpa")
+    packed = model.pack_inputs([torch.randint(3, 64, (5,))], [[]])
+    with pytest.raises(ValueError, match="cu_seqlens"):
+        model(**packed, use_cache=True)
+
+
+@torch.no_grad()
+def test_forward_appends_every_image():
+    model = tiny_model("sdpa")
+    input_ids = torch.randint(3, 64, (2, 6))
+    pixel_values = torch.randn(2, 3, 3, 16, 16)
+    logits = model(input_ids, pixel_values=pixel_values, use_cache=False).logits
+    assert logits.shape[1] == 6 + 3 * 4
+
+    packed = model.pack_inputs(list(input_ids), [list(images) for images in pixel_values])
+    packed_logits = model(**packed, use_cache=False).logits[0]
+    torch.testing.assert_close(packed_logits, logits.flatten(0, 1))
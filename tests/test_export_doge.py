@@ -0,0 +1,82 @@
+import pytest
+import torch
+
+from wonderful_matrices.export.export_doge import check_onnx_parity, export_doge_onnx, export_doge_torchscript
+from wonderful_matrices.models.configuration_doge import DogeConfig
+from wonderful_matrices.models.modeling_doge import DogeDynamicCache, DogeForCausalLM
+
+
+def tiny_config(is_moe=False, sliding_window=None):
+    return DogeConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        is_moe=is_moe,
+        num_cdmmoe_experts=16,
+        num_cdmmoe_heads=2,
+        num_cdmmoe_experts_per_head=2,
+        expert_retrieval_size=16,
+        sliding_window=sliding_window,
+        sliding_window_layers=[0] if sliding_window is not None else None,
+    )
+
+
+@pytest.mark.parametrize(
+    "attn_implementation, is_moe, sliding_window",
+    [("eager", False, None), ("sdpa", False, None), ("eager", True, None), ("sdpa", False, 4)],
+)
+@torch.no_grad()
+def test_torchscript_matches_eager(tmp_path, attn_implementation, is_moe, sliding_window):
+    torch.manual_seed(0)
+    config = tiny_config(is_moe, sliding_window)
+    config._attn_implementation = attn_implementation
+    model = DogeForCausalLM(config).eval()
+    prefill_path, decode_path = export_doge_torchscript(model, str(tmp_path))
+    prefill, decode = torch.jit.load(prefill_path), torch.jit.load(decode_path)
+
+    # a prompt length other than the traced one, with left padding on the first row
+    input_ids = torch.randint(3, 64, (2, 11))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[0, :3] = 0
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+    cache = DogeDynamicCache()
+    eager_logits = model(
+        input_ids, attention_mask=attention_mask, position_ids=position_ids, past_key_values=cache, use_cache=True
+    ).logits[:, -1:]
+    logits, *present_states = prefill(input_ids, attention_mask, position_ids)
+    torch.testing.assert_close(logits, eager_logits)
+
+    next_token = eager_logits.argmax(dim=-1)
+    attention_mask = torch.cat([attention_mask, attention_mask.new_ones(2, 1)], dim=-1)
+    position_ids = attention_mask.cumsum(-1)[:, -1:] - 1
+    eager_logits = model(
+        next_token, attention_mask=attention_mask, position_ids=position_ids, past_key_values=cache, use_cache=True
+    ).logits
+    logits, *present_states = decode(next_token, attention_mask, position_ids, *present_states)
+    torch.testing.assert_close(logits, eager_logits)
+    assert present_states[0].shape[-2] == 12
+
+
+@pytest.mark.parametrize("is_moe", [False, True])
+@torch.no_grad()
+def test_onnx_matches_eager(tmp_path, is_moe):
+    pytest.importorskip("onnxruntime")
+    torch.manual_seed(0)
+    config = tiny_config(is_moe)
+    config._attn_implementation = "eager"
+    model = DogeForCausalLM(config).eval()
+    for name, param in model.named_parameters():
+        # the zero initialized router keys tie every expert, ONNX Runtime and torch break the ties of topk differently
+        if name.endswith("feed_forward.keys"):
+            torch.nn.init.normal_(param)
+    export_doge_onnx(model, str(tmp_path))
+
+    # a prompt length other than the traced one, with left padding on the first row
+    input_ids = torch.randint(3, 64, (2, 11))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[0, :3] = 0
+    max_abs_diff = check_onnx_parity(model, str(tmp_path), input_ids, attention_mask, max_new_tokens=6)
+    assert max_abs_diff <= 1e-4
@@ -0,0 +1,92 @@
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+
+# imported on first use only
+DEFERRED_PACKAGES = ["einx", "mamba_ssm", "onnx", "onnxruntime"]
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)")
+# generous for slow CI machines, the lazy package takes well under a millisecond and each modeling file under 10ms
+LAZY_IMPORT_SECONDS = 0.05
+MODULE_IMPORT_SECONDS = 0.25
+
+
+def run_python(*args):
+    # the same search path as the tests, e.g. `src` added by the pytest configuration
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+    return subprocess.run([sys.executable, *args], capture_output=True, text=True, check=True, env=env)
+
+
+def loaded_modules(statement):
+    """Run `statement` in a fresh interpreter and return the names of the loaded modules."""
+    script = f"import sys\n{statement}\nprint('\\n'.join(sys.modules))"
+    return set(run_python("-c", script).stdout.split())
+
+
+def import_times(module):
+    """Import `module` in a fresh interpreter with `-X importtime`, return the (self, cumulative) seconds by module."""
+    times = {}
+    for line in run_python("-X", "importtime", "-c", f"import {module}").stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, name = match.groups()
+            times[name] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    return times
+
+
+def test_import_package_is_lazy():
+    modules = loaded_modules("import wonderful_matrices")
+    # torch itself comes with `transformers.utils`, the modeling files and their dependencies must stay unloaded
+    eager = sorted(
+        name
+        for name in modules
+        if name.startswith(("wonderful_matrices.models.", "wonderful_matrices.modules.", "wonderful_matrices.export"))
+    )
+    assert eager == []
+    assert sorted(package for package in DEFERRED_PACKAGES if package in modules) == []
+
+
+def test_import_package_time():
+    # best of two runs to reduce the noise
+    extra_seconds = []
+    for _ in range(2):
+        times = import_times("wonderful_matrices")
+        # `transformers` and torch are needed anyway, the package must add next to nothing on top of them
+        extra_seconds.append(times["wonderful_matrices"][1] - times["transformers"][1])
+    assert min(extra_seconds) < LAZY_IMPORT_SECONDS
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "wonderful_matrices.models.modeling_doge",
+        "wonderful_matrices.models.modeling_cheems",
+        "wonderful_matrices.models.modeing_doge_vision",
+        "wonderful_matrices.modules.cdmoe",
+        "wonderful_matrices.export",
+    ],
+)
+def test_import_defers_optional_packages(module):
+    modules = loaded_modules(f"import {module}")
+    assert sorted(package for package in DEFERRED_PACKAGES if package in modules) == []
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "wonderful_matrices.models.modeling_doge",
+        "wonderful_matrices.models.modeling_cheems",
+        "wonderful_matrices.models.modeing_doge_vision",
+    ],
+)
+def test_import_module_time(module):
+    own_seconds = []
+    for _ in range(2):
+        times = import_times(module)
+        own_seconds.append(
+            sum(self_time for name, (self_time, _) in times.items() if name.startswith("wonderful_matrices"))
+        )
+    assert min(own_seconds) < MODULE_IMPORT_SECONDS
@@ -0,0 +1,77 @@
+import pytest
+import torch
+
+from wonderful_matrices.loading.lazy_loading import load_lazy_model, materialize_lazy_layers
+from wonderful_matrices.models.configuration_doge import DogeConfig
+from wonderful_matrices.models.modeling_doge import DogeForCausalLM
+
+
+def save_checkpoint(path, tie_word_embeddings=False, is_moe=False, dtype=torch.float32, max_shard_size="5GB"):
+    torch.manual_seed(0)
+    config = DogeConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        is_moe=is_moe,
+        num_cdmmoe_experts=16,
+        num_cdmmoe_heads=2,
+        num_cdmmoe_experts_per_head=2,
+        expert_retrieval_size=16,
+        tie_word_embeddings=tie_word_embeddings,
+        pad_token_id=0,
+        eos_token_id=None,
+    )
+    model = DogeForCausalLM(config).to(dtype)
+    model.save_pretrained(path, max_shard_size=max_shard_size)
+    return path
+
+
+@pytest.mark.parametrize(
+    "tie_word_embeddings, is_moe, max_shard_size",
+    [(False, False, "5GB"), (True, False, "5GB"), (False, True, "5GB"), (False, False, "20KB")],
+)
+@torch.no_grad()
+def test_lazy_model_matches_from_pretrained(tmp_path, tie_word_embeddings, is_moe, max_shard_size):
+    path = save_checkpoint(tmp_path, tie_word_embeddings, is_moe, max_shard_size=max_shard_size)
+    eager = DogeForCausalLM.from_pretrained(path).eval()
+    lazy = load_lazy_model(DogeForCausalLM, path)
+
+    # the decoder layers are only loaded by their first forward pass
+    assert all(param.is_meta for layer in lazy.model.layers for param in layer.parameters())
+    assert not lazy.model.word_embed.weight.is_meta
+
+    input_ids = torch.randint(3, 64, (2, 7))
+    torch.testing.assert_close(lazy(input_ids).logits, eager(input_ids).logits, rtol=0, atol=0)
+    assert not any(param.is_meta for param in lazy.parameters())
+    torch.testing.assert_close(
+        lazy.generate(input_ids, max_new_tokens=8, do_sample=False),
+        eager.generate(input_ids, max_new_tokens=8, do_sample=False),
+    )
+
+
+@torch.no_grad()
+def test_tied_lm_head_stays_shared(tmp_path):
+    path = save_checkpoint(tmp_path, tie_word_embeddings=True)
+    model = load_lazy_model(DogeForCausalLM, path)
+    assert model.lm_head.weight is model.model.word_embed.weight
+    materialize_lazy_layers(model)
+    assert model.lm_head.weight is model.model.word_embed.weight
+    assert model.lm_head.weight.data_ptr() == model.model.word_embed.weight.data_ptr()
+
+
+@pytest.mark.parametrize("lazy", [True, False])
+@torch.no_grad()
+def test_bf16_checkpoint(tmp_path, lazy):
+    path = save_checkpoint(tmp_path, dtype=torch.bfloat16)
+    eager = DogeForCausalLM.from_pretrained(path, torch_dtype=torch.bfloat16).eval()
+    model = load_lazy_model(DogeForCausalLM, path, lazy=lazy)
+    input_ids = torch.randint(3, 64, (2, 7))
+    logits = model(input_ids).logits
+    assert all(param.dtype == torch.bfloat16 for param in model.parameters())
+    torch.testing.assert_close(logits, eager(input_ids).logits, rtol=0, atol=0)
+
+    # the mapped bf16 weights are cast when loading with another dtype
+    model = load_lazy_model(DogeForCausalLM, path, torch_dtype=torch.float32)
+    torch.testing.assert_close(model(input_ids).logits, eager.float()(input_ids).logits)
@@ -0,0 +1,112 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from wonderful_matrices.adapters.multi_lora import adapter_batch, inject_multi_lora, load_lora_adapter
+from wonderful_matrices.models.configuration_doge import DogeConfig
+from wonderful_matrices.models.modeling_doge import DogeForCausalLM
+
+
+def random_adapter(model, rank, generator):
+    """A PEFT style adapter state dict on the separate q/k/v projections and the down projection of every layer."""
+    config = model.config
+    head_dim = config.hidden_size // config.num_attention_heads
+    adapter = {}
+    for layer_idx in range(config.num_hidden_layers):
+        prefix = f"base_model.model.model.layers.{layer_idx}"
+        for name in ("q_proj", "k_proj", "v_proj"):
+            adapter[f"{prefix}.attn.{name}.lora_A.weight"] = torch.randn(rank, config.hidden_size, generator=generator)
+            adapter[f"{prefix}.attn.{name}.lora_B.weight"] = torch.randn(
+                config.num_attention_heads * head_dim, rank, generator=generator
+            )
+        adapter[f"{prefix}.feed_forward.down_proj.lora_A.weight"] = torch.randn(
+            rank, config.intermediate_size, generator=generator
+        )
+        adapter[f"{prefix}.feed_forward.down_proj.lora_B.weight"] = torch.randn(
+            config.hidden_size, rank, generator=generator
+        )
+    return adapter
+
+
+@pytest.fixture
+def lora_adapters():
+    torch.manual_seed(0)
+    config = DogeConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+    )
+    model = DogeForCausalLM(config).eval()
+    inject_multi_lora(model, num_adapters=2, rank=4)
+    generator = torch.Generator().manual_seed(0)
+    adapters = {}
+    for slot in (1, 2):
+        adapters[slot] = random_adapter(model, 4, generator)
+        load_lora_adapter(model, adapters[slot], slot=slot, lora_alpha=8)
+    return model, adapters
+
+
+@pytest.fixture
+def lora_model(lora_adapters):
+    return lora_adapters[0]
+
+
+@torch.no_grad()
+def test_adapter_batch_matches_merged_weights(lora_adapters):
+    model, adapters = lora_adapters
+    # `lora_alpha / rank`
+    scaling = 8 / 4
+    layer = model.model.layers[0]
+    prefix = "base_model.model.model.layers.0"
+    modules = {
+        "attn.qkv_proj": (layer.attn.qkv_proj, ["attn.q_proj", "attn.k_proj", "attn.v_proj"]),
+        "feed_forward.down_proj": (layer.feed_forward.down_proj, ["feed_forward.down_proj"]),
+    }
+    adapter_ids = [1, 2, 0]
+    for module, peft_names in modules.values():
+        base_layer = module.base_layer
+        hidden_states = torch.randn(3, 5, base_layer.in_features, generator=torch.Generator().manual_seed(2))
+        with adapter_batch(model, adapter_ids):
+            outputs = module(hidden_states)
+        for row, adapter_id in enumerate(adapter_ids):
+            # slot 0 is the base model
+            weight = base_layer.weight
+            if adapter_id != 0:
+                adapter = adapters[adapter_id]
+                delta = torch.cat(
+                    [
+                        adapter[f"{prefix}.{name}.lora_B.weight"] @ adapter[f"{prefix}.{name}.lora_A.weight"]
+                        for name in peft_names
+                    ]
+                )
+                weight = weight + scaling * delta
+            expected = F.linear(hidden_states[row], weight, base_layer.bias)
+            torch.testing.assert_close(outputs[row], expected, rtol=1e-4, atol=1e-4)
+
+
+def test_adapter_batch_expands_with_beam_search(lora_model):
+    input_ids = torch.randint(3, 64, (3, 6), generator=torch.Generator().manual_seed(1))
+    adapter_ids = [1, 2, 0]
+    generate_kwargs = {"max_new_tokens": 4, "num_beams": 2, "num_return_sequences": 2, "pad_token_id": 0}
+    with adapter_batch(lora_model, adapter_ids):
+        mixed = lora_model.generate(input_ids, **generate_kwargs)
+    for row, adapter_id in enumerate(adapter_ids):
+        with adapter_batch(lora_model, [adapter_id]):
+            alone = lora_model.generate(input_ids[row : row + 1], **generate_kwargs)
+        torch.testing.assert_close(mixed[2 * row : 2 * row + 2], alone)
+
+
+def test_adapter_batch_repeats_ids_for_expanded_rows(lora_model):
+    input_ids = torch.randint(3, 64, (3, 6), generator=torch.Generator().manual_seed(1))
+    with adapter_batch(lora_model, [1, 2, 0]):
+        logits = lora_model(input_ids).logits
+        expanded_logits = lora_model(input_ids.repeat_interleave(3, dim=0)).logits
+    torch.testing.assert_close(expanded_logits, logits.repeat_interleave(3, dim=0))
+
+
+def test_adapter_batch_rejects_mismatched_batch(lora_model):
+    input_ids = torch.randint(3, 64, (3, 6))
+    with adapter_batch(lora_model, [1, 2]), pytest.raises(ValueError, match="not a multiple"):
+        lora_model(input_ids)
@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+from wonderful_matrices.models.configuration_cheems import CheemsConfig
+from wonderful_matrices.models.configuration_doge import DogeConfig
+from wonderful_matrices.models.modeling_cheems import CheemsForCausalLM
+from wonderful_matrices.models.modeling_doge import DogeForCausalLM
+
+
+def tiny_model(model_class):
+    torch.manual_seed(0)
+    kwargs = dict(vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=3, num_attention_heads=2)
+    if model_class is CheemsForCausalLM:
+        # attention layers only, the ssd layers need the CUDA kernels of mamba_ssm
+        config = CheemsConfig(attn_layer_period=1, attn_layer_offset=0, **kwargs)
+    else:
+        config = DogeConfig(**kwargs)
+    model = model_class(config).eval()
+    # trained residual and norm weights, the initial ones are all ones
+    for layer in model.model.layers:
+        torch.nn.init.normal_(layer.post_state_residual.weight)
+        torch.nn.init.normal_(layer.pre_sequence_layernorm.weight)
+    return model
+
+
+@pytest.mark.parametrize("model_class", [DogeForCausalLM, CheemsForCausalLM])
+@torch.no_grad()
+def test_residual_carried_into_next_layer(model_class):
+    model = tiny_model(model_class)
+    input_ids = torch.randint(3, 64, (2, 7))
+    # returning the hidden states between the layers closes every residual connection inside its own layer
+    outputs = model(input_ids, output_hidden_states=True)
+    fused_logits = model(input_ids).logits
+    torch.testing.assert_close(fused_logits, outputs.logits, rtol=0, atol=0)
+
+    # the feed forward output and residual states returned by the first layer sum up to the input of the second one
+    layer = model.model.layers[0]
+    layer_outputs = []
+    handle = layer.register_forward_hook(lambda module, args, outputs: layer_outputs.append(outputs))
+    model(input_ids)
+    handle.remove()
+    hidden_states, residual_states = layer_outputs[0][0], layer_outputs[0][-1]
+    torch.testing.assert_close(layer.post_state_residual(residual_states, hidden_states), outputs.hidden_states[1])
@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from wonderful_matrices.models import configuration_doge_vision, modeing_doge_vision
+from wonderful_matrices.models.configuration_cheems import CheemsConfig
+from wonderful_matrices.models.configuration_doge import DogeConfig
+from wonderful_matrices.models.modeling_cheems import CheemsForCausalLM
+from wonderful_matrices.models.modeling_doge import DogeForCausalLM
+
+
+def tiny_model(model_class):
+    torch.manual_seed(0)
+    kwargs = dict(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        max_position_embeddings=16,
+    )
+    if model_class is CheemsForCausalLM:
+        # attention layers only, the ssd layers need the CUDA kernels of mamba_ssm
+        config = CheemsConfig(attn_layer_period=1, attn_layer_offset=0, **kwargs)
+    elif model_class is modeing_doge_vision.DogeForCausalVLM:
+        config = configuration_doge_vision.DogeConfig(image_size=[16, 16], patch_size=8, **kwargs)
+    else:
+        config = DogeConfig(**kwargs)
+    return model_class(config).eval()
+
+
+@pytest.mark.parametrize("model_class", [DogeForCausalLM, CheemsForCausalLM, modeing_doge_vision.DogeForCausalVLM])
+@torch.no_grad()
+def test_position_ids_beyond_the_cos_sin_table(model_class):
+    model = tiny_model(model_class)
+    input_ids = torch.randint(3, 64, (2, 9))
+    # no cache, the given positions run past both `max_position_embeddings` and the input length
+    position_ids = torch.arange(20, 29)[None].expand(2, -1)
+    model(input_ids, position_ids=position_ids, use_cache=False)
+
+    rotary_emb = model.model.rotary_emb
+    hidden_states = model.get_input_embeddings()(input_ids)
+    cos, sin = rotary_emb(hidden_states, position_ids)
+    expected_cos, expected_sin = rotary_emb._compute_cos_sin(position_ids, "cpu")
+    torch.testing.assert_close(cos, expected_cos)
+    torch.testing.assert_close(sin, expected_sin)